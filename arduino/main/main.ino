@@ -6,6 +6,28 @@
 
 #define SERIAL_BAUD_RATE 115200
 
+/* protocol */
+
+// the host selects the protocol by sending a mode byte at any time,
+// ascii lines are sent until told otherwise
+#define MODE_ASCII  'A'
+#define MODE_BINARY 'B'
+
+boolean binary_mode = false;
+
+// binary frames, 13 bytes little endian:
+// sync (0xA5), type, dt (uint32, us), x, y, z (int16), checksum
+// where checksum is the sum of the 12 preceding bytes (mod 256)
+#define FRAME_SYNC    0xA5
+#define FRAME_ACC     'a'
+#define FRAME_GYRO    'g'
+#define FRAME_WARNING 'w'
+#define FRAME_SIZE    13
+
+#define WARNING_SKIPPED_GYRO_READ 0
+
+byte frame[FRAME_SIZE];
+
 /* acc data */
 
 boolean acc_read_first = false;
@@ -129,6 +151,16 @@ void setup(){
 }
 
 void loop(){
+    // switch protocol if the host asks for it
+    while(Serial.available()){
+        b = Serial.read();
+        if(b == MODE_ASCII){
+            binary_mode = false;
+        }else if(b == MODE_BINARY){
+            binary_mode = true;
+        }
+    }
+
     // see application note 3.1.1 p.10 for details about reading STATUS_REG
     b = i2c_get(STATUS_REG);
     if(b & 1<<3){ // if gyro data is ready
@@ -138,7 +170,11 @@ void loop(){
 
         if(b & 1<<7){ // if skipped a gyro reading
             // send warning: w skipped gyro read
-            Serial.println("w\tskipped gyro read");
+            if(binary_mode){
+                send_frame(FRAME_WARNING, 0, WARNING_SKIPPED_GYRO_READ, 0, 0);
+            }else{
+                Serial.println("w\tskipped gyro read");
+            }
         }
 
         // fetch the gyro data
@@ -148,15 +184,19 @@ void loop(){
         }
 
         // send gyro data to serial
-        // output example: gtxyz 10023 -500 674 23
-        Serial.print("gtxyz\t");
-        Serial.print(dt); // microseconds, should be around 10000us <=> 100Hz
-        Serial.print("\t");
-        Serial.print(gyro[X]);
-        Serial.print("\t");
-        Serial.print(gyro[Y]);
-        Serial.print("\t");
-        Serial.println(gyro[Z]);
+        if(binary_mode){
+            send_frame(FRAME_GYRO, dt, gyro[X], gyro[Y], gyro[Z]);
+        }else{
+            // output example: gtxyz 10023 -500 674 23
+            Serial.print("gtxyz\t");
+            Serial.print(dt); // microseconds, should be around 10000us <=> 100Hz
+            Serial.print("\t");
+            Serial.print(gyro[X]);
+            Serial.print("\t");
+            Serial.print(gyro[Y]);
+            Serial.print("\t");
+            Serial.println(gyro[Z]);
+        }
     }
 
     if(acc_read){ // acc_read is set by the interrupt functions
@@ -167,14 +207,38 @@ void loop(){
         last_acc_time = now;
 
         // send acc data to serial
-        // output example: atxy 9983 4678 5121
-        Serial.print("atxy\t");
-        Serial.print(dt); // microseconds, should be around 10000us <=> 100Hz
-        Serial.print("\t");
-        Serial.print(acc[X]);
-        Serial.print("\t");
-        Serial.println(acc[Y]);
+        if(binary_mode){
+            send_frame(FRAME_ACC, dt, acc[X], acc[Y], 0);
+        }else{
+            // output example: atxy 9983 4678 5121
+            Serial.print("atxy\t");
+            Serial.print(dt); // microseconds, should be around 10000us <=> 100Hz
+            Serial.print("\t");
+            Serial.print(acc[X]);
+            Serial.print("\t");
+            Serial.println(acc[Y]);
+        }
+    }
+}
+
+/* binary protocol */
+
+void send_frame(byte type, long dt, int16_t x, int16_t y, int16_t z){
+    frame[0] = FRAME_SYNC;
+    frame[1] = type;
+    // the arduino is little endian, same as the frame
+    memcpy(frame + 2, &dt, 4);
+    memcpy(frame + 6, &x, 2);
+    memcpy(frame + 8, &y, 2);
+    memcpy(frame + 10, &z, 2);
+
+    byte sum = 0;
+    for(byte j=0; j<FRAME_SIZE-1; j++){
+        sum += frame[j];
     }
+    frame[FRAME_SIZE-1] = sum;
+
+    Serial.write(frame, FRAME_SIZE);
 }
 
 /* i2c helper functions */
@@ -0,0 +1,320 @@
+import json
+import platform
+import sys
+import time
+import numpy as np
+
+import fusion
+import linereader
+import prediction
+import recording
+import rotation
+import synthetic
+from helper import *
+
+"""
+    benchmark suite for the stabilization pipeline, run on synthetic sensor
+    data so results are reproducible without hardware
+
+    usage:
+        python benchmark.py [--out FILE] [--quick] [--recording FILE]
+            runs all benchmarks and writes the results as json to FILE
+            (default benchmark.json), with --recording the fusion backends
+            are also compared on a recorded session (see recording.py)
+        python benchmark.py --compare OLD NEW
+            prints the change of every benchmark between two result files
+"""
+
+# (acc rate, gyro rate) in Hz and output frequencies for the loop benchmark
+sensor_rates = [(100.0, 100.0), (400.0, 400.0), (1000.0, 1000.0)]
+output_freqs = [25.0, 50.0, 100.0]
+
+# fusion backends to compare, see fusion.create_fuser
+backends = ["complementary", "madgwick", "kalman"]
+
+# motion profiles for the accuracy benchmarks
+motions = [("sway", synthetic.sway), ("tilt", synthetic.tilt)]
+
+# camera latencies in seconds for the prediction benchmark
+latencies = [0.05, 0.1, 0.2]
+
+"""
+    best of
+    calls f() repeat times and returns the shortest run time in seconds,
+    the least disturbed run is the most reproducible number
+"""
+def best_of(f, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t = now()
+        f()
+        best = min(best, now() - t)
+    return best
+
+class BenchSerial:
+    """
+        a serial port that gives out one chunk of bytes per read pass
+        an empty chunk is a pass with nothing waiting, in_waiting moves past
+        it as read is not called then
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.i = 0
+
+    @property
+    def in_waiting(self):
+        if self.i >= len(self.chunks):
+            return 0
+        n = len(self.chunks[self.i])
+        if not n:
+            self.i += 1
+        return n
+
+    def read(self, size=1):
+        data = self.chunks[self.i]
+        self.i += 1
+        return data
+
+"""
+    per sample cost of Fuser.process, in microseconds
+"""
+def bench_process(acc_rate, gyro_rate, repeat):
+    acc, gyro, _ = synthetic.generate(10.0, acc_rate, gyro_rate)
+    lines = [s for _, s in synthetic.lines(acc, gyro)]
+
+    def run():
+        f = fusion.Fuser()
+        for s in lines:
+            f.process(s)
+
+    return best_of(run, repeat)/len(lines)*1e6
+
+"""
+    per sample cost of Fuser.process_batch, in microseconds
+"""
+def bench_process_batch(acc_rate, gyro_rate, repeat):
+    acc, gyro, _ = synthetic.generate(10.0, acc_rate, gyro_rate)
+    t = best_of(lambda: fusion.Fuser().process_batch(acc, gyro), repeat)
+    return t/(len(acc) + len(gyro))*1e6
+
+"""
+    runs the lines through a fuser of backend
+    returns (per sample cost in microseconds, angles after every line)
+"""
+def bench_backend(backend, lines, repeat):
+    # the filters alone, without online calibration
+    config = dict(fusion.default_config, backend=backend, online_cal=False)
+    angles = []
+
+    def run():
+        f = fusion.create_fuser(config)
+        del angles[:]
+        for s in lines:
+            try:
+                f.process(s)
+            except Exception:
+                pass # warnings in recordings
+            angles.append(list(f.angles)) # updated in place
+
+    return best_of(run, repeat)/len(lines)*1e6, np.array(angles)
+
+"""
+    rms error
+    returns the root mean square of the rows of a, per column, in degrees
+"""
+def rms_error(a):
+    return np.degrees(np.sqrt((a**2).mean(axis=0))).tolist()
+
+"""
+    error of the angles sent to the camera against the true angles latency
+    seconds later, when the move takes effect, see prediction.py
+    returns (rms error without, with prediction), in degrees over all axes
+"""
+def bench_prediction(motion, latency):
+    acc, gyro, _ = synthetic.generate(60.0, motion=motion)
+    f = fusion.create_fuser(dict(fusion.default_config, online_cal=False))
+    predictor = prediction.Predictor(latency=latency)
+
+    t, current, predicted = [], [], []
+    for ti, s in synthetic.lines(acc, gyro):
+        f.process(s)
+        t.append(ti)
+        current.append(list(f.angles))
+        predicted.append(predictor.predict(f.angles, f.rates))
+
+    truth = motion(np.array(t) + latency)
+    return [np.degrees(np.sqrt(((np.array(a) - truth)**2).sum(axis=1).mean()))
+        for a in [current, predicted]]
+
+"""
+    per call cost of Rotator.rotate, in microseconds
+"""
+def bench_rotate(n, repeat):
+    rotator = rotation.Rotator(0, 45)
+    angles = synthetic.sway(np.linspace(0.0, 10.0, n)).tolist()
+
+    def run():
+        for a in angles:
+            rotator.rotate(a)
+
+    return best_of(run, repeat)/n*1e6
+
+"""
+    per row cost of Rotator.rotate_many, in microseconds
+"""
+def bench_rotate_many(n, repeat):
+    rotator = rotation.Rotator(0, 45)
+    angles = synthetic.sway(np.linspace(0.0, 10.0, n))
+    return best_of(lambda: rotator.rotate_many(angles), repeat)/n*1e6
+
+"""
+    throughput of the control loop: serial framing, fusion and rotation at
+    every output tick (no camera)
+    the sensor bytes arriving between two output ticks are read in one pass,
+    as in main.py
+    returns (samples per second, seconds of sensor data per wall second)
+"""
+def bench_loop(acc_rate, gyro_rate, output_freq, repeat):
+    duration = 10.0
+    acc, gyro, _ = synthetic.generate(duration, acc_rate, gyro_rate)
+    lines = synthetic.lines(acc, gyro)
+
+    # split the byte stream at output ticks
+    ticks = np.floor(np.array([t for t, _ in lines])*output_freq).astype(int)
+    chunks = [bytearray() for _ in range(ticks[-1] + 1)]
+    for tick, (_, s) in zip(ticks.tolist(), lines):
+        chunks[tick] += (s + "\r\n").encode("ascii")
+    chunks = [bytes(c) for c in chunks]
+
+    processed = [0]
+
+    def run():
+        f = fusion.Fuser()
+        rotator = rotation.Rotator(0, 45)
+        reader = linereader.LineReader(BenchSerial(chunks))
+        n = 0
+        for _ in chunks:
+            for s in reader.read_lines():
+                f.process(s)
+                n += 1
+            rotator.rotate(f.angles)
+        processed[0] = n
+
+    t = best_of(run, repeat)
+    if processed[0] != len(lines):
+        raise Exception("loop benchmark processed %d of %d samples"%(
+            processed[0], len(lines)))
+    return len(lines)/t, duration/t
+
+def run_all(quick=False, recording_path=None):
+    repeat = 1 if quick else 5
+    results = []
+
+    def add(name, value, unit, **params):
+        results.append({
+            "name": name, "params": params, "value": value, "unit": unit})
+        print("  %-22s %-42s %10.2f %s"%(name, " ".join(
+            "%s=%s"%kv for kv in sorted(params.items())), value, unit))
+
+    for acc_rate, gyro_rate in sensor_rates:
+        add("fuser.process", bench_process(acc_rate, gyro_rate, repeat),
+            "us/sample", acc_rate=acc_rate, gyro_rate=gyro_rate)
+        add("fuser.process_batch",
+            bench_process_batch(acc_rate, gyro_rate, repeat),
+            "us/sample", acc_rate=acc_rate, gyro_rate=gyro_rate)
+
+    add("rotator.rotate", bench_rotate(10000, repeat), "us/call")
+    add("rotator.rotate_many", bench_rotate_many(100000, repeat), "us/row")
+
+    # accuracy against ground truth on synthetic data, with a gyro bias
+    for name, motion in motions:
+        acc, gyro, truth = synthetic.generate(
+            60.0, motion=motion, gyro_bias=(5.0, -3.0, 2.0))
+        lines = synthetic.lines(acc, gyro)
+        # truth at every line, the angles hold between gyro samples
+        i = np.searchsorted(truth[:, 0], [t for t, _ in lines], side="right")
+        truth_at = np.vstack([np.zeros((1, 3)), truth[:, 1:]])[i]
+        for backend in backends:
+            cost, angles = bench_backend(
+                backend, [s for _, s in lines], repeat)
+            error = rms_error(angles - truth_at)
+            add("fusion.cost", cost, "us/sample",
+                backend=backend, motion=name)
+            for axis, e in zip("xyz", error):
+                add("fusion.rms_error_" + axis, e, "deg",
+                    backend=backend, motion=name)
+
+    # camera latency compensation
+    for name, motion in motions:
+        for latency in latencies:
+            without, predicted = bench_prediction(motion, latency)
+            add("prediction.rms_error", without, "deg",
+                motion=name, latency=latency, predict=False)
+            add("prediction.rms_error", predicted, "deg",
+                motion=name, latency=latency, predict=True)
+
+    # cost on a recorded session, and how far each backend is from the
+    # complementary filter (there is no ground truth)
+    if recording_path:
+        lines = [s for _, s in recording.Replay(recording_path).lines()]
+        ref = None
+        for backend in backends:
+            cost, angles = bench_backend(backend, lines, repeat)
+            ref = angles if ref is None else ref
+            add("fusion.recorded_cost", cost, "us/sample", backend=backend)
+            for axis, e in zip("xyz", rms_error(angles - ref)):
+                add("fusion.recorded_diff_" + axis, e, "deg", backend=backend)
+
+    for acc_rate, gyro_rate in sensor_rates:
+        for output_freq in output_freqs:
+            rate, realtime = bench_loop(
+                acc_rate, gyro_rate, output_freq, repeat)
+            params = {"acc_rate": acc_rate, "gyro_rate": gyro_rate,
+                "output_freq": output_freq}
+            add("loop.throughput", rate, "samples/s", **params)
+            add("loop.realtime_factor", realtime, "x", **params)
+
+    return results
+
+"""
+    key
+    identifies a benchmark result across runs
+"""
+def key(r):
+    return r["name"] + " " + " ".join(
+        "%s=%s"%kv for kv in sorted(r["params"].items()))
+
+def compare(old_path, new_path):
+    old = dict((key(r), r) for r in json.load(open(old_path))["results"])
+    for r in json.load(open(new_path))["results"]:
+        k = key(r)
+        if k in old:
+            change = (r["value"]/old[k]["value"] - 1.0)*100.0
+            print("%-65s %10.2f -> %10.2f %s (%+.1f%%)"%(
+                k, old[k]["value"], r["value"], r["unit"], change))
+        else:
+            print("%-65s %10.2f %s (new)"%(k, r["value"], r["unit"]))
+
+def main():
+    if "--compare" in sys.argv:
+        compare(arg_value("--compare"), sys.argv[-1])
+        return
+
+    out_path = arg_value("--out") or "benchmark.json"
+
+    print("running benchmarks...")
+    results = run_all(quick="--quick" in sys.argv,
+        recording_path=arg_value("--recording"))
+
+    with open(out_path, "w") as f:
+        json.dump({
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "results": results
+        }, f, indent=2)
+    print("results written to %s"%out_path)
+
+if __name__ == "__main__":
+    main()
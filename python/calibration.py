@@ -0,0 +1,239 @@
+import json
+import os
+import threading
+
+class RunningStats:
+    """
+        running mean and variance per axis (Welford's algorithm), numerically
+        stable and without storing the samples
+    """
+    def __init__(self, axes):
+        self.axes = axes
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.mean = [0.0]*self.axes
+        self.m2 = [0.0]*self.axes
+
+    def add(self, x):
+        self.n += 1
+        n = self.n
+        mean, m2 = self.mean, self.m2
+        for i in range(self.axes):
+            d = x[i] - mean[i]
+            mean[i] += d/n
+            m2[i] += d*(x[i] - mean[i])
+
+    """
+        adds the rows of a numpy array a at once, the same as add for every
+        row, the statistics of a are merged into the running ones
+    """
+    def add_many(self, a):
+        n = len(a)
+        if not n:
+            return
+        a_mean = a.mean(axis=0)
+        a_m2 = ((a - a_mean)**2).sum(axis=0).tolist()
+        total = self.n + n
+        mean, m2 = self.mean, self.m2
+        for i, x in enumerate(a_mean.tolist()):
+            d = x - mean[i]
+            mean[i] += d*n/total
+            m2[i] += a_m2[i] + d*d*self.n*n/total
+        self.n = total
+
+    """
+        returns the sample variance per axis
+    """
+    def variance(self):
+        if self.n < 2:
+            return [0.0]*self.axes
+        return [m/(self.n - 1) for m in self.m2]
+
+class OnlineCalibrator:
+    """
+        estimates the zero values of the gyro (and optionally the acc) of a
+        fuser while it is stabilizing
+
+        raw samples are added to running statistics for as long as the rig is
+        still, any sample further than gyro_threshold (acc_threshold) raw
+        units from the mean so far starts over
+        when both gyro and acc have been still for window seconds (summed
+        from the sample dt, so the same at any sample rate) and at least
+        min_samples samples, the zero values in f.config move rate of the
+        way towards the means
+        a slow sway or turn looks still for a moment near its slowest, a
+        window of seconds is long enough to see it move
+
+        a still period with a gyro mean further than max_change from the
+        current zero value is ignored, as that is more likely a slow steady
+        turn than bias
+
+        the acc zero values are only observable if the rig is level when
+        still, so they are only updated with calibrate_acc
+
+        this runs inside the fuser, nothing is written to disk here, see
+        CalibrationSaver
+    """
+    def __init__(self, f, window=3.0, min_samples=100, gyro_threshold=20.0,
+            acc_threshold=20.0, max_change=150.0, rate=0.5,
+            calibrate_acc=False):
+        self.f = f
+        self.window = window
+        self.min_samples = min_samples
+        self.gyro_threshold = gyro_threshold
+        self.acc_threshold = acc_threshold
+        self.max_change = max_change
+        self.rate = rate
+        self.calibrate_acc = calibrate_acc
+
+        self.gyro_stats = RunningStats(3)
+        self.acc_stats = RunningStats(2)
+
+        # seconds still so far
+        self.gyro_still = 0.0
+        self.acc_still = 0.0
+
+        # number of updates of the zero values, and rejected still periods
+        self.updates = 0
+        self.rejected = 0
+
+    """
+        adds a raw acc sample [x, y], dt microseconds after the last one
+    """
+    def add_acc(self, dt, acc_raw):
+        if self.moved(self.acc_stats, acc_raw, self.acc_threshold):
+            self.acc_still = 0.0
+        self.acc_still += dt*1e-6
+        self.acc_stats.add(acc_raw)
+        self.check()
+
+    """
+        adds a raw gyro sample [x, y, z], dt microseconds after the last one
+    """
+    def add_gyro(self, dt, gyro_raw):
+        if self.moved(self.gyro_stats, gyro_raw, self.gyro_threshold):
+            self.gyro_still = 0.0
+        self.gyro_still += dt*1e-6
+        self.gyro_stats.add(gyro_raw)
+        self.check()
+
+    """
+        returns True and starts stats over if x is further than threshold
+        from the mean so far
+    """
+    def moved(self, stats, x, threshold):
+        if stats.n and max(abs(a - m) for a, m in zip(x, stats.mean)) > threshold:
+            stats.reset()
+            return True
+        return False
+
+    def check(self):
+        if self.gyro_still >= self.window and self.acc_still >= self.window \
+                and self.gyro_stats.n >= self.min_samples \
+                and self.acc_stats.n >= self.min_samples:
+            self.update()
+
+    """
+        moves the zero values towards the means of the still period
+    """
+    def update(self):
+        c = self.f.config
+        gyro_mean = self.gyro_stats.mean
+        acc_mean = self.acc_stats.mean
+        self.gyro_stats.reset()
+        self.acc_stats.reset()
+        self.gyro_still = 0.0
+        self.acc_still = 0.0
+
+        if max(abs(m - cal) for m, cal in zip(gyro_mean, c["gyro_cal"])) \
+                > self.max_change:
+            self.rejected += 1
+            return
+
+        # new lists, the old ones may be shared with other configs
+        c["gyro_cal"] = [cal + self.rate*(m - cal) for m, cal in \
+            zip(gyro_mean, c["gyro_cal"])]
+        if self.calibrate_acc:
+            c["acc_cal"] = [cal + self.rate*(m - cal) for m, cal in \
+                zip(acc_mean, c["acc_cal"])]
+        self.f.configure()
+        self.updates += 1
+
+class CalibrationSaver(threading.Thread):
+    """
+        writes the zero values of the fuser f to the calibration file at
+        path every interval seconds, if the online calibration has updated
+        them since, from a background thread so the control loop never
+        waits for the disk
+
+        the calibrator replaces the zero value lists instead of changing
+        them, so they can be read from here without a lock
+    """
+    def __init__(self, f, path, interval=60.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.f = f
+        self.path = path
+        self.interval = interval
+        self.saved = f.calibrator.updates # updates when last saved
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.save()
+
+    def save(self):
+        updates = self.f.calibrator.updates
+        if updates != self.saved:
+            save_calibration(self.path, self.f.config)
+            self.saved = updates
+
+    """
+        stops the thread and saves what is not saved yet
+    """
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.save()
+
+"""
+    default path
+    returns the calibration file of the rig name, every sensor board has its
+    own zero values, so rigs must not share a file
+"""
+def default_path(name="rig"):
+    return "calibration-%s.json"%name
+
+"""
+    save calibration
+    writes the zero values of config to the calibration file at path
+"""
+def save_calibration(path, config):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({
+            "gyro_cal": config["gyro_cal"],
+            "acc_cal": config["acc_cal"]
+        }, f, indent=2)
+    # replace in one step, so a crash never leaves a half written file
+    if os.name == "nt" and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+"""
+    load calibration
+    returns a copy of config with the zero values from the calibration file
+    at path, or config itself if there is no such file
+"""
+def load_calibration(path, config):
+    if not path or not os.path.exists(path):
+        return config
+    with open(path) as f:
+        cal = json.load(f)
+    config = dict(config)
+    for key in ["gyro_cal", "acc_cal"]:
+        if key in cal:
+            config[key] = [float(x) for x in cal[key]]
+    return config
@@ -1,30 +1,437 @@
-import requests
+from math import sqrt
+import threading
+
+import instrument
+from helper import now
+from ringbuffer import RingBuffer
 
 class Camera:
     """
         sets the default ip address and resets the camera
+        shaper: a CommandShaper to leave out moves that change little, None
+            sends every move
+        estimator: a PositionEstimator to ask the camera for its position
+            only now and then, None asks before every move
     """
-    def __init__(self, ip):
-        self.s = requests.Session()
+    def __init__(self, ip, shaper=None, estimator=None):
+        self.s = None # requests session, created on the first request
         self.addr = "http://root:pass@" + ip + "/axis-cgi/com/"
+        self.shaper = shaper
+        self.estimator = estimator
+
+        # timing of the http requests of move, see instrument.py
+        self.query_h = instrument.histogram("camera.query")
+        self.command_h = instrument.histogram("camera.command")
 
     """
         moves the camera to pan, tilt in t seconds
-        returns true if successful
+        returns True if a move was sent, False if the shaper left it out
+        after asking the position, None if it was left out without any
+        request
     """
     def move(self, pan, tilt, t):
-        r = self.s.get(self.addr + "ptz.cgi?query=position")
-        d = dict([s.split("=") for s in r.content.strip().splitlines()[0:2]])
-        cpan = float(d["pan"])
-        ctilt = float(d["tilt"])
+        if self.shaper and self.shaper.at_rest(pan, tilt, now()):
+            return None
+
+        cpan, ctilt = self.current_position()
 
         vpan = (pan - cpan)/t
         vtilt = (tilt - ctilt)/t
 
-        self.s.get(self.addr + 'ptz.cgi?continuouspantiltmove=%s,%s'%(vpan, vtilt))
+        if self.shaper:
+            v = self.shaper.shape(pan, tilt, cpan, ctilt, vpan, vtilt, now())
+            if v is None:
+                return False
+            vpan, vtilt = v
+
+        self.continuous_move(vpan, vtilt)
+        return True
+
+    """
+        sends a request for path (relative to the com address)
+        requests is imported here, from the worker thread, so a rig starts
+        stabilizing without waiting for it
+    """
+    def get(self, path):
+        if self.s is None:
+            import requests
+            self.s = requests.Session()
+        return self.s.get(self.addr + path)
+
+    """
+        returns the current [pan, tilt] of the camera
+    """
+    def position(self):
+        start_t = now()
+        r = self.get("ptz.cgi?query=position")
+        done_t = now()
+        self.query_h.add(done_t - start_t)
+        d = dict([s.split("=") for s in r.text.strip().splitlines()[0:2]])
+        pan, tilt = float(d["pan"]), float(d["tilt"])
+        if self.estimator:
+            # the camera answered somewhere during the request
+            self.estimator.sync(pan, tilt, (start_t + done_t)/2.0)
+        return [pan, tilt]
+
+    """
+        returns the [pan, tilt] of the camera, from the estimator unless it
+        is due to be synced with the camera
+    """
+    def current_position(self):
+        e = self.estimator
+        t = now()
+        if e and not e.due(t):
+            return e.position(t)
+        return self.position()
+
+    """
+        starts moving the camera with velocity vpan, vtilt
+    """
+    def continuous_move(self, vpan, vtilt):
+        start_t = now()
+        self.get('ptz.cgi?continuouspantiltmove=%s,%s'%(vpan, vtilt))
+        done_t = now()
+        self.command_h.add(done_t - start_t)
+        if self.estimator:
+            self.estimator.move(vpan, vtilt, start_t, done_t)
 
     """
         stops the camera
     """
     def stop(self):
-        self.get(self.addr + "ptz.cgi?continuouspantiltmove=0,0")
+        self.continuous_move(0, 0)
+
+class PositionEstimator:
+    """
+        keeps track of the camera position from the velocities sent to it,
+        so it only has to be asked now and then
+
+        the camera is taken to change velocity at the middle of the request
+        that sent it, which is off by up to half the request, so every
+        change adds |change|*request/2 degrees to the possible error, and
+        moving adds drift_rate of the distance (speed not exactly as
+        commanded)
+        the camera is asked again (see due) when the possible error exceeds
+        max_error degrees, or after max_age seconds
+
+        the error of the estimate is measured at every sync, see snapshot,
+        it includes the timing error of the query itself, as asking before
+        every move would have
+    """
+    def __init__(self, max_error=0.2, max_age=2.0, drift_rate=0.02):
+        self.max_error = max_error
+        self.max_age = max_age
+        self.drift_rate = drift_rate
+
+        # pan, tilt at time t moving with vpan, vtilt, None until synced
+        self.pan = self.tilt = None
+        self.vpan = self.vtilt = 0.0
+        self.t = None
+        self.sync_t = None
+        self.error = 0.0 # possible, degrees
+
+        # counters, errors in degrees
+        self.syncs = 0
+        self.estimates = 0
+        self.error_sq = 0.0 # sum of squares of measured errors
+        self.error_max = 0.0
+        self.error_latest = 0.0
+
+    """
+        returns True if the camera should be asked for its position at t
+    """
+    def due(self, t):
+        return self.t is None or t - self.sync_t > self.max_age or \
+            self.error + self.drift(t) > self.max_error
+
+    """
+        returns the possible error added by moving from self.t to t
+    """
+    def drift(self, t):
+        return self.drift_rate*(abs(self.vpan) + abs(self.vtilt))*(t - self.t)
+
+    """
+        returns the estimated [pan, tilt] at t
+    """
+    def position(self, t):
+        self.estimates += 1
+        dt = t - self.t
+        return [self.pan + self.vpan*dt, self.tilt + self.vtilt*dt]
+
+    """
+        moves the estimate on to t
+    """
+    def advance(self, t):
+        dt = t - self.t
+        self.error += self.drift(t)
+        self.pan += self.vpan*dt
+        self.tilt += self.vtilt*dt
+        self.t = t
+
+    """
+        the velocity vpan, vtilt was sent in a request from start_t to done_t
+    """
+    def move(self, vpan, vtilt, start_t, done_t):
+        vpan, vtilt = float(vpan), float(vtilt)
+        if self.t is not None:
+            t = (start_t + done_t)/2.0
+            self.advance(t)
+            self.error += (abs(vpan - self.vpan) + abs(vtilt - self.vtilt))* \
+                (done_t - start_t)/2.0
+        self.vpan, self.vtilt = vpan, vtilt
+
+    """
+        the camera was at pan, tilt at t
+    """
+    def sync(self, pan, tilt, t):
+        if self.t is not None:
+            epan, etilt = self.position(t)
+            self.estimates -= 1 # not used to move
+            e = sqrt((pan - epan)**2 + (tilt - etilt)**2)
+            self.error_latest = e
+            self.error_max = max(self.error_max, e)
+            self.error_sq += e*e
+            self.syncs += 1
+        self.pan, self.tilt = pan, tilt
+        self.t = self.sync_t = t
+        self.error = 0.0
+
+    """
+        returns the counters and the measured error of the estimates
+    """
+    def snapshot(self):
+        return {
+            "syncs": self.syncs,
+            "estimates": self.estimates,
+            "error_rms": sqrt(self.error_sq/self.syncs) if self.syncs else 0.0,
+            "error_max": self.error_max,
+            "error_latest": self.error_latest
+        }
+
+class CommandShaper:
+    """
+        leaves out camera moves that would change little, to cut the http
+        load on the camera and the network
+
+        dead_band: degrees, errors smaller than this are not corrected
+        min_dv: degrees per second, a new velocity closer than this to the
+            last one sent is not sent
+        max_rate: velocity commands per second at most
+        max_rest: seconds, a camera stopped within the dead band is assumed
+            to stay there without asking it, for at most this long
+
+        a stop is always sent right away, so the camera never keeps crawling
+        on a left out command
+    """
+    def __init__(self, dead_band=0.2, min_dv=0.5, max_rate=10.0,
+            max_rest=2.0):
+        self.dead_band = dead_band
+        self.min_dv = min_dv
+        self.min_interval = 1.0/max_rate
+        self.max_rest = max_rest
+
+        # last velocity sent and when, None before the first
+        self.last_v = None
+        self.last_t = None
+
+        # (pan, tilt, time) where the camera was stopped, None if moving
+        self.rest = None
+
+        # counters
+        self.commands = 0 # velocity commands sent
+        self.suppressed = 0 # velocity commands left out
+        self.queries_skipped = 0 # moves left out without asking the position
+
+    """
+        returns True if the camera was stopped within the dead band of pan,
+        tilt (recently enough), then the move is left out entirely
+    """
+    def at_rest(self, pan, tilt, t):
+        if self.rest is None:
+            return False
+        rpan, rtilt, rest_t = self.rest
+        if t - rest_t > self.max_rest:
+            self.rest = None # ask again
+            return False
+        if abs(pan - rpan) < self.dead_band and \
+                abs(tilt - rtilt) < self.dead_band:
+            self.suppressed += 1
+            self.queries_skipped += 1
+            return True
+        return False
+
+    """
+        shapes a move to pan, tilt of a camera at cpan, ctilt, that would be
+        done with velocity vpan, vtilt, at time t
+        returns the velocity [vpan, vtilt] to send or None to send nothing
+    """
+    def shape(self, pan, tilt, cpan, ctilt, vpan, vtilt, t):
+        # close enough, stop instead of hunting around the target
+        if abs(pan - cpan) < self.dead_band:
+            vpan = 0.0
+        if abs(tilt - ctilt) < self.dead_band:
+            vtilt = 0.0
+        stop = vpan == 0.0 and vtilt == 0.0
+
+        if self.last_v is not None:
+            lpan, ltilt = self.last_v
+            if stop and (lpan != 0.0 or ltilt != 0.0):
+                pass # always stop right away
+            elif (abs(vpan - lpan) < self.min_dv and
+                    abs(vtilt - ltilt) < self.min_dv) or \
+                    t - self.last_t < self.min_interval:
+                self.suppressed += 1
+                if stop:
+                    self.rest = (cpan, ctilt, t)
+                return None
+
+        self.last_v = [vpan, vtilt]
+        self.last_t = t
+        self.commands += 1
+        self.rest = (cpan, ctilt, t) if stop else None
+        return [vpan, vtilt]
+
+    """
+        returns the counters for diagnostics
+    """
+    def snapshot(self):
+        return {
+            "commands": self.commands,
+            "suppressed": self.suppressed,
+            "queries_skipped": self.queries_skipped
+        }
+
+class CameraWorker(threading.Thread):
+    """
+        moves camera from a background thread, so the control loop never
+        waits for http
+
+        only the newest target is kept: a target submitted before the previous
+        one was sent replaces it, and the replaced one is counted as dropped
+    """
+    def __init__(self, camera, buffer_size=100):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.camera = camera
+        self.cond = threading.Condition()
+        self.running = True
+
+        # newest (pan, tilt, t, submit time) not yet sent, None if nothing to do
+        self.target = None
+
+        # True while a move is being sent
+        self.in_flight = False
+
+        # counters
+        self.submitted = 0
+        self.sent = 0
+        self.suppressed = 0 # left out by the shaper of the camera
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = None
+
+        # duration of the newest move that made requests, and how many
+        self.rtt = None
+        self.round_trips = 0
+
+        # buffers for diagnostics, newest first
+        # latency: duration of camera.move (http round trips)
+        # age: time from submit until the move was done
+        self.latency_buf = RingBuffer(buffer_size)
+        self.age_buf = RingBuffer(buffer_size)
+
+        # time from submit until the move was started, see instrument.py
+        self.wait_h = instrument.histogram("camera.wait")
+
+    """
+        asks the worker to move the camera to pan, tilt in t seconds,
+        never blocks
+    """
+    def submit(self, pan, tilt, t):
+        with self.cond:
+            if self.target is not None:
+                self.dropped += 1
+            self.target = (pan, tilt, t, now())
+            self.submitted += 1
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and self.target is None:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                pan, tilt, t, submit_t = self.target
+                self.target = None
+                self.in_flight = True
+
+            start_t = now()
+            self.wait_h.add(start_t - submit_t)
+            try:
+                moved = self.camera.move(pan, tilt, t)
+                ok = True
+            except Exception as e:
+                ok = False
+                self.last_error = e
+            done_t = now()
+
+            with self.cond:
+                self.in_flight = False
+                if ok and moved is not None:
+                    self.rtt = done_t - start_t
+                    self.round_trips += 1
+                if not ok:
+                    self.errors += 1
+                elif moved:
+                    self.sent += 1
+                    self.latency_buf.push(done_t - start_t)
+                    self.age_buf.push(done_t - submit_t)
+                else:
+                    self.suppressed += 1
+
+    """
+        returns a copy of the worker state for diagnostics
+    """
+    def snapshot(self):
+        with self.cond:
+            return {
+                "submitted": self.submitted,
+                "sent": self.sent,
+                "suppressed": self.suppressed,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "last_error": self.last_error,
+                "in_flight": self.in_flight,
+                "pending": self.target is not None,
+                "latency_avg": self.latency_buf.mean(),
+                "latency_max": self.latency_buf.max(),
+                "latency": list(self.latency_buf),
+                "age": list(self.age_buf)
+            }
+
+    """
+        returns (sent, age of the newest sent move in seconds), for keeping
+        up with the latency without copying the buffers
+    """
+    def latest(self):
+        with self.cond:
+            return self.sent, self.age_buf.latest()
+
+    """
+        returns (round trips, duration of the newest in seconds, dropped), for
+        adapting the output rate, see scheduler.RateController
+    """
+    def throughput(self):
+        with self.cond:
+            return self.round_trips, self.rtt, self.dropped
+
+    """
+        stops the worker thread, a move in flight is finished first
+    """
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.join()
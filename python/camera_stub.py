@@ -0,0 +1,237 @@
+from math import pi, sin, sqrt
+import random
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError: # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import camera
+from helper import *
+
+class StubCamera:
+    """
+        a simulated pan/tilt head, moves with the last commanded continuous
+        velocity (degrees per second)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pan = 0.0
+        self.tilt = 0.0
+        self.vpan = 0.0
+        self.vtilt = 0.0
+        self.last_t = now()
+        self.queries = 0
+        self.moves = 0
+
+    # integrate position up to now, call with lock held
+    def update(self):
+        t = now()
+        self.pan += self.vpan*(t - self.last_t)
+        self.tilt += self.vtilt*(t - self.last_t)
+        self.last_t = t
+
+    def position(self):
+        with self.lock:
+            self.update()
+            self.queries += 1
+            return self.pan, self.tilt
+
+    def move(self, vpan, vtilt):
+        with self.lock:
+            self.update()
+            self.moves += 1
+            self.vpan, self.vtilt = vpan, vtilt
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+        answers the subset of VAPIX ptz.cgi used by camera.Camera
+    """
+    def do_GET(self):
+        server = self.server
+        if server.delay or server.jitter:
+            time.sleep(server.delay + random.random()*server.jitter)
+
+        query = self.path.split("?", 1)[-1]
+        if not self.path.split("?")[0].endswith("/axis-cgi/com/ptz.cgi"):
+            self.send_response(404)
+            self.end_headers()
+        elif query == "query=position":
+            pan, tilt = server.camera.position()
+            body = "pan=%.4f\ntilt=%.4f\nzoom=1\n"%(pan, tilt)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body.encode("ascii"))
+        elif query.startswith("continuouspantiltmove="):
+            try:
+                vpan, vtilt = map(float, query.split("=")[1].split(","))
+            except ValueError:
+                self.send_response(400)
+                self.end_headers()
+                return
+            server.camera.move(vpan, vtilt)
+            self.send_response(204) # like the camera, no content
+            self.end_headers()
+        else:
+            self.send_response(400)
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass # keep the console clean
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+"""
+    starts a stub camera server on localhost in a background thread
+    delay: seconds added to every request, jitter: extra random seconds
+    returns the server, its address is server.server_address and the
+    simulated head is server.camera
+"""
+def start_stub(port=0, delay=0.0, jitter=0.0):
+    server = StubServer(("127.0.0.1", port), StubHandler)
+    server.camera = StubCamera()
+    server.delay = delay
+    server.jitter = jitter
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+"""
+    percentile
+    returns the p:th percentile (0-100) of list l
+"""
+def percentile(l, p):
+    s = sorted(l)
+    return s[min(len(s) - 1, int(p/100.0*len(s)))]
+
+"""
+    follow
+    moves the camera of server through a worker at rate hz for duration
+    seconds, the target is still for the first half and then sways
+    returns (http requests per second, rms tracking error in degrees,
+    average duration of a move in seconds)
+"""
+def follow(server, shaper, rate, duration, estimator=None):
+    ip = "%s:%d"%server.server_address
+    stub = server.camera
+    with stub.lock:
+        stub.pan = stub.tilt = stub.vpan = stub.vtilt = 0.0
+        stub.queries = stub.moves = 0
+
+    w = camera.CameraWorker(camera.Camera(ip, shaper, estimator))
+    w.start()
+    errors = []
+    start_t = now()
+    next_t = start_t
+    while now() - start_t < duration:
+        t = now() - start_t
+        sway = 2.0*sin(2*pi*0.3*t) if t > duration/2 else 0.0
+        w.submit(sway, sway/2, 2.0/rate)
+        pan, tilt = stub.position()
+        errors.append((pan - sway)**2 + (tilt - sway/2)**2)
+        next_t += 1.0/rate
+        time.sleep(max(0.0, next_t - now()))
+    w.stop()
+
+    with stub.lock:
+        requests = stub.queries + stub.moves - len(errors) # not our queries
+    return requests/duration, sqrt(sum(errors)/len(errors)), \
+        w.latency_buf.mean()
+
+"""
+    benchmarks camera.Camera and camera.CameraWorker against a stub server
+
+    usage: python camera_stub.py [delay ms] [jitter ms] [rate hz] [seconds]
+    with no arguments, serves a stub on port 8080 until interrupted
+"""
+def main():
+    if len(sys.argv) == 1:
+        server = start_stub(8080)
+        print("stub camera at 127.0.0.1:8080, ctrl-c to stop")
+        while True:
+            time.sleep(1)
+
+    delay, jitter, rate, duration = [float(x) for x in
+        (sys.argv[1:] + ["10", "5", "25", "5"][len(sys.argv) - 1:])]
+    server = start_stub(delay=delay*1e-3, jitter=jitter*1e-3)
+    ip = "%s:%d"%server.server_address
+
+    # blocking, as called from the control loop before
+    c = camera.Camera(ip)
+    latencies = []
+    end_t = now() + duration
+    while now() < end_t:
+        t = now()
+        c.move(10.0, 20.0, 0.08)
+        latencies.append(now() - t)
+    print("blocking move:")
+    print("  moves/s: %.1f"%(len(latencies)/duration))
+    print("  latency p50 p99 max [ms]: %.1f %.1f %.1f"%(
+        percentile(latencies, 50)*1e3, percentile(latencies, 99)*1e3,
+        max(latencies)*1e3))
+
+    # worker, submitting at rate hz
+    w = camera.CameraWorker(camera.Camera(ip), buffer_size=100000)
+    w.start()
+    submit_t = []
+    end_t = now() + duration
+    next_t = now()
+    while now() < end_t:
+        t = now()
+        w.submit(10.0, 20.0, 0.08)
+        submit_t.append(now() - t)
+        next_t += 1.0/rate
+        time.sleep(max(0.0, next_t - now()))
+    w.stop()
+
+    s = w.snapshot()
+    latency = s["latency"][:s["sent"]]
+    age = s["age"][:s["sent"]]
+    print("worker at %.0f hz:"%rate)
+    print("  submitted sent dropped errors: %d %d %d %d"%(
+        s["submitted"], s["sent"], s["dropped"], s["errors"]))
+    print("  moves/s: %.1f"%(s["sent"]/duration))
+    print("  submit p50 max [us]: %.1f %.1f"%(
+        percentile(submit_t, 50)*1e6, max(submit_t)*1e6))
+    if latency:
+        print("  latency p50 p99 max [ms]: %.1f %.1f %.1f"%(
+            percentile(latency, 50)*1e3, percentile(latency, 99)*1e3,
+            max(latency)*1e3))
+        print("  age p50 p99 max [ms]: %.1f %.1f %.1f"%(
+            percentile(age, 50)*1e3, percentile(age, 99)*1e3, max(age)*1e3))
+
+    # with and without camera.CommandShaper and camera.PositionEstimator
+    for name, shaper, estimator in [
+            ("unshaped", None, None),
+            ("shaped", camera.CommandShaper(), None),
+            ("estimated", None, camera.PositionEstimator()),
+            ("shaped estimated", camera.CommandShaper(),
+                camera.PositionEstimator())]:
+        requests, error, move_t = follow(server, shaper, rate, duration,
+            estimator)
+        print("%s moves at %.0f hz:"%(name, rate))
+        print("  http requests/s: %.1f"%requests)
+        print("  move avg [ms]: %.1f"%(move_t*1e3))
+        print("  rms tracking error [deg]: %.3f"%error)
+        if shaper:
+            print("  commands suppressed queries skipped: %d %d %d"%(
+                shaper.commands, shaper.suppressed, shaper.queries_skipped))
+        if estimator:
+            e = estimator.snapshot()
+            print("  syncs estimates: %d %d, estimate error rms max [deg]: "
+                "%.3f %.3f"%(e["syncs"], e["estimates"], e["error_rms"],
+                e["error_max"]))
+
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+import os
+import sys
+import threading
+
+import instrument
+from helper import *
+
+"""
+    terminal dashboard
+
+    the control loop only hands a snapshot of the state (Stabilizer.stats)
+    to a Renderer at its rate, the renderer builds the text and writes it
+    to the terminal from its own thread, so the loop never waits for stdout
+    only lines that changed since the last frame are redrawn, using ansi
+    cursor movement
+"""
+
+# frames per second
+default_rate = 5.0
+
+class Renderer(threading.Thread):
+    """
+        draws render_f(stats) from a background thread, at most rate times
+        a second, newer stats replace ones not drawn yet
+
+        in_place: redraw the screen, otherwise the text is printed below
+            the last frame (for simple output)
+        ansi: use ansi cursor movement for in place redraws, None detects
+            if the terminal supports it, without it the screen is cleared
+            for every frame
+    """
+    def __init__(self, render_f, rate=default_rate, in_place=True, ansi=None,
+            out=sys.stdout):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.render_f = render_f
+        self.interval = 1.0/rate
+        self.in_place = in_place
+        self.ansi = supports_ansi(out) if ansi is None else ansi
+        self.out = out
+
+        self.cond = threading.Condition()
+        self.running = True
+        self.stats = None # newest stats not drawn yet
+        self.last_publish = 0.0
+
+        # lines on screen
+        self.lines = []
+
+        self.frames = 0
+        self.render_h = instrument.histogram("dashboard.render")
+
+    """
+        hands the state of stab to the renderer if a frame is due, called
+        from the control loop (as Stabilizer.run(on_output)), never blocks
+        on the terminal
+    """
+    def publish(self, stab):
+        t = now()
+        if t - self.last_publish < self.interval:
+            return
+        self.last_publish = t
+        d = stab.stats()
+        with self.cond:
+            self.stats = d
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and self.stats is None:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                d = self.stats
+                self.stats = None
+
+            t = now()
+            self.draw(self.render_f(d).split("\n"))
+            self.render_h.add(now() - t)
+            self.frames += 1
+
+    """
+        writes the lines of a frame
+    """
+    def draw(self, lines):
+        if not self.in_place:
+            self.out.write("\n".join(lines) + "\n")
+        elif self.ansi:
+            s = []
+            if not self.frames:
+                s.append("\x1b[2J") # clear the screen once
+            for i, line in enumerate(lines):
+                if i >= len(self.lines) or line != self.lines[i]:
+                    # move to the line, write it and clear the rest of it
+                    s.append("\x1b[%d;1H%s\x1b[K"%(i + 1, line))
+            # clear below, if the frame got shorter, and park the cursor
+            s.append("\x1b[%d;1H\x1b[J"%(len(lines) + 1))
+            self.out.write("".join(s))
+        else:
+            self.out.write("\n"*100 + "\n".join(lines) + "\n")
+        self.out.flush()
+        self.lines = lines
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.join()
+
+"""
+    supports ansi
+    returns True if out is a terminal that understands ansi escape codes,
+    on windows they are turned on if possible (windows 10 and newer)
+"""
+def supports_ansi(out):
+    if not hasattr(out, "isatty") or not out.isatty():
+        return False
+    if os.name != "nt":
+        return True
+    try:
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        h = kernel32.GetStdHandle(-11) # stdout
+        mode = ctypes.c_uint32()
+        if not kernel32.GetConsoleMode(h, ctypes.byref(mode)):
+            return False
+        # ENABLE_VIRTUAL_TERMINAL_PROCESSING
+        return bool(kernel32.SetConsoleMode(h, mode.value | 0x0004))
+    except Exception:
+        return False
+
+"""
+    render simple
+    returns the one line of simple output for the stats d of a rig
+"""
+def render_simple(d):
+    out_f_data = map(round_to_int, d["out_f"])
+    return "out tgt cur avg min: {:3d} {:3d} {:3d} {:3d}".format(*out_f_data)
+
+"""
+    render
+    returns the dashboard text for the stats d of a rig (Stabilizer.stats)
+"""
+def render(d):
+    # calculate diagnostic data
+    acc_f_data = map(round_to_int, d["acc_f"])
+    gyro_f_data = map(round_to_int, d["gyro_f"])
+    out_f_data = map(round_to_int, d["out_f"])
+    fus_t_data = [int(x*1.0e6) for x in d["fus_t"]]
+    rot_t_data = [int(x*1.0e6) for x in d["rot_t"]]
+    out_t_data = [int(x*1.0e6) for x in d["out_t"]]
+    jitter_data = [int(x*1.0e6) for x in d["jitter"]]
+
+    cam = d["camera"]
+    if cam:
+        cam_t_data = [int(x*1.0e3) for x in cam["latency"]]
+        cam_lines = [
+            "  http avg max [ms]: {:5d} {:5d}".format(*cam_t_data),
+            "  sent suppressed dropped errors: {} {} {} {}".format(
+                cam["sent"], cam["suppressed"], cam["dropped"], cam["errors"]),
+            "  in flight: %s"%("yes" if cam["in_flight"] else "no")
+        ]
+        pos = cam["position"]
+        if pos:
+            cam_lines.append(
+                "  position syncs estimates: {} {}, error rms max [deg]: "
+                "{:.2f} {:.2f}".format(pos["syncs"], pos["estimates"],
+                pos["error_rms"], pos["error_max"]))
+    else:
+        cam_lines = ["  disabled"]
+
+    cal = d["calibration"]
+    if cal:
+        cal_lines = [
+            "  gyro zero: " + nice_format_list_of_float(cal["gyro_cal"]),
+            "  updates rejected: {} {}".format(cal["updates"], cal["rejected"])
+        ]
+    else:
+        cal_lines = ["  disabled"]
+
+    pred = d["prediction"]
+    if pred:
+        pred_lines = [
+            "  latency horizon [ms]: {:5d} {:5d}".format(
+                int(pred["latency"]*1.0e3), int(pred["horizon"]*1.0e3)),
+            "  measurements: {}".format(pred["measurements"])
+        ]
+    else:
+        pred_lines = ["  disabled"]
+
+    rate = d["rate"]
+    if rate:
+        rate_lines = [
+            "  out limit [hz]: {:3d} {:3d}".format(
+                round_to_int(rate["freq"]), round_to_int(rate["limit"])),
+            "  rtt [ms]: {:5d}, changes: {}".format(
+                int((rate["rtt"] or 0.0)*1.0e3), rate["changes"])
+        ]
+    else:
+        rate_lines = ["  fixed"]
+
+    timing_lines = ["  {:16s} {:7d} {:7d} {:7d} {:7d}".format(name,
+        *[int(h[k]*1.0e6) for k in ["p50", "p99", "p999", "max"]])
+        for name, h in sorted(d["timing"].items())]
+
+    x, y, z = d["angles"]
+
+    return "\n".join([
+        ascii_art+"\n",
+        "serial: %s"%d["serial"],
+        "camera: %s"%(d["camera_ip"] or "disabled"),
+        "fusion: %s"%d["backend"],
+        "target:",
+        "  pan:  %3d"%d["target"][0],
+        "  tilt: %3d"%d["target"][1],
+        "freq [hz]:",
+        "  acc       cur avg min:     {:3d} {:3d} {:3d}".format(*acc_f_data),
+        "  gyro      cur avg min:     {:3d} {:3d} {:3d}".format(*gyro_f_data),
+        "  out   tgt cur avg min: {:3d} {:3d} {:3d} {:3d}".format(*out_f_data),
+        "time [us]:",
+        "  fus  avg max: {:5d} {:5d}".format(*fus_t_data),
+        "  rot  avg max: {:5d} {:5d}".format(*rot_t_data),
+        "  out  avg max: {:5d} {:5d}".format(*out_t_data),
+        "  tick jitter cur avg max: {:5d} {:5d} {:5d}".format(*jitter_data),
+        "  loop busy [%]: {:3d}, missed ticks: {}".format(
+            int(d["busy"]*100.0), d["missed"]),
+        "{:18s}{:>8s}{:>8s}{:>8s}{:>8s}".format(
+            "latency [us]:", "p50", "p99", "p999", "max"),
+        "\n".join(timing_lines),
+        "serial backlog [B]:",
+        "  cur max: {:5d} {:5d}".format(*d["backlog"]),
+        "camera moves:\n" + "\n".join(cam_lines),
+        "online calibration:\n" + "\n".join(cal_lines),
+        "prediction:\n" + "\n".join(pred_lines),
+        "output rate:\n" + "\n".join(rate_lines),
+        "status:\n  " + d["status"],
+        "",
+        "pan tilt:",
+        nice_format_list_of_float(d["pan_tilt"]),
+        "",
+        "fusion data:",
+        nice_format_list_of_float(d["angles"]),
+        visualize_2d(x, y, 90, 4),
+        visualize_1d(z, 90, 4)
+    ])
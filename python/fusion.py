@@ -1,5 +1,6 @@
 from math import asin, degrees, pi, radians, sin, cos, sqrt
 from helper import *
+from ringbuffer import RingBuffer
 
 default_config = {
     "acc_cal": [4968.7, 4981.1], # zero-value for acc
@@ -8,9 +9,65 @@ default_config = {
     "gyro_cal": [-12.0, 15.0, 0.1], # zero-value for gyro
     "gyro_signs": [1.0, 1.0, -1.0],
     "gyro_to_dps_factor": 2000.0 / 2**15, # full range (dps) / full range (bits)
-    "acc_fuse_f": 1.0 # Hz
+    "acc_fuse_f": 1.0, # Hz
+    "backend": "complementary", # see create_fuser
+    "madgwick_beta": 0.1, # madgwick filter gain, rad/s
+    "kalman_angle_noise": 1e-4, # see kalman.KalmanFuser, rad^2/s
+    "kalman_motion_noise": 0.03, # rad^2/s per (rad/s)^2
+    "kalman_bias_noise": 1e-8, # (rad/s)^2/s
+    "kalman_acc_noise": 0.01, # rad^2
+    "online_cal": False, # update gyro_cal while running, see calibration.py
+    "online_cal_acc": False # also update acc_cal, only if level when still
 }
 
+# same as math.radians(x) == x*deg_to_rad
+deg_to_rad = pi/180.0
+
+# most cached smoothing factors per fuser, dt only varies by a few us
+factor_cache_size = 1000
+
+"""
+    fusion backends
+
+    every backend has the interface of Fuser, used by main.py:
+        process(s), process_acc(dt, acc_raw), process_gyro(dt, gyro_raw),
+        process_batch(acc, gyro)
+        angles, the [x, y, z] rotation vector used by Rotator, may be
+            updated in place, copy it to keep it
+        rates, the latest gyro rates [x, y, z] in rad/s, see prediction.py
+        acc_f_buf, gyro_f_buf, sample frequencies for diagnostics
+"""
+
+"""
+    create fuser
+    returns a fuser of the backend given by config["backend"]:
+        "complementary": Fuser, complementary filter on euler angles
+        "madgwick": madgwick.MadgwickFuser, quaternion orientation filter
+        "kalman": kalman.KalmanFuser, kalman filter estimating gyro bias
+"""
+def create_fuser(config=default_config, buffer_size=100):
+    # own copy, online calibration changes it
+    config = dict(config)
+
+    backend = config.get("backend", "complementary")
+    if backend == "complementary":
+        f = Fuser(config, buffer_size)
+    elif backend == "madgwick":
+        import madgwick
+        f = madgwick.MadgwickFuser(config, buffer_size)
+    elif backend == "kalman":
+        import kalman
+        f = kalman.KalmanFuser(config, buffer_size)
+    else:
+        raise Exception("unknown fusion backend: %s"%backend)
+
+    if config.get("online_cal"):
+        import calibration
+        f.calibrator = calibration.OnlineCalibrator(f,
+            calibrate_acc=config.get("online_cal_acc", False))
+
+    return f
+
 class Fuser:
     def __init__(self, config=default_config, buffer_size=100):
         # save config
@@ -22,9 +79,18 @@ class Fuser:
         # final rotation vector [x, y, z]
         self.angles = [0]*3
 
+        # latest gyro rates [x, y, z], radians per second
+        self.rates = [0.0]*3
+
+        # online calibration (see calibration.py), fed with the raw samples
+        self.calibrator = None
+
+        # constants and caches used per sample
+        self.configure()
+
         # buffers for diagnostics, newest first
-        self.acc_f_buf = [0.0]*buffer_size
-        self.gyro_f_buf = [0.0]*buffer_size
+        self.acc_f_buf = RingBuffer(buffer_size)
+        self.gyro_f_buf = RingBuffer(buffer_size)
 
     """
         processes a line s sent via serial from arduino
@@ -34,95 +100,238 @@ class Fuser:
             "atxy 10000 4000 6000" (acc)
             "gtxyz 10000 150 -200 50" (gyro)
             "w skipped gyro read" (warning)
+
+        not timed here, a clock read costs as much as a filter step, the
+        caller times a whole read pass (see stabilizer.py)
     """
     def process(self, s):
-        c = self.config # just shorter
-
         ss = s.split() # ex. ss = ["atxy", "10000", "5000", "5000"]
 
         if ss[0] == "atxy" and len(ss) == 4: # acc
-            # get dt and convert from microseconds to seconds
-            dt = float(ss[1])*1e-6
-
-            # save f=dt^-1 to buffer
-            pp(1/dt, self.acc_f_buf)
-
-            # low pass filter smoothing factor
-            sf_lp = lp_smoothing_factor(c["acc_fc"], dt)
+            self.process_acc(float(ss[1]), [float(ss[2]), float(ss[3])])
+        elif ss[0] == "gtxyz" and len(ss) == 5: # gyro
+            self.process_gyro(float(ss[1]),
+                [float(ss[2]), float(ss[3]), float(ss[4])])
+        elif ss[0] == "w": # warning
+            raise Exception(" ".join(ss[1:]))
+        else:
+            raise Exception("invalid data")
 
-            # read raw data
-            acc_raw = [float(s) for s in ss[2:4]]
+    """
+        binds the config to the constants used by process_acc and
+        process_gyro, call again after changing config
+    """
+    def configure(self):
+        c = self.config # just shorter
 
-            # get data in g, ((raw data)-(zero value))/(1g value)
-            # then clamp to max 1g
-            acc = [uclamp((a-cal)/g) for a, cal, g \
-                in zip(acc_raw, c["acc_cal"], c["acc_g"])]
+        self.acc_consts = tuple(c["acc_cal"]) + tuple(c["acc_g"])
+        self.gyro_consts = tuple(c["gyro_cal"]) + tuple(c["gyro_signs"]) \
+            + (c["gyro_to_dps_factor"],)
 
-            # low pass filter data
-            self.filt_acc = [sf_lp*a + (1.0-sf_lp)*fa for fa, a in \
-                zip(self.filt_acc, acc)]
+        # per sample factors, keyed by dt in microseconds, see acc_factors
+        self.acc_cache = {}
+        self.gyro_cache = {}
 
-            # take corresponding angle from data
-            # assuming total acceleration is 1g, z = sqrt(1-(other axis)^2)
-            filt_acc_angle = [
-                asin(a/max(1.0, sqrt(1-oa**2))) for a, oa \
-                in zip(self.filt_acc, self.filt_acc[::-1])]
+    """
+        returns (f, sf_lp, 1 - sf_lp, sf_f, 1 - sf_f) for an acc sample dt
+        microseconds after the last one: the sample frequency, low pass
+        filter and fusion smoothing factors
+        dt is a whole number of microseconds and nearly constant, so these
+        are cached
+    """
+    def acc_factors(self, dt):
+        if len(self.acc_cache) >= factor_cache_size:
+            self.acc_cache.clear()
 
-            # angles to fuse into final angle data
-            acc_fusion_angle = [
-                filt_acc_angle[1],
-                -filt_acc_angle[0],
-                self.angles[2]
-            ]
+        # convert dt from microseconds to seconds
+        dt_s = dt*1e-6
 
-            # fusion factor
-            sf_f = lp_smoothing_factor(c["acc_fuse_f"], dt) # typically very small
+        sf_lp = lp_smoothing_factor(self.config["acc_fc"], dt_s)
+        sf_f = lp_smoothing_factor(self.config["acc_fuse_f"], dt_s)
+        k = (1/dt_s, sf_lp, 1.0 - sf_lp, sf_f, 1.0 - sf_f)
+        self.acc_cache[dt] = k
+        return k
 
-            # fuse into final angle data (angles)
-            self.angles = [sf_f*afa + (1.0-sf_f)*ang for ang, afa \
-                in zip(self.angles, acc_fusion_angle)]
+    """
+        returns (f, dt in seconds) for a gyro sample dt microseconds after
+        the last one, see acc_factors
+    """
+    def gyro_factors(self, dt):
+        if len(self.gyro_cache) >= factor_cache_size:
+            self.gyro_cache.clear()
+        dt_s = dt*1e-6
+        k = (1/dt_s, dt_s)
+        self.gyro_cache[dt] = k
+        return k
 
-        elif ss[0] == "gtxyz" and len(ss) == 5: # gyro
-            # get dt and convert from microseconds to seconds
-            dt = float(ss[1])*1e-6
+    """
+        processes an acc sample
+        dt: time since last acc sample in microseconds
+        acc_raw: raw [x, y] values
 
-            # save f=dt^-1 to buffer
-            pp(1/dt, self.gyro_f_buf)
+        filt_acc and angles are updated in place
+    """
+    def process_acc(self, dt, acc_raw):
+        if self.calibrator:
+            self.calibrator.add_acc(dt, acc_raw)
+
+        f, sf_lp, sf_lp1, sf_f, sf_f1 = \
+            self.acc_cache.get(dt) or self.acc_factors(dt)
+
+        # save f=dt^-1 to buffer
+        self.acc_f_buf.push(f)
+
+        # get data in g, ((raw data)-(zero value))/(1g value)
+        # then clamp to max 1g
+        cal_x, cal_y, g_x, g_y = self.acc_consts
+        x = (acc_raw[0] - cal_x)/g_x
+        y = (acc_raw[1] - cal_y)/g_y
+        x = -1 if x < -1 else 1 if x > 1 else x
+        y = -1 if y < -1 else 1 if y > 1 else y
+
+        # low pass filter data
+        fa = self.filt_acc
+        x = sf_lp*x + sf_lp1*fa[0]
+        y = sf_lp*y + sf_lp1*fa[1]
+        fa[0] = x
+        fa[1] = y
+
+        # take corresponding angle from data
+        # the angle is asin(a/max(1.0, sqrt(1-(other axis)^2))), where the
+        # divisor is always 1.0 as the filtered data is within 1g
+        angle_x = asin(x)
+        angle_y = asin(y)
+
+        # fuse into final angle data (angles), z is not given by acc
+        ang = self.angles
+        ang[0] = sf_f*angle_y + sf_f1*ang[0]
+        ang[1] = sf_f*-angle_x + sf_f1*ang[1]
+        ang[2] = sf_f*ang[2] + sf_f1*ang[2]
 
-            # read raw data
-            gyro_raw = [float(s) for s in ss[2:5]]
+    """
+        processes a gyro sample
+        dt: time since last gyro sample in microseconds
+        gyro_raw: raw [x, y, z] values
 
-            # apply calibration
-            gyro_raw = [x - cal for x, cal in \
-                zip(gyro_raw, c["gyro_cal"])]
+        angles is updated in place
+    """
+    def process_gyro(self, dt, gyro_raw):
+        if self.calibrator:
+            self.calibrator.add_gyro(dt, gyro_raw)
+
+        f, dt = self.gyro_cache.get(dt) or self.gyro_factors(dt)
+
+        # save f=dt^-1 to buffer
+        self.gyro_f_buf.push(f)
+
+        # apply calibration, flip signs to correct raw data, convert to
+        # degrees per second and then to radians per second
+        cal_x, cal_y, cal_z, s_x, s_y, s_z, dps = self.gyro_consts
+        rx = (gyro_raw[0] - cal_x)*s_x*dps*deg_to_rad
+        ry = (gyro_raw[1] - cal_y)*s_y*dps*deg_to_rad
+        rz = (gyro_raw[2] - cal_z)*s_z*dps*deg_to_rad
+        self.rates = [rx, ry, rz]
+
+        # get difference from last angle (da)
+        dx = rx*dt
+        dy = ry*dt
+        dz = rz*dt
+
+        # rotate angles
+        # https://en.wikipedia.org/wiki/Rotation_matrix
+        ang = self.angles
+        x, y = ang[0], ang[1]
+        c, s = cos(dz), sin(dz)
+
+        # integrate
+        ang[0] = (x*c - y*s) + dx
+        ang[1] = (x*s + y*c) + dy
+        ang[2] = ang[2] + dz
 
-            # flip signs to correct raw data
-            gyro_raw = [g*s for g, s in zip(gyro_raw, c["gyro_signs"])]
+    """
+        processes a batch of already parsed samples
 
-            # convert to degrees per second
-            gyro_dps = [x*c["gyro_to_dps_factor"] for x in gyro_raw]
+        acc:  array with rows [t, dt, x, y], same values as in "atxy" lines
+        gyro: array with rows [t, dt, x, y, z], same values as in "gtxyz" lines
 
-            # convert to radians per second
-            gyro_rps = [radians(x) for x in gyro_dps]
+        t is any increasing timestamp (e.g. host receive time) and is only used
+        to interleave acc and gyro samples, acc goes first on equal t
 
-            # get difference from last angle (da)
-            gyro_da = [x*dt for x in gyro_rps]
+        runs the same filter as calling process() once per sample, but each
+        step is done for the whole batch at once with numpy
+        the state (angles, filt_acc, rates) is left as after the last sample
+        the samples are not given to the online calibration
 
-            # rotate angles
-            # https://en.wikipedia.org/wiki/Rotation_matrix
-            old_angles = [x for x in self.angles] # copy
-            self.angles[0] = +old_angles[0]*cos(gyro_da[2]) \
-                                -old_angles[1]*sin(gyro_da[2])
-            self.angles[1] = +old_angles[0]*sin(gyro_da[2]) \
-                                +old_angles[1]*cos(gyro_da[2])
+        returns (t, angles), the sorted timestamps and an array where row i is
+        the [x, y, z] rotation vector after sample i
+    """
+    def process_batch(self, acc, gyro):
+        import numpy as np # not needed online, so a rig starts faster without
 
-            # integrate
-            self.angles = [ang + da for ang, da in zip(self.angles, gyro_da)]
+        c = self.config # just shorter
 
-        elif ss[0] == "w": # warning
-            raise Exception(" ".join(ss[1:]))
-        else:
-            raise Exception("invalid data")
+        acc, gyro, t, order = interleave(acc, gyro)
+        if not len(t):
+            return t, np.zeros((0, 3))
+        n_acc = len(acc)
+        is_acc = order < n_acc
+
+        ## acc, same steps as in process()
+        acc_dt = acc[:, 1]*1e-6
+        sf_lp = lp_smoothing_factor(c["acc_fc"], acc_dt)
+        acc_g = np.clip((acc[:, 2:4] - c["acc_cal"])/c["acc_g"], -1.0, 1.0)
+
+        # the low pass filter is a linear recurrence, solve it as a scan
+        filt_acc = affine_scan(
+            (1.0 - sf_lp)[:, None], sf_lp[:, None]*acc_g, self.filt_acc)
+
+        filt_acc_angle = np.arcsin(filt_acc/np.maximum(1.0,
+            np.sqrt(1.0 - filt_acc[:, ::-1]**2)))
+
+        sf_f = lp_smoothing_factor(c["acc_fuse_f"], acc_dt)
+
+        ## gyro, same steps as in process()
+        gyro_dt = gyro[:, 1]*1e-6
+        gyro_raw = (gyro[:, 2:5] - c["gyro_cal"])*c["gyro_signs"]
+        gyro_rps = np.radians(gyro_raw*c["gyro_to_dps_factor"])
+        gyro_da = gyro_rps*gyro_dt[:, None]
+
+        ## fuse
+        # seen as a complex number x + iy, both steps are linear:
+        #   acc:  xy = (1 - sf_f)*xy + sf_f*(acc angles)
+        #   gyro: xy = exp(i*da_z)*xy + (da_x + i*da_y) (rotate and integrate)
+        # while z is only changed by the gyro
+        m = np.empty(len(t), dtype=complex)
+        b = np.empty(len(t), dtype=complex)
+        acc_xy = filt_acc_angle[:, 1] - 1j*filt_acc_angle[:, 0]
+        m[is_acc] = (1.0 - sf_f)[order[is_acc]]
+        b[is_acc] = (sf_f*acc_xy)[order[is_acc]]
+        gi = order[~is_acc] - n_acc
+        m[~is_acc] = np.exp(1j*gyro_da[gi, 2])
+        b[~is_acc] = gyro_da[gi, 0] + 1j*gyro_da[gi, 1]
+
+        xy = affine_scan(m, b, self.angles[0] + 1j*self.angles[1])
+        da_z = np.zeros(len(t))
+        da_z[~is_acc] = gyro_da[gi, 2]
+
+        angles = np.empty((len(t), 3))
+        angles[:, 0] = xy.real
+        angles[:, 1] = xy.imag
+        angles[:, 2] = self.angles[2] + np.cumsum(da_z)
+
+        # save state
+        self.angles = angles[-1].tolist()
+        if n_acc:
+            self.filt_acc = filt_acc[-1].tolist()
+        if len(gi):
+            self.rates = gyro_rps[gi[-1]].tolist()
+
+        # save the newest frequencies to the buffers
+        for dt, buf in [(acc_dt, self.acc_f_buf), (gyro_dt, self.gyro_f_buf)]:
+            for x in (1.0/dt[-len(buf):]).tolist():
+                buf.push(x)
+
+        return t, angles
 
 """
     low pass filter smoothing factor
@@ -133,6 +342,68 @@ class Fuser:
 def lp_smoothing_factor(fc, dt):
     return 1.0/(1.0 + 1.0/(2.0*pi*fc*dt))
 
+"""
+    interleave
+    orders the acc and gyro samples given to process_batch by timestamp,
+    a stable sort keeps acc first on ties
+    returns (acc, gyro, t, order), acc and gyro as float arrays, the sorted
+    timestamps t and order, where order[i] < len(acc) means that sample i is
+    acc[order[i]] and otherwise gyro[order[i] - len(acc)]
+"""
+def interleave(acc, gyro):
+    import numpy as np
+
+    acc = np.asarray(acc, dtype=float).reshape(-1, 4)
+    gyro = np.asarray(gyro, dtype=float).reshape(-1, 5)
+    t = np.concatenate([acc[:, 0], gyro[:, 0]])
+    order = np.argsort(t, kind="mergesort")
+    return acc, gyro, t[order], order
+
+"""
+    affine scan
+    solves the recurrence x[n] = m[n]*x[n-1] + b[n] for all n at once,
+    starting from x[-1] = x0
+    uses a parallel prefix scan, log2(len(m)) passes over the arrays
+"""
+def affine_scan(m, b, x0):
+    import numpy as np
+
+    m = np.array(m)
+    b = np.array(b)
+    k = 1
+    while k < len(m):
+        # combine each step with the one k steps back
+        b[k:] = m[k:]*b[:-k] + b[k:]
+        m[k:] = m[k:]*m[:-k]
+        k *= 2
+    return m*x0 + b
+
+"""
+    process each
+    processes a batch of samples (see Fuser.process_batch) one by one with
+    the fuser f, for filters that are not linear
+    returns (t, angles) like Fuser.process_batch
+"""
+def process_each(f, acc, gyro):
+    import numpy as np
+
+    acc, gyro, t, order = interleave(acc, gyro)
+    n_acc = len(acc)
+    acc_l = acc.tolist()
+    gyro_l = gyro.tolist()
+
+    angles = []
+    for i in order.tolist():
+        if i < n_acc:
+            r = acc_l[i]
+            f.process_acc(r[1], r[2:4])
+        else:
+            r = gyro_l[i - n_acc]
+            f.process_gyro(r[1], r[2:5])
+        angles.append(list(f.angles)) # may be updated in place
+
+    return t, np.array(angles).reshape(-1, 3)
+
 """
     dummy main
     quick test without needing to run the main file
@@ -1,68 +1,392 @@
 from serial import Serial
-from math import degrees, sin,radians
+from math import log, radians
+import json
 import sys
 
 from helper import *
+import calibration
+import fusion
+import linereader
+
+"""
+    calibration and noise characterization of the sensors
+
+    reads the sensors of a rig standing still, saves their means as the
+    zero values (see calibration.py) and prints how noisy they are:
+        variance per axis
+        overlapping allan deviation over cluster times tau
+        angle random walk (gyro) or white noise density (acc), on the
+            -1/2 slope of the allan deviation
+        bias instability, the floor of the allan deviation
+        suggested noise constants of kalman.KalmanFuser
+    the samples are taken in chunks of numpy arrays, memory stays bounded by
+    the chunk and the longest tau however long the capture is
+
+    usage: python gyro_calibration.py [--port PORT] [--samples N]
+            [--recording FILE] [--max-tau S] [--name NAME]
+            [--calibration FILE] [--out FILE]
+        --port PORT is the serial port, otherwise picked from those found
+        --samples N reads N samples of each sensor (default 100), minutes
+            of samples are needed for the noise values to mean anything
+        --recording FILE reads a recording (see recording.py) instead of
+            serial, all of it if --samples is not given
+        --max-tau S is the longest cluster time in seconds (default 1000)
+        --name NAME is the rig, the zero values are saved to its calibration
+            file (see calibration.default_path) unless --calibration is given
+        --out FILE writes the noise values and allan deviations as json
+"""
+
+# samples per chunk given to the analysis
+chunk_size = 100000
+
+# allan deviation cluster sizes per decade
+taus_per_decade = 10
+
+# clusters of the longest tau at least, fewer make too rough an estimate
+min_clusters = 10
+
+class AllanDeviation:
+    """
+        overlapping allan deviation per axis of a stream of samples, for the
+        cluster sizes ms (in samples)
+
+        the samples are summed up (S), the allan variance of cluster size m
+        is the mean over all k of
+            (S[k + 2m] - 2*S[k + m] + S[k])^2/(2*m^2)
+        in the units of the samples squared, only the last 2*max(ms) sums
+        are kept for the next chunk
+    """
+    def __init__(self, axes, ms):
+        import numpy as np
+
+        self.ms = ms
+        self.history = np.zeros((1, axes)) # S[0]
+        self.offset = None # taken off the samples, keeps the sums small
+        self.sq = np.zeros((len(ms), axes))
+        self.counts = np.zeros(len(ms))
+        self.n = 0
+
+    """
+        adds the samples a, an array with a row per sample
+    """
+    def add(self, a):
+        import numpy as np
+
+        if not len(a):
+            return
+        if self.offset is None:
+            self.offset = a.mean(axis=0)
+        h = np.vstack([self.history,
+            self.history[-1] + np.cumsum(a - self.offset, axis=0)])
+        new = len(h) - len(a) # index of the first new sum
+        for i, m in enumerate(self.ms):
+            # the differences ending on the new sums
+            start = max(new, 2*m)
+            if start >= len(h):
+                continue
+            d = h[start:] - 2.0*h[start - m:len(h) - m] \
+                + h[start - 2*m:len(h) - 2*m]
+            self.sq[i] += (d*d).sum(axis=0)
+            self.counts[i] += len(d)
+        self.history = h[-2*max(self.ms):]
+        self.n += len(a)
+
+    """
+        returns (ms, deviations), the cluster sizes with at least
+        min_clusters clusters and an array with the allan deviation per axis
+        of each
+    """
+    def deviation(self):
+        import numpy as np
+
+        ms = np.array(self.ms, dtype=float)
+        ok = (self.counts > 0) & (self.n >= min_clusters*ms)
+        avar = self.sq[ok]/(2.0*ms[ok, None]**2*self.counts[ok, None])
+        return ms[ok], np.sqrt(avar)
+
+class NoiseAnalysis:
+    """
+        noise of one sensor with axes axes, scale converts the raw values to
+        the units reported (deg/s, g)
+        max_tau: longest cluster time of the allan deviation, seconds
+    """
+    def __init__(self, name, axes, scale, max_tau=1000.0):
+        self.name = name
+        self.scale = scale
+        self.max_tau = max_tau
+        self.stats = calibration.RunningStats(axes)
+        self.allan = None # created once the sample rate is known
+        self.dt_sum = 0.0 # seconds
+
+    """
+        adds the raw samples v (a row per sample) with sample intervals dt
+        (microseconds, as sent by the arduino)
+    """
+    def add(self, v, dt):
+        import numpy as np
+
+        if not len(v):
+            return
+        self.stats.add_many(v)
+        self.dt_sum += dt.sum()*1e-6
+        if self.allan is None:
+            m_max = max(1, int(self.max_tau/(dt.mean()*1e-6)))
+            decades = log(m_max)/log(10.0)
+            ms = np.unique(np.logspace(0.0, decades,
+                int(decades*taus_per_decade) + 1).astype(int))
+            self.allan = AllanDeviation(len(self.stats.mean), ms.tolist())
+        self.allan.add(v)
+
+    """
+        average sample interval in seconds
+    """
+    def dt(self):
+        return self.dt_sum/self.stats.n if self.stats.n else 0.0
+
+    """
+        returns the results as a dict of plain values, in the scaled units:
+            mean per axis, raw (the zero values), std per axis
+            taus (seconds), allan deviation per tau and axis
+            white: white noise density per axis, units*sqrt(s), the angle
+                random walk of a gyro
+            bias_instability per axis, and the tau it was found at
+    """
+    def result(self):
+        import numpy as np
+
+        s = self.stats
+        scale = np.array(self.scale, dtype=float)
+        d = {
+            "name": self.name,
+            "samples": s.n,
+            "dt": self.dt(),
+            "mean": list(s.mean),
+            "std": (np.sqrt(s.variance())*np.abs(scale)).tolist(),
+            "taus": [],
+            "adev": [],
+            "white": None,
+            "bias_instability": None,
+            "bias_tau": None
+        }
+        if self.allan is None:
+            return d
+        ms, adev = self.allan.deviation()
+        if not len(ms):
+            return d
+        taus = ms*self.dt()
+        adev = adev*np.abs(scale)
+        d["taus"] = taus.tolist()
+        d["adev"] = adev.tolist()
+
+        # white noise, sigma = N/sqrt(tau), where the slope is about -1/2,
+        # else from the shortest tau, where it dominates
+        white = []
+        for a in adev.T:
+            n = a*np.sqrt(taus)
+            if len(taus) > 1:
+                slope = np.diff(np.log(a))/np.diff(np.log(taus))
+                on = np.abs(slope + 0.5) < 0.1
+                if on.any():
+                    white.append(float(np.median(n[:-1][on])))
+                    continue
+            white.append(float(n[0]))
+        d["white"] = white
+
+        # bias instability, the floor of the flicker noise is 0.664*B
+        i = adev.argmin(axis=0)
+        d["bias_instability"] = (adev[i, range(adev.shape[1])]/0.664).tolist()
+        d["bias_tau"] = taus[i].tolist()
+        return d
+
+"""
+    suggest
+    returns noise constants of kalman.KalmanFuser (see fusion.default_config)
+    from the results of gyro (deg/s) and acc (g), config gives acc_fc
+"""
+def suggest(gyro, acc, config):
+    s = {}
+    if gyro["white"]:
+        # angle random walk, rad/sqrt(s), squared is rad^2/s
+        s["kalman_angle_noise"] = max(radians(x) for x in gyro["white"][:2])**2
+        # bias changing by the instability over its tau, (rad/s)^2/s
+        s["kalman_bias_noise"] = max(radians(b)**2/t for b, t in
+            zip(gyro["bias_instability"], gyro["bias_tau"]))
+    if acc["samples"] > 1 and acc["dt"] > 0.0:
+        # tilt variance (rad^2 for small angles) after the low pass filter,
+        # white noise through it keeps sf/(2 - sf) of its variance
+        sf = fusion.lp_smoothing_factor(config["acc_fc"], acc["dt"])
+        s["kalman_acc_noise"] = max(x**2 for x in acc["std"])*sf/(2.0 - sf)
+    return s
+
+"""
+    print result
+    prints the result r of a NoiseAnalysis with unit name unit
+"""
+def print_result(r, unit):
+    axes = "xyz"[:len(r["mean"])]
+    print("\n%s: %d samples, %.1f Hz"%(r["name"], r["samples"],
+        1.0/r["dt"] if r["dt"] else 0.0))
+    print("  %-28s %s"%("", " ".join("%12s"%a for a in axes)))
+    rows = [("mean [raw]", r["mean"]), ("std [%s]"%unit, r["std"])]
+    if r["white"]:
+        rows += [("white noise [%s*sqrt(s)]"%unit, r["white"]),
+            ("bias instability [%s]"%unit, r["bias_instability"]),
+            ("  at tau [s]", r["bias_tau"])]
+    for name, values in rows:
+        print("  %-28s %s"%(name, " ".join("%12.4g"%x for x in values)))
+    if r["taus"]:
+        print("  allan deviation [%s]:"%unit)
+        for tau, adev in zip(r["taus"], r["adev"]):
+            print("  %13.4g s %s"%(tau, " ".join("%12.4g"%x for x in adev)))
+
+"""
+    read serial
+    yields (kind, v, dt) chunks from port until n samples of both acc and
+    gyro were read, kind "acc" or "gyro", v and dt numpy arrays
+"""
+def read_serial(port, n):
+    import numpy as np
+
+    ser = Serial(port, 115200, timeout=0)
+    ser.write(b"A") # in case it was left in binary mode
+    reader = linereader.LineReader(ser)
+    counts = {"acc": 0, "gyro": 0}
+    pending = {"acc": [], "gyro": []}
+    while counts["acc"] < n or counts["gyro"] < n:
+        for s in reader.read_lines():
+            ss = s.split()
+            try:
+                if ss[0] == "atxy" and len(ss) == 4:
+                    kind = "acc"
+                elif ss[0] == "gtxyz" and len(ss) == 5:
+                    kind = "gyro"
+                else:
+                    continue
+                row = [float(x) for x in ss[1:]]
+            except (IndexError, ValueError):
+                continue
+            if counts[kind] < n:
+                pending[kind].append(row)
+                counts[kind] += 1
+        for kind, rows in pending.items():
+            if len(rows) >= chunk_size or (rows and counts[kind] >= n):
+                a = np.array(rows)
+                del rows[:]
+                yield kind, a[:, 1:], a[:, 0]
+    ser.close()
+
+"""
+    read recording
+    yields (kind, v, dt) chunks like read_serial from the recording at path,
+    at most n samples of each sensor if n is given
+    the file is read a chunk at a time rather than memory mapped like
+    recording.Replay, so a long capture does not fill the memory
+"""
+def read_recording(path, n=None):
+    import numpy as np
+    import recording
+
+    f = open(path, "rb")
+    if f.read(len(recording.MAGIC)) != recording.MAGIC:
+        raise Exception("not a recording: %s"%path)
+    counts = {"acc": 0, "gyro": 0}
+    while True:
+        r = np.fromfile(f, dtype=recording.RECORD, count=chunk_size)
+        if not len(r):
+            break
+        for kind, code, axes in [("acc", recording.ACC, 2),
+                ("gyro", recording.GYRO, 3)]:
+            s = r[r["kind"] == code]
+            if n is not None:
+                s = s[:max(0, n - counts[kind])]
+            counts[kind] += len(s)
+            yield kind, s["v"][:, :axes].astype(float), s["dt"].astype(float)
+        if n is not None and min(counts.values()) >= n:
+            break
+    f.close()
 
 def main():
     ### setup
     clear_console()
     print(ascii_art)
 
-    ## prompts user for serial port
-    ports = serial_ports()
-    print("\nSerial setup:")
-    if ports:
-        if len(ports) > 1:
-            print("  Available serial ports:")
-            print("\n".join(["    %s: %s"%(i+1, v) for i, v in enumerate(ports)]))
-            inp = raw_input("  Pick a serial port: [1 - %s] "%len(ports))
-            try:
-                index = int(inp) - 1
-                if not in_interval(index, [0, len(ports-1)]):
-                    raise Exception()
-                port = ports[index]
-            except Exception as e:
-                exit("Invalid input, exiting...")
-        else:
-            port = ports[0]
+    # arg --calibration FILE is where the zero values are saved, the file
+    # main.py loads at startup for the rig --name
+    calibration_path = arg_value("--calibration") or \
+        calibration.default_path(arg_value("--name") or "rig")
+    config = calibration.load_calibration(calibration_path,
+        fusion.default_config)
+
+    n = arg_value("--samples")
+    n = int(n) if n else None
+    max_tau = float(arg_value("--max-tau") or 1000.0)
+
+    if arg_value("--recording"):
+        print("\nReading %s..."%arg_value("--recording"))
+        chunks = read_recording(arg_value("--recording"), n)
     else:
-        exit("  No serial port found, exiting...")
-    print("  Serial port: %s"%port)
+        ## prompts user for serial port
+        ports = [arg_value("--port")] if arg_value("--port") else find_ports()
+        print("\nSerial setup:")
+        if ports:
+            if len(ports) > 1:
+                print("  Available serial ports:")
+                print("\n".join(["    %s: %s"%(i+1, v)
+                    for i, v in enumerate(ports)]))
+                inp = raw_input("  Pick a serial port: [1 - %s] "%len(ports))
+                try:
+                    index = int(inp) - 1
+                    if not in_interval(index, [0, len(ports) - 1]):
+                        raise Exception()
+                    port = ports[index]
+                except Exception as e:
+                    exit("Invalid input, exiting...")
+            else:
+                port = ports[0]
+        else:
+            exit("  No serial port found, exiting...")
+        print("  Serial port: %s"%port)
+        print("\nReading...")
+        chunks = read_serial(port, n or 100)
 
-    ser = Serial(port, 115200, timeout=0)
+    # raw to deg/s and g
+    dps = config["gyro_to_dps_factor"]
+    analyses = {
+        "gyro": NoiseAnalysis("gyro", 3,
+            [dps*s for s in config["gyro_signs"]], max_tau),
+        "acc": NoiseAnalysis("acc", 2,
+            [1.0/g for g in config["acc_g"]], max_tau)
+    }
+    for kind, v, dt in chunks:
+        analyses[kind].add(v, dt)
 
-    acc_reads = []
-    gyro_reads = []
-    n = 100
+    gyro_stats = analyses["gyro"].stats
+    acc_stats = analyses["acc"].stats
+    if not gyro_stats.n or not acc_stats.n:
+        exit("No samples read, exiting...")
 
-    ser_buffer = ""
+    gyro = analyses["gyro"].result()
+    acc = analyses["acc"].result()
+    print_result(gyro, "deg/s")
+    print_result(acc, "g")
+    suggested = suggest(gyro, acc, config)
+    if suggested:
+        print("\nsuggested noise constants (see kalman.KalmanFuser):")
+        for key, value in sorted(suggested.items()):
+            print("  %-20s %.3g"%(key, value))
 
-    print("\nReading...")
+    if arg_value("--out"):
+        with open(arg_value("--out"), "w") as f:
+            json.dump({"gyro": gyro, "acc": acc, "suggested": suggested}, f,
+                indent=2, sort_keys=True)
 
-    while len(gyro_reads) < n or len(acc_reads) < n:
-        if ser.in_waiting:
-            ser_buffer += ser.read(size=24)
-            if "\n" in ser_buffer:
-                i = ser_buffer.index("\n")
-                s = ser_buffer[:i-1]
-                ser_buffer = ser_buffer[i+1:]
-                try:
-                    ss = s.split()
-                    if ss[0] == "atxy" and len(ss) == 4:
-                        acc_raw = [float(s) for s in ss[2:4]]
-                        acc_reads.append(acc_raw)
-                    elif ss[0] == "gtxyz" and len(ss) == 5:
-                        gyro_raw = [float(s) for s in ss[2:5]]
-                        gyro_reads.append(gyro_raw)
-                except Exception as e:
-                    pass
-                continue
+    print("\nzero values:")
+    print(["%.1f"%x for x in acc_stats.mean])
+    print(["%.1f"%x for x in gyro_stats.mean])
 
-    acc = ["%.1f"%avg([read[i] for read in acc_reads]) for i in range(2)]
-    print(acc)
-    gyro = ["%.1f"%avg([read[i] for read in gyro_reads]) for i in range(3)]
-    print(gyro)
+    config = dict(config, acc_cal=acc_stats.mean, gyro_cal=gyro_stats.mean)
+    calibration.save_calibration(calibration_path, config)
+    print("Saved to %s"%calibration_path)
 
 
 if __name__ == "__main__":
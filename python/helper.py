@@ -1,8 +1,9 @@
 import time
+import json
 import os
+import sys
 import platform
 from glob import glob
-from serial import Serial, SerialException
 
 """
     the super fancy ascii art for the project
@@ -60,6 +61,16 @@ def yes(s):
 def in_interval(x, i):
     return i[0] <= x <= i[1]
 
+"""
+    argument value
+    returns the command line argument following name, or None if name is not
+    given
+"""
+def arg_value(name):
+    if name in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(name) + 1]
+    return None
+
 """
     round to int
     returns x rounded to nearest int
@@ -75,48 +86,93 @@ def clear_console():
     for _ in range(100): print("") # the stupid but fast way
     # os.system("cls" if os.name == "nt" else "clear")
 
+# usb vendor ids of arduino boards (arduino.cc, arduino.org)
+arduino_vids = ["2341", "2A03"]
+
 """
-    serial ports
-    returns all serial ports available
+    find ports
+    returns the serial ports of arduino boards, without opening any port
+    (opening resets the board, which then needs a second or two to boot):
+        - on linux /dev/serial/by-id, the names stay the same when the board
+          is plugged into another usb port
+        - otherwise the ports listed by pyserial with an arduino vendor id
 """
-def serial_ports():
-    if platform.system() == "Windows":
-        possible_ports = ["COM%s"%(i+1) for i in range(256)]
-    elif platform.system() == "Linux":
-        possible_ports = glob('/dev/ttyAC*')
-    else:
-        raise EnvironmentError("unsupported os")
+def find_ports():
+    if platform.system() == "Linux":
+        ports = sorted(glob("/dev/serial/by-id/*"))
+        arduinos = [p for p in ports if "arduino" in p.lower()]
+        if arduinos or ports:
+            return arduinos or ports
 
+    from serial.tools.list_ports import comports
     ports = []
-    for port in possible_ports:
-        try:
-            ser = Serial(port)
-            ser.close()
+    for port, desc, hwid in sorted(comports()):
+        hwid = hwid.upper()
+        if any("VID:PID=%s:"%v in hwid for v in arduino_vids) or \
+                "arduino" in desc.lower():
             ports.append(port)
-        except(OSError, SerialException):
-            pass
     return ports
 
+"""
+    find port
+    returns the serial port of the sensor board of rig name, or None
+    the port found last time is kept in the json file cache_path, it is used
+    right away if it still exists, otherwise find_ports picks the first one
+    and it is cached for the next start
+"""
+def find_port(name="rig", cache_path="ports.json"):
+    cache = {}
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        pass # no cache yet
+
+    port = cache.get(name)
+    if port and os.path.exists(port):
+        return port
+
+    ports = find_ports()
+    if not ports:
+        return None
+    cache[name] = ports[0]
+    try:
+        with open(cache_path, "w") as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+    except IOError:
+        pass # only slower next time
+    return ports[0]
+
 """
     now (time)
     returns the current time
 """
-def now():
-    if platform.system() == "Windows":
-        return time.clock()
-    elif platform.system() == "Linux":
-        return time.time()
-    else:
+# picked once, now() is called several times per sample
+# time.clock is gone since python 3.8, perf_counter is there since 3.3,
+# or so time.clock is only looked up where there is no perf_counter
+if platform.system() == "Windows":
+    now = getattr(time, "perf_counter", None) or time.clock
+elif platform.system() == "Linux":
+    now = time.time
+else:
+    def now():
         raise EnvironmentError("unsupported os")
 
 # below follows some special functions for printing diagnostic data
 
 """
     current, average, minimum
-    returns [current, average, minimum] of a buffer list l
+    returns [current, average, minimum] of a RingBuffer b
+"""
+def cur_avg_min(b):
+    return [b.latest(), b.mean(), b.min()]
+
+"""
+    current, average, maximum
+    returns [current, average, maximum] of a RingBuffer b
 """
-def cur_avg_min(l):
-    return [l[0], avg(l), min(l)]
+def cur_avg_max(b):
+    return [b.latest(), b.mean(), b.max()]
 
 """
     nice format list of floats
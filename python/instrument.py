@@ -0,0 +1,208 @@
+from bisect import bisect_right
+from math import ceil, exp, log
+import json
+import os
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError: # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from helper import now
+
+"""
+    timing instrumentation
+
+    every named span has a Histogram of its durations, kept in a registry
+    for the whole process, for example:
+        h = instrument.histogram("serial.read") # once, at init
+        t = now()
+        ...
+        h.add(now() - t)
+    or, where a dict lookup per call does not matter:
+        with instrument.Span("dashboard.render"):
+            ...
+
+    snapshot() returns count, mean, max and p50/p99/p999 of every span, it
+    can be written to a json file (FileExporter) or served over http
+    (serve)
+"""
+
+class Histogram:
+    """
+        histogram of durations in seconds with logarithmic buckets, uses the
+        same memory however many values are added
+
+        values between lowest and highest are kept with a relative error of
+        at most 10^(1/buckets_per_decade), about 12% for 20, values outside
+        end up in the first or last bucket
+    """
+    def __init__(self, lowest=1e-7, highest=100.0, buckets_per_decade=20):
+        self.lowest = lowest
+        self.scale = buckets_per_decade/log(10.0)
+        self.counts = [0]*(int(ceil(log(highest/lowest)*self.scale)) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+        # lower bounds of the buckets after the first, a binary search is
+        # cheaper than a log per value
+        self.bounds = [lowest*exp(i/self.scale)
+            for i in range(1, len(self.counts))]
+
+    def add(self, x):
+        self.counts[bisect_right(self.bounds, x)] += 1
+        self.count += 1
+        self.total += x
+        if x > self.max:
+            self.max = x
+
+    """
+        returns the value at percentile p (0 - 100), the geometric middle of
+        the bucket it falls in
+    """
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        rank = max(1.0, p/100.0*self.count)
+        c = 0
+        for i, n in enumerate(self.counts):
+            c += n
+            if c >= rank:
+                return min(self.lowest*exp((i + 0.5)/self.scale), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total/self.count if self.count else 0.0
+
+    def reset(self):
+        self.counts = [0]*len(self.counts)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.mean(),
+            "max": self.max,
+            "p50": self.percentile(50.0),
+            "p99": self.percentile(99.0),
+            "p999": self.percentile(99.9)
+        }
+
+# span name: Histogram
+registry = {}
+registry_lock = threading.Lock()
+
+"""
+    histogram
+    returns the histogram of the span name, created on first use
+"""
+def histogram(name):
+    h = registry.get(name)
+    if h is None:
+        with registry_lock:
+            h = registry.setdefault(name, Histogram())
+    return h
+
+class Span:
+    """
+        times the with block into the histogram of name
+    """
+    def __init__(self, name):
+        self.h = histogram(name)
+
+    def __enter__(self):
+        self.t = now()
+        return self
+
+    def __exit__(self, *exc):
+        self.h.add(now() - self.t)
+
+"""
+    snapshot
+    returns {span name: Histogram.snapshot()} of all spans, in seconds
+"""
+def snapshot():
+    with registry_lock:
+        items = list(registry.items())
+    return dict((name, h.snapshot()) for name, h in items)
+
+"""
+    resets all histograms, for example to only see the tail of the last
+    minute
+"""
+def reset():
+    with registry_lock:
+        for h in registry.values():
+            h.reset()
+
+"""
+    write json
+    writes snapshot() to path, replaced in one step so a reader never sees
+    a half written file
+"""
+def write_json(path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"time": now(), "spans": snapshot()}, f, indent=2,
+            sort_keys=True)
+    if os.name == "nt" and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+class FileExporter(threading.Thread):
+    """
+        writes the snapshot to path every interval seconds, from a
+        background thread
+    """
+    def __init__(self, path, interval=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            write_json(self.path)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        write_json(self.path)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+        answers GET /metrics with the snapshot as json
+    """
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = json.dumps({"time": now(), "spans": snapshot()},
+            sort_keys=True).encode("ascii")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass # keep the console clean
+
+"""
+    serve
+    serves the metrics on http://host:port/metrics from a background thread,
+    only on the local machine by default
+    returns the server, server.shutdown() stops it
+"""
+def serve(port, host="127.0.0.1"):
+    server = HTTPServer((host, port), MetricsHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
@@ -0,0 +1,206 @@
+from math import asin, cos, sin
+import numpy as np
+
+import fusion
+from helper import *
+
+class KalmanFuser(fusion.Fuser):
+    """
+        extended kalman filter, same interface as fusion.Fuser
+
+        the state is the rotation vector [x, y, z] of Fuser and the gyro bias
+        [x, y, z] in rad/s, on top of config["gyro_cal"]:
+            self.angles, self.bias
+        the gyro moves the angles the same way as Fuser.process_gyro, with
+        the bias taken off, the low pass filtered acc then pulls x and y
+        towards its tilt by the kalman gain instead of a fixed acc_fuse_f
+
+        as the bias is estimated while running, the acc can be trusted less
+        than in the complementary filter, which gives less noise without the
+        angles drifting
+        z and its bias are not seen by the acc, they follow from the gyro and
+        from how z couples into x and y
+
+        noise parameters, see default_config:
+            kalman_angle_noise: rad^2/s the angles diverge from the
+                integrated gyro by
+            kalman_motion_noise: added to that per (rad/s)^2 of rotation,
+                as the small angle steps of the gyro are worse when turning
+            kalman_bias_noise: (rad/s)^2/s the bias changes by
+            kalman_acc_noise: rad^2, variance of the acc tilt
+
+        the matrices are 6x6 numpy arrays allocated once, updated in place
+    """
+    def __init__(self, config=fusion.default_config, buffer_size=100):
+        # before Fuser.__init__, which calls configure
+        self.bias = [0.0]*3
+        self.gyro_consts = None
+
+        # process noise of a sample, diagonal
+        self.Q = np.empty(6)
+
+        fusion.Fuser.__init__(self, config, buffer_size)
+
+        # covariance of [x, y, z, bias x, bias y, bias z], the angles start
+        # unknown and converge in the first second
+        self.P = np.diag([0.1, 0.1, 0.1, 1e-4, 1e-4, 1e-4])
+        self.P_diag = self.P.reshape(-1)[::7] # a view, for adding Q
+
+        # state transition jacobian, the entries that stay 0 or 1 are set
+        # here, the rest per gyro sample
+        self.F = np.eye(6)
+
+        # scratch for F*P*F^T, the gain and its update of P
+        self.FP = np.empty((6, 6))
+        self.S_inv = np.empty((2, 2)) # of the innovation covariance
+        self.w = np.empty(2)
+        self.KT = np.empty((2, 6))
+        self.KP = np.empty((6, 6))
+
+    """
+        binds the config, see Fuser.configure
+        a changed gyro_cal (online calibration) is moved out of the bias so
+        the total gyro offset stays the same
+    """
+    def configure(self):
+        old = self.gyro_consts
+        fusion.Fuser.configure(self)
+        c = self.config # just shorter
+
+        self.q_angle = c["kalman_angle_noise"]
+        self.q_motion = c["kalman_motion_noise"]
+        self.q_bias = c["kalman_bias_noise"]
+        self.r_acc = c["kalman_acc_noise"]
+
+        if old:
+            new = self.gyro_consts
+            dps = new[6]*fusion.deg_to_rad
+            for i in range(3):
+                self.bias[i] += (old[i]*old[3 + i] - new[i]*new[3 + i])*dps
+
+    """
+        processes an acc sample, see Fuser.process_acc
+        low pass filters the data and corrects the state with the tilt
+    """
+    def process_acc(self, dt, acc_raw):
+        if self.calibrator:
+            self.calibrator.add_acc(dt, acc_raw)
+
+        f, sf_lp, sf_lp1, _, _ = self.acc_cache.get(dt) or self.acc_factors(dt)
+
+        # save f=dt^-1 to buffer
+        self.acc_f_buf.push(f)
+
+        # get data in g, clamped to max 1g, and low pass filter it
+        cal_x, cal_y, g_x, g_y = self.acc_consts
+        x = uclamp((acc_raw[0] - cal_x)/g_x)
+        y = uclamp((acc_raw[1] - cal_y)/g_y)
+        fa = self.filt_acc
+        x = sf_lp*x + sf_lp1*fa[0]
+        y = sf_lp*y + sf_lp1*fa[1]
+        fa[0] = x
+        fa[1] = y
+
+        # innovation, the acc tilt minus the angles, same axes as Fuser
+        ang = self.angles
+        e0 = asin(y) - ang[0]
+        e1 = -asin(x) - ang[1]
+
+        # the acc measures x and y directly, so only the first two rows of P
+        # are needed and S is 2x2, inverted by hand
+        # P and S are symmetric, so the gain is K = P[:2, :]^T*S^-1
+        P = self.P
+        P2 = P[:2]
+        (s00, s01), (_, s11) = P2[:, :2].tolist()
+        s00 += self.r_acc
+        s11 += self.r_acc
+        det = s00*s11 - s01*s01
+        S_inv = self.S_inv
+        S_inv[0, 0], S_inv[0, 1] = s11/det, -s01/det
+        S_inv[1, 0], S_inv[1, 1] = -s01/det, s00/det
+
+        # state update, K*e = P[:2, :]^T*(S^-1*e)
+        w = self.w
+        w[0] = (s11*e0 - s01*e1)/det
+        w[1] = (s00*e1 - s01*e0)/det
+        k = np.dot(w, P2).tolist()
+        ang[0] += k[0]
+        ang[1] += k[1]
+        ang[2] += k[2]
+        b = self.bias
+        b[0] += k[3]
+        b[1] += k[4]
+        b[2] += k[5]
+
+        # covariance update, P -= K*P[:2, :]
+        KT = np.dot(S_inv, P2, out=self.KT)
+        np.dot(KT.T, P2, out=self.KP)
+        P -= self.KP
+
+    """
+        processes a gyro sample, see Fuser.process_gyro
+        integrates the bias corrected rates and propagates the covariance
+    """
+    def process_gyro(self, dt, gyro_raw):
+        if self.calibrator:
+            self.calibrator.add_gyro(dt, gyro_raw)
+
+        f, dt = self.gyro_cache.get(dt) or self.gyro_factors(dt)
+
+        # save f=dt^-1 to buffer
+        self.gyro_f_buf.push(f)
+
+        # calibrate, flip signs, convert to radians per second and take off
+        # the estimated bias
+        cal_x, cal_y, cal_z, s_x, s_y, s_z, dps = self.gyro_consts
+        b = self.bias
+        rx = (gyro_raw[0] - cal_x)*s_x*dps*fusion.deg_to_rad - b[0]
+        ry = (gyro_raw[1] - cal_y)*s_y*dps*fusion.deg_to_rad - b[1]
+        rz = (gyro_raw[2] - cal_z)*s_z*dps*fusion.deg_to_rad - b[2]
+        self.rates = [rx, ry, rz]
+
+        # same step as Fuser.process_gyro
+        dx, dy, dz = rx*dt, ry*dt, rz*dt
+        ang = self.angles
+        x, y = ang[0], ang[1]
+        c, s = cos(dz), sin(dz)
+        ang[0] = (x*c - y*s) + dx
+        ang[1] = (x*s + y*c) + dy
+        ang[2] = ang[2] + dz
+
+        # jacobian of the step, the bias enters through d = (r - bias)*dt
+        F = self.F
+        F[:2] = ((c, -s, 0.0, -dt, 0.0, (x*s + y*c)*dt),
+            (s, c, 0.0, 0.0, -dt, (y*s - x*c)*dt))
+        F[2, 5] = -dt
+
+        # P = F*P*F^T + Q*dt, the gyro model is worse the faster the rig
+        # turns (small angles), so the angles get more noise then and the
+        # bias does not take up the error
+        np.dot(F, self.P, out=self.FP)
+        np.dot(self.FP, F.T, out=self.P)
+        q = (self.q_angle + self.q_motion*(rx*rx + ry*ry + rz*rz))*dt
+        qb = self.q_bias*dt
+        self.Q[:] = (q, q, q, qb, qb, qb)
+        self.P_diag += self.Q
+
+    """
+        processes a batch of samples, see Fuser.process_batch
+        the filter is not linear, so the samples are processed one by one
+    """
+    def process_batch(self, acc, gyro):
+        return fusion.process_each(self, acc, gyro)
+
+"""
+    dummy main
+    quick test without needing to run the main file
+"""
+def main():
+    f = KalmanFuser()
+    f.process("atxy 10000 4000 6000")
+    f.process("gtxyz 10000 150 -200 50")
+    print(f.angles)
+    print(f.bias)
+
+if __name__ == "__main__":
+    main()
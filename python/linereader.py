@@ -0,0 +1,43 @@
+class LineReader:
+    """
+        reads complete lines from ser, a serial.Serial or anything else with
+        in_waiting and read(size)
+    """
+    def __init__(self, ser):
+        self.ser = ser
+
+        # received bytes not yet split into lines, reused between reads
+        self.buffer = bytearray()
+
+        # bytes waiting in the serial input at the last read, shows how far
+        # behind the reader is
+        self.backlog = 0
+
+        # largest backlog since last reset by the user
+        self.peak_backlog = 0
+
+        # number of lines returned by the last read
+        self.lines_read = 0
+
+    """
+        drains the serial input in one read and returns all complete lines
+        received so far, without line endings
+        a trailing partial line is kept until the rest of it arrives
+    """
+    def read_lines(self):
+        n = self.ser.in_waiting
+        self.backlog = n
+        self.peak_backlog = max(self.peak_backlog, n)
+        if n:
+            self.buffer += self.ser.read(n)
+
+        end = self.buffer.rfind(b"\n")
+        if end < 0:
+            self.lines_read = 0
+            return []
+
+        lines = self.buffer[:end].decode("ascii", "replace").split("\n")
+        del self.buffer[:end + 1]
+
+        self.lines_read = len(lines)
+        return [s.rstrip("\r") for s in lines] # arduino uses println, \r\n
@@ -0,0 +1,167 @@
+from math import asin, atan2, cos, sin, sqrt
+
+import fusion
+from helper import *
+
+class MadgwickFuser(fusion.Fuser):
+    """
+        quaternion orientation filter, same interface as fusion.Fuser
+
+        the orientation is kept as a quaternion integrated from the gyro and
+        corrected towards the low pass filtered acc by a gradient descent step
+        of size config["madgwick_beta"], see
+        S. Madgwick, An efficient orientation filter for inertial and
+        inertial/magnetic sensor arrays, 2010
+
+        unlike the complementary filter this has no small angle assumptions,
+        so it does not couple axes at large tilts
+    """
+    def __init__(self, config=fusion.default_config, buffer_size=100):
+        fusion.Fuser.__init__(self, config, buffer_size)
+
+        # orientation of the sensor, [w, x, y, z]
+        self.q = [1.0, 0.0, 0.0, 0.0]
+
+        # True when q has been set from the first acc sample
+        self.q_init = False
+
+    """
+        binds the config, see Fuser.configure
+    """
+    def configure(self):
+        fusion.Fuser.configure(self)
+        self.beta = self.config["madgwick_beta"]
+
+    """
+        processes an acc sample, see Fuser.process_acc
+        only low pass filters the data, the filter uses it on the next gyro
+        sample
+    """
+    def process_acc(self, dt, acc_raw):
+        if self.calibrator:
+            self.calibrator.add_acc(dt, acc_raw)
+
+        # sample frequency and low pass filter smoothing factor
+        f, sf_lp, sf_lp1, _, _ = self.acc_cache.get(dt) or self.acc_factors(dt)
+
+        # save f=dt^-1 to buffer
+        self.acc_f_buf.push(f)
+
+        # get data in g, clamped to max 1g
+        cal_x, cal_y, g_x, g_y = self.acc_consts
+        x = uclamp((acc_raw[0] - cal_x)/g_x)
+        y = uclamp((acc_raw[1] - cal_y)/g_y)
+
+        if not self.q_init:
+            # start at the tilt given by acc instead of converging to it
+            self.filt_acc = [x, y]
+            self.q = euler_to_quaternion(asin(y), -asin(x), 0.0)
+            self.angles = quaternion_to_euler(self.q)
+            self.q_init = True
+            return
+
+        # low pass filter data
+        fa = self.filt_acc
+        fa[0] = sf_lp*x + sf_lp1*fa[0]
+        fa[1] = sf_lp*y + sf_lp1*fa[1]
+
+    """
+        processes a gyro sample, see Fuser.process_gyro
+    """
+    def process_gyro(self, dt, gyro_raw):
+        if self.calibrator:
+            self.calibrator.add_gyro(dt, gyro_raw)
+
+        # sample frequency and dt in seconds
+        f, dt = self.gyro_cache.get(dt) or self.gyro_factors(dt)
+
+        # save f=dt^-1 to buffer
+        self.gyro_f_buf.push(f)
+
+        # calibrate, flip signs and convert to radians per second
+        cal_x, cal_y, cal_z, s_x, s_y, s_z, dps = self.gyro_consts
+        gx = (gyro_raw[0] - cal_x)*s_x*dps*fusion.deg_to_rad
+        gy = (gyro_raw[1] - cal_y)*s_y*dps*fusion.deg_to_rad
+        gz = (gyro_raw[2] - cal_z)*s_z*dps*fusion.deg_to_rad
+        self.rates = [gx, gy, gz]
+
+        q0, q1, q2, q3 = self.q
+
+        # rate of change of quaternion from gyro
+        dq0 = 0.5*(-q1*gx - q2*gy - q3*gz)
+        dq1 = 0.5*(q0*gx + q2*gz - q3*gy)
+        dq2 = 0.5*(q0*gy - q1*gz + q3*gx)
+        dq3 = 0.5*(q0*gz + q1*gy - q2*gx)
+
+        # acc [x, y, z] in g, z from the assumption that total acc is 1g
+        ax, ay = self.filt_acc
+        az = sqrt(max(0.0, 1.0 - ax*ax - ay*ay))
+        n = sqrt(ax*ax + ay*ay + az*az)
+
+        if self.q_init and n > 0.0:
+            ax, ay, az = ax/n, ay/n, az/n
+
+            # gradient of the error between the gravity direction predicted
+            # by q and the measured one
+            q0q0, q1q1, q2q2, q3q3 = q0*q0, q1*q1, q2*q2, q3*q3
+            s0 = 4.0*q0*q2q2 + 2.0*q2*ax + 4.0*q0*q1q1 - 2.0*q1*ay
+            s1 = 4.0*q1*q3q3 - 2.0*q3*ax + 4.0*q0q0*q1 - 2.0*q0*ay - 4.0*q1 \
+                + 8.0*q1*q1q1 + 8.0*q1*q2q2 + 4.0*q1*az
+            s2 = 4.0*q0q0*q2 + 2.0*q0*ax + 4.0*q2*q3q3 - 2.0*q3*ay - 4.0*q2 \
+                + 8.0*q2*q1q1 + 8.0*q2*q2q2 + 4.0*q2*az
+            s3 = 4.0*q1q1*q3 - 2.0*q1*ax + 4.0*q2q2*q3 - 2.0*q2*ay
+            n = sqrt(s0*s0 + s1*s1 + s2*s2 + s3*s3)
+
+            # step against the gradient
+            if n > 0.0:
+                beta = self.beta/n
+                dq0 -= beta*s0
+                dq1 -= beta*s1
+                dq2 -= beta*s2
+                dq3 -= beta*s3
+
+        # integrate and normalize
+        q0 += dq0*dt
+        q1 += dq1*dt
+        q2 += dq2*dt
+        q3 += dq3*dt
+        n = sqrt(q0*q0 + q1*q1 + q2*q2 + q3*q3)
+        self.q = [q0/n, q1/n, q2/n, q3/n]
+
+        self.angles = quaternion_to_euler(self.q)
+
+    """
+        processes a batch of samples, see Fuser.process_batch
+        the filter is not linear, so the samples are processed one by one
+    """
+    def process_batch(self, acc, gyro):
+        return fusion.process_each(self, acc, gyro)
+
+"""
+    quaternion to euler
+    returns the [x, y, z] (roll, pitch, yaw) angles of quaternion q, the same
+    angles as fusion.Fuser uses for small rotations
+"""
+def quaternion_to_euler(q):
+    q0, q1, q2, q3 = q
+    return [
+        atan2(2.0*(q0*q1 + q2*q3), 1.0 - 2.0*(q1*q1 + q2*q2)),
+        asin(uclamp(2.0*(q0*q2 - q3*q1))),
+        atan2(2.0*(q0*q3 + q1*q2), 1.0 - 2.0*(q2*q2 + q3*q3))
+    ]
+
+"""
+    euler to quaternion
+    returns the quaternion of roll x, pitch y and yaw z, see
+    quaternion_to_euler
+"""
+def euler_to_quaternion(x, y, z):
+    cx, sx = cos(x/2), sin(x/2)
+    cy, sy = cos(y/2), sin(y/2)
+    cz, sz = cos(z/2), sin(z/2)
+    return [
+        cx*cy*cz + sx*sy*sz,
+        sx*cy*cz - cx*sy*sz,
+        cx*sy*cz + sx*cy*sz,
+        cx*cy*sz - sx*sy*cz
+    ]
@@ -1,25 +1,115 @@
-from serial import Serial
 from math import degrees, sin,radians
+import json
 import time
 import sys
 
-import fusion
-import camera
-import rotation
+import dashboard
+import instrument
+import stabilizer
 from helper import *
 
-def main():
-    ### setup
-    clear_console()
-    print(ascii_art)
+"""
+    command line settings
+    returns the rig settings given as command line arguments (only those
+    given), see stabilizer.default_settings
+"""
+def cli_settings():
+    s = {}
+
+    # arg --port PORT is the serial port, "auto" finds it, see find_port
+    if arg_value("--port"):
+        s["port"] = arg_value("--port")
+
+    # arg --replay FILE plays back a recording instead of using a serial port
+    # and implies --offline-test
+    if arg_value("--replay"):
+        s["replay"] = arg_value("--replay")
+
+    # arg --record FILE records the serial stream
+    if arg_value("--record"):
+        s["record"] = arg_value("--record")
+
+    # arg --binary uses the binary sensor protocol (recordings are ascii)
+    if "--binary" in sys.argv:
+        s["binary"] = True
+
+    # arg --camera IP enables camera control
+    if arg_value("--camera"):
+        s["camera_ip"] = arg_value("--camera")
+
+    # arg --pan and --tilt set the target, degrees
+    if arg_value("--pan"):
+        s["pan"] = float(arg_value("--pan"))
+    if arg_value("--tilt"):
+        s["tilt"] = float(arg_value("--tilt"))
+
+    # arg --output-freq HZ is how often the camera is moved
+    if arg_value("--output-freq"):
+        s["output_freq"] = float(arg_value("--output-freq"))
+
+    # arg --no-estimate asks the camera for its position before every move
+    # instead of estimating it, see camera.PositionEstimator
+    if "--no-estimate" in sys.argv:
+        s["estimate_position"] = False
+
+    # arg --fixed-rate keeps the output frequency instead of adapting it to
+    # the camera, see scheduler.RateController
+    if "--fixed-rate" in sys.argv:
+        s["adapt_output"] = False
+
+    # arg --backend NAME selects the fusion backend, see fusion.create_fuser
+    if arg_value("--backend"):
+        s["backend"] = arg_value("--backend")
+
+    # arg --name NAME names the rig, it picks the port cache entry and the
+    # calibration file, see calibration.default_path
+    if arg_value("--name"):
+        s["name"] = arg_value("--name")
+
+    # arg --calibration FILE is where zero values are loaded from at startup
+    # and saved to by the online calibration (default per rig name)
+    if arg_value("--calibration"):
+        s["calibration"] = arg_value("--calibration")
+
+    # arg --online-cal updates the gyro zero values while the rig is still
+    # and saves them to the calibration file, see calibration.py
+    if "--online-cal" in sys.argv:
+        s["online_cal"] = True
+
+    # arg --no-predict sends the current angles instead of extrapolating them
+    # by the camera latency, see prediction.py
+    if "--no-predict" in sys.argv:
+        s["predict"] = False
+
+    # arg --no-shaping sends every camera move, see camera.CommandShaper
+    if "--no-shaping" in sys.argv:
+        s["shape_commands"] = False
+
+    # arg --telemetry DIR records every output to DIR, see telemetry.py
+    if arg_value("--telemetry"):
+        s["telemetry"] = arg_value("--telemetry")
+
+    return s
+
+"""
+    prompt settings
+    asks the user for what settings does not give, see main
+    returns simple_output
+"""
+def prompt_settings(settings, offline_test):
+    s = settings # just shorter
+    replay_path = s.get("replay")
 
-    # arg --offline-test is used to skip camera and angle setup
-    offline_test = len(sys.argv) > 1 and sys.argv[1] == "--offline-test"
     if offline_test:
         print("\nOffline test mode")
 
     ## prompts user for serial port
-    ports = serial_ports()
+    if replay_path:
+        ports = [replay_path]
+    elif s.get("port"):
+        ports = [s["port"]]
+    else:
+        ports = find_ports()
     print("\nSerial setup:")
     if ports:
         if len(ports) > 1:
@@ -28,7 +118,7 @@ def main():
             inp = raw_input("  Pick a serial port: [1 - %s] "%len(ports))
             try:
                 index = int(inp) - 1
-                if not in_interval(index, [0, len(ports-1)]):
+                if not in_interval(index, [0, len(ports) - 1]):
                     raise Exception()
                 port = ports[index]
             except Exception as e:
@@ -37,42 +127,52 @@ def main():
             port = ports[0]
     else:
         exit("  No serial port found, exiting...")
+    if not replay_path:
+        s["port"] = port
     print("  Serial port: %s"%port)
+    print("  Protocol: %s"%("binary" if s.get("binary") else "ascii"))
+    if s.get("record"):
+        print("  Recording to: %s"%s["record"])
 
     ## prompts user for camera control
     print("\nCamera setup:")
-    if offline_test:
+    if s.get("camera_ip"):
+        camera_control = True
+        ip = s["camera_ip"]
+    elif offline_test:
         camera_control = False
         print("  Camera control disabled")
     else:
         inp = raw_input("  Enable camera control? [Y/n] ")
         camera_control = yes(inp)
+        if camera_control:
+            ips = [
+                "169.254.20.202",
+                "169.254.20.203"
+            ]
+            print("  IP:")
+            print("    0: custom")
+            print("\n".join(["    %s: %s"%(i+1, v) for i, v in enumerate(ips)]))
+            inp = raw_input("  Pick an IP: [0 - %s] "%(len(ips)))
+            try:
+                inp = int(inp)
+                if not in_interval(inp, [0, len(ips)]):
+                    raise Exception()
+                if inp:
+                    ip = ips[inp-1]
+                else:
+                    ip = raw_input("  Enter custom IP: ")
+            except Exception as e:
+                exit("  Invalid input, exiting...")
     if camera_control:
-        ips = [
-            "169.254.20.202",
-            "169.254.20.203"
-        ]
-        print("  IP:")
-        print("    0: custom")
-        print("\n".join(["    %s: %s"%(i+1, v) for i, v in enumerate(ips)]))
-        inp = raw_input("  Pick an IP: [0 - %s] "%(len(ips)))
-        try:
-            inp = int(inp)
-            if not in_interval(inp, [0, len(ips)]):
-                raise Exception()
-            if inp:
-                ip = ips[inp-1]
-            else:
-                ip = raw_input("  Enter custom IP: ")
-        except Exception as e:
-            exit("  Invalid input, exiting...")
         print("  IP: %s"%ip)
+    s["camera_ip"] = ip if camera_control else None
 
     ## prompts user for default pan and tilt
-    tgt_pan = 0
-    tgt_tilt = 45
+    tgt_pan = s.get("pan", stabilizer.default_settings["pan"])
+    tgt_tilt = s.get("tilt", stabilizer.default_settings["tilt"])
     print("\nAngle setup:")
-    if offline_test:
+    if offline_test or "pan" in s or "tilt" in s:
         print("  Using (%d, %d) as target (pan, tilt)"%(tgt_pan, tgt_tilt))
     else:
         tgt_pan_range = [-90, 90]
@@ -88,6 +188,7 @@ def main():
                     raise Exception()
             except:
                 exit("  Invalid input, exiting...")
+    s["pan"], s["tilt"] = tgt_pan, tgt_tilt
 
     ## prompts user for print config
     print("\nPrinting config")
@@ -99,10 +200,10 @@ def main():
         simple_output = yes(inp)
 
     ## prompts user for output freq config
-    output_freq = 25.0
+    output_freq = s.get("output_freq", stabilizer.default_settings["output_freq"])
 
     print("\nOutput frequency config:")
-    if offline_test:
+    if offline_test or "output_freq" in s:
         print("  Output frequency: %d"%int(output_freq))
     else:
         inp = raw_input("  Use default frequency (%d)? [Y/n] "%int(output_freq))
@@ -110,138 +211,77 @@ def main():
             output_freq = float(raw_input("  Enter output frequency: "))
             if output_freq <= 0.0:
                     raise Exception()
+    s["output_freq"] = output_freq
 
-    print("\nSetup finished, starting stabilization...")
+    return simple_output
 
-    ### initialize
-
-    # hardcoded setting
+def main():
+    # arg --config FILE reads the rig settings from a json file (see
+    # stabilizer.default_settings) and asks nothing, as does arg --headless,
+    # other args override the file
+    # the port is found without opening it (see find_port) and nothing waits,
+    # so a restarted rig is back to stabilizing right away
+    config_path = arg_value("--config")
+    headless = bool(config_path) or "--headless" in sys.argv
 
-    # used for lookup
-    output_dt = 1.0/output_freq
+    # arg --offline-test is used to skip camera and angle setup
+    offline_test = "--offline-test" in sys.argv
 
-    # camera movement "gain"
-    cam_dt = 2.0*output_dt
+    # arg --metrics FILE writes the timing of every stage to FILE once a
+    # second, arg --metrics-port PORT serves it on localhost:PORT/metrics
+    metrics_path = arg_value("--metrics")
+    metrics_port = arg_value("--metrics-port")
 
-    # used for measuring output freq
-    last_output_time = 0.0
+    ### setup
 
-    # buffer length is set such that the buffer is 1 second long
-    buf_len = int(output_freq)
+    settings = {}
+    if config_path:
+        with open(config_path) as f:
+            settings = json.load(f)
+    settings.update(cli_settings())
 
-    # start serial
-    ser = Serial(port, 115200, timeout=0)
-    ser_buffer = "" # serial buffer for reading continuously
+    # a replay (from the args or the file) has no camera to set up
+    replay_path = settings.get("replay")
+    offline_test = offline_test or bool(replay_path)
 
-    # create and initalize a fuser
-    f = fusion.Fuser(buffer_size=buf_len)
+    if headless:
+        simple_output = True
+        print("Starting %s..."%settings.get("name", "rig"))
+    else:
+        clear_console()
+        print(ascii_art)
+        simple_output = prompt_settings(settings, offline_test)
+        print("\nSetup finished, starting stabilization...")
 
-    # create and initalize a camera object
-    if camera_control:
-        c = camera.Camera(ip)
+    ### initialize
 
-    # create and initalize a rotator
-    rotator = rotation.Rotator(tgt_pan, tgt_tilt)
+    stab = stabilizer.Stabilizer(settings)
 
-    # create empty buffers
-    out_f_buf = [0.0]*buf_len
-    fuse_t_buf = [0.0]*buf_len
-    rot_t_buf = [0.0]*buf_len
-    out_t_buf = [0.0]*buf_len
-    exc_buf = [None]*buf_len
+    if metrics_path:
+        instrument.FileExporter(metrics_path).start()
+    if metrics_port:
+        instrument.serve(int(metrics_port))
 
     ### run
 
-    time.clock() # needs to be called once to initalize
-
-    time.sleep(1)
-
-    while True:
-        # read from serial
-        # if possible, process data
-        if ser.in_waiting:
-            ser_buffer += ser.read(size=24) # a line won't be longer than 24B
-            if "\n" in ser_buffer: # if a complete line is in the buffer
-                # extract the line
-                i = ser_buffer.index("\n")
-                s = ser_buffer[:i-1]
-                ser_buffer = ser_buffer[i+1:]
-                try: # and process it
-                    t = now()
-                    f.process(s)
-                    pp(now() - t, fuse_t_buf)
-                    pp(None, exc_buf)
-                except Exception as e:
-                    pp(e, exc_buf) # save the exception for diagnostic output
-                continue
-
-        # if long enough time passed, output data
-        t = now()
-        dt = t - last_output_time
-        if dt >= output_dt:
-            last_output_time = t
-            freq = 1.0/dt
-            pp(freq, out_f_buf)
-
-            angles = f.angles
-            rot_t = now()
-            pan, tilt = rotator.rotate(angles)
-            pp(now()-rot_t, rot_t_buf)
-
-            if camera_control:
-                c.move(pan, tilt, cam_dt)
-
-            # calculate diagnostic data
-            out_f_data = \
-                map(round_to_int, [output_freq]+cur_avg_min(out_f_buf))
-
-            if not simple_output:
-                acc_f_data = \
-                    map(round_to_int, cur_avg_min(f.acc_f_buf))
-                gyro_f_data = \
-                    map(round_to_int, cur_avg_min(f.gyro_f_buf))
-                fus_t_data = \
-                    [int(x*1.0e6) for x in [avg(fuse_t_buf), max(fuse_t_buf)]]
-                rot_t_data = \
-                    [int(x*1.0e6) for x in [avg(rot_t_buf), max(rot_t_buf)]]
-                out_t_data = \
-                    [int(x*1.0e6) for x in [avg(out_t_buf), max(out_t_buf)]]
-                excs = \
-                    [str(x) for x in exc_buf if x]
-                x, y, z = \
-                    map(degrees, angles)
-
-            if simple_output:
-                print("out tgt cur avg min: {:3d} {:3d} {:3d} {:3d}".format(*out_f_data))
-            else:
-                clear_console()
-                print("\n".join([
-                    ascii_art+"\n",
-                    "serial: %s"%port,
-                    "camera: %s"%(ip if camera_control else "disabled"),
-                    "target:",
-                    "  pan:  %3d"%tgt_pan,
-                    "  tilt: %3d"%tgt_tilt,
-                    "freq [hz]:",
-                    "  acc       cur avg min:     {:3d} {:3d} {:3d}".format(*acc_f_data),
-                    "  gyro      cur avg min:     {:3d} {:3d} {:3d}".format(*gyro_f_data),
-                    "  out   tgt cur avg min: {:3d} {:3d} {:3d} {:3d}".format(*out_f_data),
-                    "time [us]:",
-                    "  fus  avg max: {:5d} {:5d}".format(*fus_t_data),
-                    "  rot  avg max: {:5d} {:5d}".format(*rot_t_data),
-                    "  out  avg max: {:5d} {:5d}".format(*out_t_data),
-                    "status:\n  " + (excs[0] if excs else "ok"),
-                    "",
-                    "pan tilt:",
-                    nice_format_list_of_float([pan, tilt]),
-                    "",
-                    "fusion data:",
-                    nice_format_list_of_float(map(degrees, angles)),
-                    visualize_2d(x, y, 90, 4),
-                    visualize_1d(z, 90, 4)
-                ]))
-
-            pp(now() - t, out_t_buf)
+    if not headless:
+        time.sleep(1)
+
+    # the dashboard is drawn from its own thread, the loop only hands over
+    # the state
+    if simple_output:
+        renderer = dashboard.Renderer(dashboard.render_simple, in_place=False)
+    else:
+        renderer = dashboard.Renderer(dashboard.render)
+    renderer.start()
+
+    try:
+        stab.run(on_output=renderer.publish)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        renderer.stop()
+        stab.close() # writes what is left of the telemetry
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,52 @@
+from math import cos, sin
+
+class Predictor:
+    """
+        extrapolates the fused angles to where the platform will be when a
+        camera move takes effect
+
+        the latency from submitting a move until the camera acts on it is
+        measured on every sent move (see camera.CameraWorker) and smoothed
+        with an exponential moving average, offset is added on top for the
+        time the camera itself needs to respond
+        the angles are moved forward by the latest gyro rates over that time,
+        the same step as Fuser.process_gyro
+    """
+    def __init__(self, latency=0.08, offset=0.0, smoothing=0.1,
+            max_horizon=0.5):
+        # measured latency, seconds, latency is the guess until measured
+        self.latency = latency
+        self.measurements = 0
+
+        self.offset = offset
+        self.smoothing = smoothing # weight of a new measurement
+
+        # longer extrapolations are mostly noise
+        self.max_horizon = max_horizon
+
+    """
+        adds a measured latency in seconds
+    """
+    def update(self, latency):
+        if self.measurements:
+            self.latency += self.smoothing*(latency - self.latency)
+        else:
+            self.latency = latency
+        self.measurements += 1
+
+    """
+        returns how far ahead to predict, in seconds
+    """
+    def horizon(self):
+        return min(max(self.latency + self.offset, 0.0), self.max_horizon)
+
+    """
+        returns the rotation vector [x, y, z] horizon() seconds after angles,
+        turning with rates [x, y, z] in radians per second
+    """
+    def predict(self, angles, rates):
+        h = self.horizon()
+        dx, dy, dz = rates[0]*h, rates[1]*h, rates[2]*h
+        x, y, z = angles
+        c, s = cos(dz), sin(dz)
+        return [x*c - y*s + dx, x*s + y*c + dy, z + dz]
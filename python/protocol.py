@@ -0,0 +1,190 @@
+import numpy as np
+
+from helper import now
+
+"""
+    binary sensor protocol, see arduino/main/main.ino
+
+    the arduino sends ascii lines (see Fuser.process) until the host sends
+    MODE_BINARY, after which it sends fixed size little endian frames:
+        sync      uint8     SYNC
+        type      uint8     ACC, GYRO or WARNING
+        dt        uint32    microseconds since last sample of the same type
+        v         int16*3   raw [x, y, z] (acc: [x, y, 0], warning: [code, 0, 0])
+        checksum  uint8     sum of the 12 preceding bytes, mod 256
+"""
+MODE_ASCII = b"A"
+MODE_BINARY = b"B"
+
+SYNC = 0xA5
+ACC, GYRO, WARNING = ord("a"), ord("g"), ord("w")
+
+WARNINGS = ["skipped gyro read"]
+
+FRAME = np.dtype([
+    ("sync", "u1"),
+    ("type", "u1"),
+    ("dt", "<u4"),
+    ("v", "<i2", (3,)),
+    ("checksum", "u1")
+])
+FRAME_SIZE = FRAME.itemsize # 13
+
+"""
+    decodes consecutive frames in buf (a bytearray or bytes) from start
+    the frames are not copied, the returned record array points into buf
+
+    returns (frames, end), where frames are the valid frames found and end is
+    where decoding stopped:
+        - after the last frame if all complete frames were valid
+        - at the first invalid frame, or one byte past it if it is the first
+          one, so the next call resyncs
+        - before a trailing incomplete frame
+"""
+def decode(buf, start=0):
+    s = buf.find(b"\xa5", start) # first sync byte
+    if s < 0:
+        return np.zeros(0, dtype=FRAME), len(buf) # nothing but garbage
+
+    count = (len(buf) - s)//FRAME_SIZE
+    if not count:
+        return np.zeros(0, dtype=FRAME), s
+
+    frames = np.frombuffer(buf, dtype=FRAME, count=count, offset=s)
+    raw = np.frombuffer(buf, dtype=np.uint8, count=count*FRAME_SIZE,
+        offset=s).reshape(count, FRAME_SIZE)
+
+    ok = (frames["sync"] == SYNC) & \
+        (raw[:, :-1].sum(axis=1, dtype=np.uint8) == frames["checksum"])
+    bad = np.flatnonzero(~ok)
+    if not len(bad):
+        return frames, s + count*FRAME_SIZE
+
+    k = int(bad[0])
+    return frames[:k], s + k*FRAME_SIZE + (0 if k else 1)
+
+"""
+    decodes all frames in buf, skipping corrupt data
+    returns (frames, end), see decode
+"""
+def decode_all(buf):
+    parts = []
+    end = 0
+    while True:
+        frames, new_end = decode(buf, end)
+        if len(frames):
+            parts.append(frames)
+        if new_end == end:
+            break
+        end = new_end
+
+    if len(parts) == 1:
+        return parts[0], end
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=FRAME), end
+
+"""
+    processes a sample (type, dt, v) with the fuser f
+    warnings are raised, like Fuser.process does
+"""
+def process(f, sample):
+    kind, dt, v = sample
+    if kind == ACC:
+        f.process_acc(dt, v[:2])
+    elif kind == GYRO:
+        f.process_gyro(dt, v)
+    elif kind == WARNING:
+        raise Exception(
+            WARNINGS[v[0]] if 0 <= v[0] < len(WARNINGS) else "unknown warning")
+    else:
+        raise Exception("invalid data")
+
+class FrameReader:
+    """
+        reads binary frames from ser, like LineReader does for lines
+        asks the arduino for binary frames until the first valid one arrives,
+        and again if ascii sample lines show up later (the board was reset
+        and starts in ascii)
+    """
+    def __init__(self, ser, retry_time=0.5):
+        self.ser = ser
+        self.retry_time = retry_time
+        self.last_request = None
+        self.synced = False
+
+        # received bytes not yet decoded, reused between reads
+        self.buffer = bytearray()
+
+        # see LineReader
+        self.backlog = 0
+        self.peak_backlog = 0
+
+        # number of bytes skipped as corrupt or not binary (ascii sent before
+        # the switch)
+        self.skipped = 0
+
+        # number of times ascii lines were seen after sync
+        self.resyncs = 0
+
+    """
+        drains the serial input in one read and returns all complete frames
+        received so far as a record array (FRAME)
+    """
+    def read_frames(self):
+        if not self.synced and (self.last_request is None
+                or now() - self.last_request > self.retry_time):
+            # the arduino resets when the port opens and may miss the request
+            self.ser.write(MODE_BINARY)
+            self.last_request = now()
+
+        n = self.ser.in_waiting
+        self.backlog = n
+        self.peak_backlog = max(self.peak_backlog, n)
+        if n:
+            self.buffer += self.ser.read(n)
+
+        frames, end = decode_all(self.buffer)
+        frames = frames.copy() # release buf so it can be trimmed
+        skipped = end - len(frames)*FRAME_SIZE
+        self.skipped += skipped
+        ascii = skipped and is_ascii(self.buffer[:end])
+        del self.buffer[:end]
+
+        if ascii:
+            # ascii lines, before the switch or after a board reset
+            if self.synced:
+                self.synced = False
+                self.last_request = None # ask again right away
+                self.resyncs += 1
+        elif len(frames):
+            self.synced = True
+        return frames
+
+    """
+        returns all complete frames received so far as a list of samples
+        (type, dt, v), see process
+    """
+    def read_samples(self):
+        frames = self.read_frames()
+        return list(zip(frames["type"].tolist(), frames["dt"].tolist(),
+            frames["v"].tolist()))
+
+"""
+    is ascii
+    returns True if buf has an ascii sample line in it (see Fuser.process)
+"""
+def is_ascii(buf):
+    return b"atxy" in buf or b"gtxyz" in buf
+
+"""
+    encode
+    returns the frame the arduino sends for a sample, as bytes
+"""
+def encode(kind, dt, v):
+    frame = np.zeros(1, dtype=FRAME)
+    frame["sync"] = SYNC
+    frame["type"] = kind
+    frame["dt"] = dt
+    frame["v"] = v
+    raw = frame.view(np.uint8)
+    raw[-1] = raw[:-1].sum(dtype=np.uint8)
+    return frame.tobytes()
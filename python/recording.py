@@ -0,0 +1,308 @@
+from math import degrees
+import os
+import struct
+import sys
+import time
+import numpy as np
+
+import fusion
+import protocol
+from helper import *
+
+"""
+    file format
+
+    a recording is a short header followed by fixed size little endian
+    records, one for each line received from the arduino:
+        t     float64  host receive time, seconds
+        kind  uint8    ACC, GYRO, WARNING or INVALID
+        dt    int32    dt from the line, microseconds
+        v     int32*3  raw values from the line (acc uses the first two,
+                       warnings store the index in WARNINGS, -1 if unknown)
+
+    lines that do not fit a record (invalid lines and unknown warnings) are
+    kept as received in a side file, path + LINES_SUFFIX, which is only
+    created when there are any, their record has the offset and length of
+    the line there in v[1] and v[2] (0 if not kept)
+    replay gives back every line as the fuser saw it, up to whitespace,
+    except in recordings of the binary protocol, which has no lines
+"""
+MAGIC = b"PTZREC1\n"
+LINES_SUFFIX = ".lines"
+
+ACC, GYRO, WARNING, INVALID = range(4)
+
+WARNINGS = protocol.WARNINGS # same codes as the binary protocol
+
+RECORD = np.dtype([
+    ("t", "<f8"),
+    ("kind", "u1"),
+    ("dt", "<i4"),
+    ("v", "<i4", (3,))
+])
+
+record_struct = struct.Struct("<dBi3i") # same layout as RECORD
+
+# range of the dt and v fields
+INT32_MIN, INT32_MAX = -2**31, 2**31 - 1
+
+"""
+    fits record
+    returns True if dt and the values v fit the int32 fields of a record
+"""
+def fits_record(dt, v):
+    return INT32_MIN <= dt <= INT32_MAX and \
+        all(INT32_MIN <= x <= INT32_MAX for x in v)
+
+class Recorder:
+    """
+        creates (or overwrites) the recording at path
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "wb")
+        self.f.write(MAGIC)
+        self.count = 0
+
+        # side file of the lines that do not fit a record, opened when needed
+        self.lines_f = None
+        self.lines_size = 0
+
+    """
+        writes s to the side file
+        returns [offset, length] of it there
+    """
+    def keep_line(self, s):
+        if self.lines_f is None:
+            self.lines_f = open(self.path + LINES_SUFFIX, "wb")
+        data = s.encode("ascii", "replace")
+        self.lines_f.write(data)
+        offset = self.lines_size
+        self.lines_size += len(data)
+        return [offset, len(data)]
+
+    """
+        records a line s sent via serial from arduino (see Fuser.process),
+        received at time t (defaults to now)
+    """
+    def record(self, s, t=None):
+        if t is None:
+            t = now()
+
+        ss = s.split()
+        kind, dt, v = INVALID, 0, [0]*3
+        try:
+            if ss[0] == "atxy" and len(ss) == 4:
+                kind, dt, v = ACC, int(ss[1]), [int(ss[2]), int(ss[3]), 0]
+            elif ss[0] == "gtxyz" and len(ss) == 5:
+                kind, dt, v = GYRO, int(ss[1]), [int(x) for x in ss[2:5]]
+            elif ss[0] == "w":
+                msg = " ".join(ss[1:])
+                if msg in WARNINGS:
+                    kind, v = WARNING, [WARNINGS.index(msg), 0, 0]
+                else:
+                    kind, v = WARNING, [-1] + self.keep_line(s)
+        except (IndexError, ValueError):
+            kind, dt, v = INVALID, 0, [0]*3
+
+        # a corrupt line can have numbers too large for a record
+        if not fits_record(dt, v):
+            kind = INVALID
+
+        if kind == INVALID:
+            dt, v = 0, [0] + self.keep_line(s)
+
+        self.f.write(record_struct.pack(t, kind, dt, *v))
+        self.count += 1
+
+    """
+        records a sample (type, dt, v) decoded from the binary protocol (see
+        protocol.py), received at time t (defaults to now)
+    """
+    def record_sample(self, sample, t=None):
+        if t is None:
+            t = now()
+
+        kind, dt, v = sample
+        kind = {protocol.ACC: ACC, protocol.GYRO: GYRO,
+            protocol.WARNING: WARNING}.get(kind, INVALID)
+        if not fits_record(dt, v):
+            kind = INVALID
+        if kind == WARNING and not 0 <= v[0] < len(WARNINGS):
+            v = [-1, 0, 0]
+        elif kind == INVALID:
+            dt, v = 0, [0]*3
+
+        self.f.write(record_struct.pack(t, kind, dt, *v))
+        self.count += 1
+
+    def close(self):
+        self.f.close()
+        if self.lines_f:
+            self.lines_f.close()
+
+class Replay:
+    """
+        opens the recording at path, the records are memory mapped and
+        available as a numpy record array in self.records, the side file
+        of kept lines is read into self.kept
+    """
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise Exception("not a recording: %s"%path)
+            f.seek(0, 2)
+            # a trailing partial record (recorder killed) is ignored
+            n = (f.tell() - len(MAGIC))//RECORD.itemsize
+
+        if n:
+            self.records = np.memmap(path, dtype=RECORD, mode="r",
+                offset=len(MAGIC), shape=(n,))
+        else:
+            self.records = np.zeros(0, dtype=RECORD)
+
+        self.kept = b""
+        if os.path.exists(path + LINES_SUFFIX):
+            with open(path + LINES_SUFFIX, "rb") as f:
+                self.kept = f.read()
+
+    def __len__(self):
+        return len(self.records)
+
+    """
+        duration of the recording in seconds
+    """
+    def duration(self):
+        if not len(self.records):
+            return 0.0
+        return float(self.records["t"][-1] - self.records["t"][0])
+
+    """
+        returns (acc, gyro), the samples as arrays for Fuser.process_batch,
+        only those recorded from start up to end (seconds, as t) if given
+    """
+    def batch(self, start=None, end=None):
+        r = self.records
+        if start is not None or end is not None:
+            t = r["t"]
+            r = r[np.searchsorted(t, start) if start is not None else 0:
+                np.searchsorted(t, end) if end is not None else len(r)]
+        acc = r[r["kind"] == ACC]
+        gyro = r[r["kind"] == GYRO]
+        return (
+            np.column_stack([acc["t"], acc["dt"], acc["v"][:, :2]]),
+            np.column_stack([gyro["t"], gyro["dt"], gyro["v"]])
+        )
+
+    """
+        yields (t, s) for every record, where s is the line as originally
+        sent by the arduino
+        if realtime, sleeps so that lines are yielded at the recorded pace
+    """
+    def lines(self, realtime=False):
+        start_t = None
+        for t, kind, dt, v in self.records.tolist():
+            if realtime:
+                if start_t is None:
+                    start_t, start_wall = t, now()
+                wait = (t - start_t) - (now() - start_wall)
+                if wait > 0:
+                    time.sleep(wait)
+            yield t, record_to_line(kind, dt, v, self.kept)
+
+    """
+        feeds all lines to the fuser f, at recorded pace if realtime or as
+        fast as possible otherwise
+        returns the number of lines that raised (warnings, invalid data)
+    """
+    def feed(self, f, realtime=False):
+        errors = 0
+        for _, s in self.lines(realtime):
+            try:
+                f.process(s)
+            except Exception:
+                errors += 1
+        return errors
+
+class ReplaySerial:
+    """
+        a replacement for serial.Serial that plays back a recording, so the
+        main loop can run without an arduino
+        if realtime, bytes become available at the recorded pace, otherwise
+        everything is available at once
+    """
+    def __init__(self, path, realtime=True):
+        self.replay = Replay(path)
+        self.realtime = realtime
+        self.ts = self.replay.records["t"]
+        self.next = 0 # index of the next record to release
+        self.buffer = bytearray()
+        self.start_t = self.ts[0] if len(self.ts) else 0.0
+        self.start_wall = now()
+
+    def release(self):
+        if self.realtime:
+            t = self.start_t + (now() - self.start_wall)
+            end = int(np.searchsorted(self.ts, t, side="right"))
+        else:
+            end = len(self.ts)
+        for r in self.replay.records[self.next:end].tolist():
+            # arduino uses println
+            line = record_to_line(*r[1:], kept=self.replay.kept) + "\r\n"
+            self.buffer += line.encode("ascii")
+        self.next = max(self.next, end)
+
+    @property
+    def in_waiting(self):
+        self.release()
+        return len(self.buffer)
+
+    def read(self, size=1):
+        self.release()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def close(self):
+        pass
+
+"""
+    record to line
+    returns the line the arduino sent for a record, lines that do not fit a
+    record are taken from kept, the side file contents (see file format)
+"""
+def record_to_line(kind, dt, v, kept=b""):
+    if kind == ACC:
+        return "atxy\t%d\t%d\t%d"%(dt, v[0], v[1])
+    elif kind == GYRO:
+        return "gtxyz\t%d\t%d\t%d\t%d"%(dt, v[0], v[1], v[2])
+    elif kind == WARNING and v[0] >= 0:
+        return "w\t" + WARNINGS[v[0]]
+    elif v[2] and v[1] + v[2] <= len(kept):
+        return kept[v[1]:v[1] + v[2]].decode("ascii")
+    elif kind == WARNING:
+        return "w\tunknown warning"
+    else:
+        return "?"
+
+"""
+    prints a summary of a recording and replays it as fast as possible
+    usage: python recording.py FILE
+"""
+def main():
+    r = Replay(sys.argv[1])
+    kinds = np.bincount(r.records["kind"], minlength=4)
+    print("records: %d (acc %d, gyro %d, warnings %d, invalid %d)"%(
+        (len(r),) + tuple(kinds)))
+    print("duration: %.1f s"%r.duration())
+
+    f = fusion.Fuser()
+    t = now()
+    errors = r.feed(f)
+    t = now() - t
+    print("replay: %.3f s, %.1f us/line, %d errors"%(
+        t, t/max(1, len(r))*1e6, errors))
+    print(nice_format_list_of_float([degrees(x) for x in f.angles]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+from collections import deque
+
+class RingBuffer:
+    """
+        fixed size buffer holding the last size values pushed, preallocated
+        and filled with fill from the start
+        indexing and iteration is newest first, like the lists used with pp
+
+        with stats, mean, min and max of the values in the buffer are kept up
+        to date on every push (amortized O(1)), so reading them costs nothing
+        regardless of size
+    """
+    def __init__(self, size, fill=0.0, stats=True):
+        self.size = size
+        self.data = [fill]*size
+        self.n = 0 # number of values pushed, the next value goes to n % size
+        self.stats = stats
+
+        if stats:
+            self.sum = fill*size
+            # candidates for min and max as (push number, value), the front
+            # is the current min (max), values increase (decrease) backwards
+            # the fill values count as pushed just before the first push
+            self.mins = deque([(-1, fill)])
+            self.maxs = deque([(-1, fill)])
+
+    """
+        adds x as the newest value, dropping the oldest
+    """
+    def push(self, x):
+        n = self.n
+        i = n % self.size
+        old = self.data[i]
+        self.data[i] = x
+        self.n = n + 1
+
+        if not self.stats:
+            return
+
+        # recompute the sum once per lap to stop rounding errors from adding up
+        if i == self.size - 1:
+            self.sum = sum(self.data)
+        else:
+            self.sum += x - old
+
+        expired = n - self.size # push number of the value just dropped
+
+        mins = self.mins
+        while mins and mins[-1][1] >= x:
+            mins.pop()
+        mins.append((n, x))
+        if mins[0][0] <= expired:
+            mins.popleft()
+
+        maxs = self.maxs
+        while maxs and maxs[-1][1] <= x:
+            maxs.pop()
+        maxs.append((n, x))
+        if maxs[0][0] <= expired:
+            maxs.popleft()
+
+    def mean(self):
+        return self.sum/float(self.size)
+
+    def min(self):
+        return self.mins[0][1]
+
+    def max(self):
+        return self.maxs[0][1]
+
+    """
+        returns the newest value
+    """
+    def latest(self):
+        return self.data[(self.n - 1) % self.size]
+
+    def __len__(self):
+        return self.size
+
+    """
+        returns the k:th newest value, 0 is the newest
+    """
+    def __getitem__(self, k):
+        if not -self.size <= k < self.size:
+            raise IndexError("ring buffer index out of range")
+        return self.data[(self.n - 1 - k) % self.size]
+
+    def __iter__(self):
+        for k in range(self.size):
+            yield self.data[(self.n - 1 - k) % self.size]
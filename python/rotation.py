@@ -1,63 +1,151 @@
 from math import sin, cos, pi, atan, acos, degrees, atan2, radians
-import numpy as np
+
+import instrument
 
 class Rotator:
     def __init__(self, pan, tilt):
         pan, tilt = map(radians, [pan, tilt])
         self.target_pan = pan
-        self.target_pt = np.array([
+        # target point on the unit sphere, floats so numpy is not needed
+        # unless rotate_many is used
+        self.target = [
             sin(tilt)*cos(pan),
             sin(tilt)*sin(pan),
             cos(tilt)
-        ])
+        ]
 
     """
         rotates xyz coordinates [x, y, z] to pan and tilt
         returns [pan, tilt] in degrees
+
+        same as target*rotation_matrix(xyz), written out with floats so
+        nothing is allocated per call
+        not timed here, the caller times it (see Stabilizer.output)
     """
     def rotate(self, xyz):
-        ## construct rotational matrix, rotates in order x, y, z
-
-        # initalizes 3x3 matrix with all elem = 0.0
-        rot_mat = np.full((3, 3), 0.0)
-
         # we want to reverse angles to compensate movement
-        xyz = [-x for x in xyz]
-
         # precompute sin and cos for all components
-        s = [np.sin(x) for x in xyz]
-        c = [np.cos(x) for x in xyz]
-
-        rot_mat[0, 0] =  c[2]*c[1]
-        rot_mat[0, 1] = -s[2]*c[1]
-        rot_mat[0, 2] =  s[1]
+        s0, s1, s2 = sin(-xyz[0]), sin(-xyz[1]), sin(-xyz[2])
+        c0, c1, c2 = cos(-xyz[0]), cos(-xyz[1]), cos(-xyz[2])
 
-        rot_mat[1, 0] =  s[1]*c[2]*s[0]+s[2]*c[0]
-        rot_mat[1, 1] =  -s[2]*s[1]*s[0]+c[2]*c[0]
-        rot_mat[1, 2] = -c[1]*s[0]
+        tx, ty, tz = self.target
 
-        rot_mat[2, 0] = -c[2]*s[2]*c[0]+s[2]*s[0]
-        rot_mat[2, 1] =  s[2]*s[1]*c[0]+c[2]*s[0]
-        rot_mat[2, 2] =  c[1]*c[0]
-
-        # rot_max*target_pt applies the rotation to the original vector
-        pt = np.dot(self.target_pt, rot_mat)
+        # rot_max*target applies the rotation to the original vector
+        x = tx*(c2*c1) + ty*(s1*c2*s0+s2*c0) + tz*(-c2*s2*c0+s2*s0)
+        y = tx*(-s2*c1) + ty*(-s2*s1*s0+c2*c0) + tz*(s2*s1*c0+c2*s0)
+        z = tx*s1 + ty*(-c1*s0) + tz*(c1*c0)
 
         # correct angles
-        if pt[0] == 0:
-            if pt[1] < 0:
+        if x == 0:
+            if y < 0:
                 pan = -90
-            if pt[1] > 0:
+            if y > 0:
                 pan = 90
             else:
                 pan  = self.target_pan
-        elif pt[0] <  0:
-            pan = pi - atan2(pt[1],pt[0])
+        elif x <  0:
+            pan = pi - atan2(y, x)
         else:
-            pan = atan2(pt[1], pt[0])
+            pan = atan2(y, x)
 
-        tilt = acos(pt[2]) # tilt = arccos(z/[r = 1])
+        tilt = acos(z) # tilt = arccos(z/[r = 1])
         if tilt > pi/2:
             tilt  = pi - tilt
 
-        return map(degrees, [pan, tilt])
+        return [degrees(pan), degrees(tilt)]
+
+    """
+        rotates many xyz coordinates at once, angles is an array with rows
+        [x, y, z]
+        returns (pan, tilt), arrays in degrees with the same results as
+        calling rotate for every row (nan where rotate would raise)
+    """
+    def rotate_many(self, angles):
+        with instrument.Span("rotation.rotate_many"):
+            return self._rotate_many(angles)
+
+    def _rotate_many(self, angles):
+        import numpy as np
+
+        # we want to reverse angles to compensate movement
+        a = -np.asarray(angles, dtype=float).reshape(-1, 3)
+        s0, s1, s2 = np.sin(a).T
+        c0, c1, c2 = np.cos(a).T
+
+        tx, ty, tz = self.target
+
+        x = tx*(c2*c1) + ty*(s1*c2*s0+s2*c0) + tz*(-c2*s2*c0+s2*s0)
+        y = tx*(-s2*c1) + ty*(-s2*s1*s0+c2*c0) + tz*(s2*s1*c0+c2*s0)
+        z = tx*s1 + ty*(-c1*s0) + tz*(c1*c0)
+
+        # correct angles, as in rotate
+        pan = np.arctan2(y, x)
+        pan = np.where(x < 0, pi - pan, pan)
+        pan = np.where(x == 0, np.where(y > 0, 90.0, self.target_pan), pan)
+
+        with np.errstate(invalid="ignore"):
+            tilt = np.arccos(z)
+        tilt = np.where(tilt > pi/2, pi - tilt, tilt)
+
+        return np.degrees(pan), np.degrees(tilt)
+
+"""
+    rotation matrix
+    returns the 3x3 matrix that rotates in order x, y, z by the angles xyz,
+    as used by Rotator
+"""
+def rotation_matrix(xyz):
+    import numpy as np
+
+    # initalizes 3x3 matrix with all elem = 0.0
+    rot_mat = np.full((3, 3), 0.0)
+
+    # we want to reverse angles to compensate movement
+    xyz = [-x for x in xyz]
+
+    # precompute sin and cos for all components
+    s = [np.sin(x) for x in xyz]
+    c = [np.cos(x) for x in xyz]
+
+    rot_mat[0, 0] =  c[2]*c[1]
+    rot_mat[0, 1] = -s[2]*c[1]
+    rot_mat[0, 2] =  s[1]
+
+    rot_mat[1, 0] =  s[1]*c[2]*s[0]+s[2]*c[0]
+    rot_mat[1, 1] =  -s[2]*s[1]*s[0]+c[2]*c[0]
+    rot_mat[1, 2] = -c[1]*s[0]
+
+    rot_mat[2, 0] = -c[2]*s[2]*c[0]+s[2]*s[0]
+    rot_mat[2, 1] =  s[2]*s[1]*c[0]+c[2]*s[0]
+    rot_mat[2, 2] =  c[1]*c[0]
+
+    return rot_mat
+
+"""
+    dummy main
+    checks rotate and rotate_many against the matrix version
+"""
+def main():
+    import numpy as np
+
+    rng = np.random.RandomState(0)
+    for pan, tilt in [(0, 45), (-60, 10), (90, 80)]:
+        r = Rotator(pan, tilt)
+        angles = rng.uniform(-0.5, 0.5, (1000, 3))
+
+        # pan and tilt from the matrix version, same steps as rotate
+        pt = np.array([np.dot(r.target, rotation_matrix(a)) for a in angles])
+        ref_pan = np.arctan2(pt[:, 1], pt[:, 0])
+        ref_pan = np.where(pt[:, 0] < 0, pi - ref_pan, ref_pan)
+        ref_tilt = np.arccos(pt[:, 2])
+        ref_tilt = np.where(ref_tilt > pi/2, pi - ref_tilt, ref_tilt)
+        ref = np.degrees(np.column_stack([ref_pan, ref_tilt]))
+
+        single = np.array([r.rotate(a) for a in angles.tolist()])
+        many = np.column_stack(r.rotate_many(angles))
+
+        print("target (%d, %d): max diff rotate %.2e, rotate_many %.2e"%(
+            pan, tilt, np.abs(single - ref).max(), np.abs(many - ref).max()))
+
+if __name__ == "__main__":
+    main()
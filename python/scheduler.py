@@ -0,0 +1,247 @@
+import os
+import select
+import time
+
+import instrument
+from helper import now
+from ringbuffer import RingBuffer
+
+"""
+    scheduling of the control loop
+
+    instead of spinning on serial and the clock, the loop sleeps until
+    serial data arrives or the next output is due:
+        ticker = Ticker(output_dt, buffer_size)
+        waiter = create_waiter(ser)
+        while True:
+            ... read and process serial ...
+            if ticker.due(now()):
+                ... output ...
+            waiter.wait(ticker.remaining(now()))
+    with a camera, a RateController picks the tick interval, see set_interval
+"""
+
+class Ticker:
+    """
+        output deadlines at a fixed interval, measures how late every tick
+        is handled (jitter)
+
+        deadlines are kept on a fixed grid, so a late tick does not delay the
+        next ones, ticks missed entirely are skipped
+    """
+    def __init__(self, interval, buffer_size=100):
+        self.interval = interval
+        self.deadline = None # of the next tick, None until the first
+
+        # lateness of the ticks in seconds, newest first
+        self.jitter_buf = RingBuffer(buffer_size)
+        self.jitter_h = instrument.histogram("loop.tick_jitter")
+        self.late = 0.0 # of the last tick
+        self.missed = 0
+
+    """
+        returns True if a tick is due at time t, and moves on to the next
+    """
+    def due(self, t):
+        if self.deadline is None:
+            self.deadline = t # first tick right away
+        if t < self.deadline:
+            return False
+
+        late = t - self.deadline
+        self.late = late
+        self.jitter_buf.push(late)
+        self.jitter_h.add(late)
+
+        self.deadline += self.interval
+        if self.deadline <= t:
+            missed = int((t - self.deadline)/self.interval) + 1
+            self.missed += missed
+            self.deadline += missed*self.interval
+        return True
+
+    """
+        changes the interval, from the last tick on
+    """
+    def set_interval(self, interval):
+        if self.deadline is not None:
+            self.deadline += interval - self.interval
+        self.interval = interval
+
+    """
+        returns the time from t until the next tick, in seconds
+    """
+    def remaining(self, t):
+        return 0.0 if self.deadline is None else self.deadline - t
+
+class RateController:
+    """
+        adapts the output rate to what the camera and the loop sustain,
+        within [min_freq, max_freq] Hz, starting at freq
+
+        a camera sustains about one move per round trip time (rtt, the http
+        requests of camera.Camera.move, smoothed), headroom leaves time for
+        jitter, so the rate is limited to 1/(rtt*headroom)
+        the rate goes down right away to the limit, to the achieved rate if
+        the loop does not reach it, or by backoff when the camera falls
+        behind (moves dropped as the previous was not sent yet), at most
+        once per cooldown seconds, and goes up slowly otherwise
+
+        the achieved rate is the mean over the last window outputs, all at
+        the current rate, so after a change it is not known until window
+        outputs later, until then the rate is not raised or cut for it
+        a rate the loop did not reach is not tried again for probe_time
+        seconds
+
+        changes smaller than hysteresis (relative) are not applied, so the
+        ticker does not change interval every output
+    """
+    def __init__(self, freq, min_freq=5.0, max_freq=50.0, headroom=1.5,
+            smoothing=0.1, increase=0.01, backoff=0.7, cooldown=1.0,
+            hysteresis=0.05, window=25, probe_time=30.0):
+        self.min_freq = min_freq
+        self.max_freq = max_freq
+        self.headroom = headroom
+        self.smoothing = smoothing # weight of a new measurement
+        self.increase = increase # share of the way up to the limit per output
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.hysteresis = hysteresis
+        self.window = window
+        self.probe_time = probe_time
+
+        self.freq = self.clamp(freq) # applied
+        self.wanted = self.freq # before hysteresis
+        self.limit = max_freq
+
+        # smoothed rtt, and achieved rate over the output intervals in
+        # dt_buf, None until measured
+        self.rtt = None
+        self.achieved = None
+        self.dt_buf = RingBuffer(window)
+        self.outputs = 0 # at the current rate
+
+        self.dropped = 0 # by the camera worker, as of the last update
+        self.backoff_t = None
+        self.ceiling = None # rate the loop did not reach
+        self.ceiling_t = None
+        self.changes = 0
+
+    def clamp(self, freq):
+        return min(max(freq, self.min_freq), self.max_freq)
+
+    """
+        updates with an output at time t, dt after the previous one
+        rtt: round trip time of the newest camera move in seconds, None if
+            there was none since the last update
+        dropped: moves dropped by the camera worker so far
+        returns the new rate in Hz if it changed, otherwise None
+    """
+    def update(self, t, dt, rtt, dropped):
+        a = self.smoothing
+        if rtt is not None:
+            self.rtt = rtt if self.rtt is None else self.rtt + a*(rtt - self.rtt)
+        self.dt_buf.push(dt)
+        self.outputs += 1
+        if self.outputs >= self.window:
+            self.achieved = 1.0/self.dt_buf.mean()
+
+        limit = self.max_freq
+        if self.rtt:
+            limit = min(limit, 1.0/(self.rtt*self.headroom))
+        self.limit = limit
+
+        if self.ceiling is not None and t - self.ceiling_t > self.probe_time:
+            self.ceiling = None
+
+        wanted = self.wanted
+        cooled = self.backoff_t is None or t - self.backoff_t > self.cooldown
+        if dropped > self.dropped and cooled:
+            wanted *= self.backoff
+            self.backoff_t = t
+        elif self.achieved is not None and cooled and \
+                self.achieved < (1.0 - self.hysteresis)*self.freq:
+            wanted = self.achieved # the loop does not keep up
+            self.backoff_t = t
+            self.ceiling = self.freq
+            self.ceiling_t = t
+        elif wanted > limit:
+            wanted = limit
+        elif self.achieved is not None:
+            if self.ceiling is not None:
+                # stay clear of the rate that failed
+                limit = min(limit, self.ceiling*(1.0 - self.hysteresis))
+            wanted = max(wanted, min(wanted + self.increase*(limit - wanted),
+                limit))
+        self.dropped = dropped
+        self.wanted = wanted = self.clamp(wanted)
+
+        if abs(wanted - self.freq) < self.hysteresis*self.freq:
+            return None
+        self.freq = wanted
+        self.achieved = None # measured again at the new rate
+        self.outputs = 0
+        self.changes += 1
+        return wanted
+
+    """
+        returns the state for diagnostics
+    """
+    def snapshot(self):
+        return {
+            "freq": self.freq,
+            "limit": self.limit,
+            "rtt": self.rtt,
+            "achieved": self.achieved,
+            "changes": self.changes
+        }
+
+class SelectWaiter:
+    """
+        waits for data on a file descriptor (a serial port on linux or mac)
+    """
+    def __init__(self, fd):
+        self.fd = fd
+
+    """
+        waits at most timeout seconds, less if data arrives
+    """
+    def wait(self, timeout):
+        if timeout > 0.0:
+            select.select([self.fd], [], [], timeout)
+
+class SleepWaiter:
+    """
+        waits by sleeping in short steps, for serial ports that can not be
+        waited on (windows, recording.ReplaySerial)
+    """
+    def __init__(self, step=0.001):
+        self.step = step
+
+        # the windows timer ticks every 15.6 ms unless asked for 1 ms
+        if os.name == "nt":
+            try:
+                import ctypes
+                ctypes.windll.winmm.timeBeginPeriod(1)
+            except Exception:
+                pass
+
+    """
+        waits at most timeout seconds, less if data may have arrived
+    """
+    def wait(self, timeout):
+        if timeout > 0.0:
+            time.sleep(min(timeout, self.step))
+
+"""
+    create waiter
+    returns a waiter for serial port ser, waking on incoming data if the os
+    allows it
+"""
+def create_waiter(ser):
+    if os.name != "nt" and hasattr(ser, "fileno"):
+        try:
+            return SelectWaiter(ser.fileno())
+        except Exception:
+            pass # not an os level port
+    return SleepWaiter()
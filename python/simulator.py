@@ -0,0 +1,363 @@
+from bisect import bisect_right
+from math import degrees, sqrt
+import errno
+import os
+import select
+import sys
+import threading
+import time
+import numpy as np
+
+import protocol
+import recording
+import synthetic
+from helper import *
+
+"""
+    sensor board simulator on a virtual serial port (pty), to run main.py
+    or load test the serial, fusion and output path without hardware, at
+    rates beyond the real sensors
+
+    usage:
+        python simulator.py [--rate HZ] [--acc-rate HZ] [--gyro-rate HZ]
+                [--motion NAME] [--bias X,Y,Z] [--warnings N] [--seed N]
+                [--duration S] [--truth FILE] [--score]
+            --rate sets both sensor rates (default 100 Hz)
+            --motion is sway, tilt or still (see synthetic.py)
+            --bias is the gyro bias in raw units
+            --warnings is the number of "skipped gyro read" warnings per
+                second
+            --truth writes the true angles (t, x, y, z in degrees) to FILE
+            without --score, prints the port to give main.py --port and
+            runs until ctrl-c (or duration seconds)
+            with --score, also runs the Stabilizer on the port (the other
+            main.py args apply, e.g. --backend, --output-freq, --binary)
+            and reports the fusion error against the true angles and how
+            well the loop keeps up
+"""
+
+# motion profiles by name, see synthetic.py
+motions = {
+    "sway": synthetic.sway,
+    "tilt": synthetic.tilt,
+    "still": synthetic.still
+}
+
+# sample kinds of the binary protocol, the samples use those of recording.py
+protocol_kinds = {
+    recording.ACC: protocol.ACC,
+    recording.GYRO: protocol.GYRO,
+    recording.WARNING: protocol.WARNING
+}
+
+class Simulator(threading.Thread):
+    """
+        sends the samples of synthetic.generate on a pty in real time, from a
+        background thread, as ascii lines or as binary frames once the host
+        asks for them (see protocol.py), like the arduino does
+
+        the samples are generated in blocks of block seconds, see
+        synthetic.generate for the other arguments
+        warning_rate: "skipped gyro read" warnings per second, at random
+        max_pending: bytes the host may fall behind by, samples that do not
+            fit are dropped (and counted) like a full serial buffer would
+        truth_path: file the true angles at every gyro sample are written to
+            (t, x, y, z in degrees), see also truth
+    """
+    def __init__(self, acc_rate=100.0, gyro_rate=100.0, motion=synthetic.sway,
+            acc_noise=5.0, gyro_noise=3.0, gyro_bias=(0.0, 0.0, 0.0),
+            warning_rate=0.0, seed=0, block=1.0, max_pending=65536,
+            truth_path=None):
+        import pty
+        import tty
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.acc_rate = acc_rate
+        self.gyro_rate = gyro_rate
+        self.motion = motion
+        self.acc_noise = acc_noise
+        self.gyro_noise = gyro_noise
+        self.gyro_bias = gyro_bias
+        self.warning_rate = warning_rate
+        self.seed = seed
+        self.block = block
+        self.max_pending = max_pending
+
+        # raw, so nothing is echoed or translated, and the writing end does
+        # not block when the host falls behind
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        fcntl_nonblock(self.master)
+        self.port = os.ttyname(self.slave)
+
+        self.binary = False
+
+        # samples of the current block, sorted, and the next one to send
+        self.samples = [] # (t, kind, dt, v)
+        self.sample_ts = []
+        self.next = 0
+        self.blocks = 0
+
+        self.truth_f = open(truth_path, "w") if truth_path else None
+
+        self.pending = bytearray() # not yet taken by the host
+        self.start_t = None
+
+        # counters
+        self.sent = 0 # samples
+        self.dropped = 0
+        self.warnings = 0
+        self.bytes_sent = 0
+
+        self.stopped = threading.Event()
+
+    """
+        generates the next block of samples
+    """
+    def generate(self):
+        start = self.blocks*self.block
+        acc, gyro, truth = synthetic.generate(self.block, self.acc_rate,
+            self.gyro_rate, self.motion, acc_noise=self.acc_noise,
+            gyro_noise=self.gyro_noise, gyro_bias=self.gyro_bias,
+            seed=self.seed + self.blocks, start=start)
+
+        # sorted by time, acc first on ties
+        samples = [(r[0], 0, recording.ACC, int(r[1]), [int(r[2]), int(r[3]), 0])
+            for r in acc.tolist()]
+        samples += [(r[0], 1, recording.GYRO, int(r[1]), [int(x) for x in r[2:5]])
+            for r in gyro.tolist()]
+        rng = np.random.RandomState(self.seed + self.blocks)
+        for t in rng.uniform(start, start + self.block,
+                rng.poisson(self.warning_rate*self.block)).tolist():
+            samples.append((t, 2, recording.WARNING, 0, [0, 0, 0]))
+        samples.sort()
+
+        self.samples = [(t, kind, dt, v) for t, _, kind, dt, v in samples]
+        self.sample_ts = [s[0] for s in samples]
+        self.next = 0
+        self.blocks += 1
+
+        if self.truth_f:
+            np.savetxt(self.truth_f, np.column_stack(
+                [truth[:, 0], np.degrees(truth[:, 1:])]), fmt="%.6f")
+
+    """
+        returns the encoded samples with times up to t
+    """
+    def take(self, t):
+        data = []
+        while True:
+            end = bisect_right(self.sample_ts, t, self.next)
+            for _, kind, dt, v in self.samples[self.next:end]:
+                if kind == recording.WARNING:
+                    self.warnings += 1
+                if self.binary:
+                    data.append(protocol.encode(protocol_kinds[kind], dt, v))
+                else:
+                    data.append((recording.record_to_line(kind, dt, v)
+                        + "\r\n").encode("ascii"))
+            self.next = end
+            if end < len(self.samples):
+                return data
+            self.generate() # the block is used up
+
+    """
+        handles the mode requests of the host
+    """
+    def read_requests(self):
+        try:
+            data = os.read(self.master, 1024)
+        except OSError as e:
+            if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                return
+            raise
+        if protocol.MODE_BINARY in data:
+            self.binary = data.rfind(protocol.MODE_BINARY) > \
+                data.rfind(protocol.MODE_ASCII)
+        elif protocol.MODE_ASCII in data:
+            self.binary = False
+
+    """
+        writes as much of the pending bytes as the host takes
+    """
+    def flush(self):
+        while self.pending:
+            try:
+                n = os.write(self.master, bytes(self.pending))
+            except OSError as e:
+                if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    return
+                raise
+            self.bytes_sent += n
+            del self.pending[:n]
+
+    def start(self):
+        self.start_t = now()
+        self.generate()
+        threading.Thread.start(self)
+
+    def run(self):
+        while not self.stopped.is_set():
+            data = self.take(now() - self.start_t)
+            if len(self.pending) > self.max_pending:
+                self.dropped += len(data)
+            else:
+                self.sent += len(data)
+                self.pending += b"".join(data)
+            self.flush()
+
+            # the usb serial of the arduino also sends about once a ms
+            r, _, _ = select.select([self.master], [], [], 0.001)
+            if r:
+                self.read_requests()
+
+    """
+        returns the true angles [x, y, z] at t seconds after start (now() -
+        start_t)
+    """
+    def truth(self, t):
+        return self.motion(np.array([t]))[0].tolist()
+
+    """
+        returns the counters
+    """
+    def snapshot(self):
+        return {
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "warnings": self.warnings,
+            "bytes_sent": self.bytes_sent
+        }
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        os.close(self.master)
+        os.close(self.slave)
+        if self.truth_f:
+            self.truth_f.close()
+
+"""
+    serve
+    runs a Simulator with the keyword arguments kwargs until anything is
+    received on conn (a multiprocessing pipe), to keep it in its own process
+    and off the interpreter lock of the stabilizer
+    sends (port, start_t) when started and snapshot() when stopped
+"""
+def serve(kwargs, conn):
+    sim = Simulator(**kwargs)
+    sim.start()
+    conn.send((sim.port, sim.start_t))
+    conn.recv()
+    sim.stop()
+    conn.send(sim.snapshot())
+
+"""
+    fcntl nonblock
+    makes reads and writes on the file descriptor fd return right away
+"""
+def fcntl_nonblock(fd):
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+"""
+    score
+    runs the Stabilizer on port for duration seconds, next to a simulator
+    following motion from start_t (see serve), and returns its stats with
+    the rms error of the fused angles against the true ones at every output
+    (after warmup seconds) added as "rms_error", [x, y, z] in degrees
+"""
+def score(port, start_t, motion, settings, duration, warmup=2.0):
+    import stabilizer
+
+    stab = stabilizer.Stabilizer(dict(settings, port=port))
+    sq = [0.0]*3
+    n = 0
+    try:
+        t_end = now() + duration
+        while now() < t_end:
+            if stab.step():
+                t = now() - start_t
+                if t > warmup:
+                    truth = motion(np.array([t]))[0].tolist()
+                    for i in range(3):
+                        sq[i] += (stab.angles[i] - truth[i])**2
+                    n += 1
+            stab.wait()
+        d = stab.stats()
+    finally:
+        stab.close()
+    d["rms_error"] = [degrees(sqrt(x/max(n, 1))) for x in sq]
+    return d
+
+def main():
+    rate = arg_value("--rate")
+    acc_rate = float(arg_value("--acc-rate") or rate or 100.0)
+    gyro_rate = float(arg_value("--gyro-rate") or rate or 100.0)
+    motion = motions[arg_value("--motion") or "sway"]
+    bias = [float(x) for x in (arg_value("--bias") or "0,0,0").split(",")]
+    duration = arg_value("--duration")
+    duration = float(duration) if duration else None
+    kwargs = {
+        "acc_rate": acc_rate,
+        "gyro_rate": gyro_rate,
+        "motion": motion,
+        "gyro_bias": bias,
+        "warning_rate": float(arg_value("--warnings") or 0.0),
+        "seed": int(arg_value("--seed") or 0),
+        "truth_path": arg_value("--truth")
+    }
+
+    if "--score" in sys.argv:
+        import multiprocessing
+        import main as main_
+
+        conn, child_conn = multiprocessing.Pipe()
+        p = multiprocessing.Process(target=serve, args=(kwargs, child_conn))
+        p.daemon = True
+        p.start()
+        port, start_t = conn.recv()
+        settings = dict(main_.cli_settings(), calibration="")
+        try:
+            d = score(port, start_t, motion, settings, duration or 10.0)
+        finally:
+            conn.send("stop")
+            sim = conn.recv()
+            p.join()
+
+        print("rates: acc %d Hz, gyro %d Hz, sent %d samples (%d dropped, "
+            "%d warnings)"%(acc_rate, gyro_rate, sim["sent"], sim["dropped"],
+            sim["warnings"]))
+        print("fused: acc %d Hz, gyro %d Hz, backlog max %d bytes"%(
+            d["acc_f"][1], d["gyro_f"][1], d["backlog"][1]))
+        print("output: %.1f Hz (target %.1f), %d missed, busy %.1f %%"%(
+            d["out_f"][2], d["out_f"][0], d["missed"], d["busy"]*100.0))
+        for name in ["serial.read", "fusion.pass", "loop.output"]:
+            h = d["timing"].get(name)
+            if h:
+                print("  %-14s p50 %8.1f us  p99 %8.1f us"%(
+                    name, h["p50"]*1e6, h["p99"]*1e6))
+        print("rms error [deg]: " + nice_format_list_of_float(d["rms_error"]))
+        return
+
+    sim = Simulator(**kwargs)
+    sim.start()
+    print("serial port: %s"%sim.port)
+    print("  python main.py --port %s"%sim.port)
+    try:
+        t_end = now() + duration if duration else None
+        while t_end is None or now() < t_end:
+            time.sleep(1.0)
+            print("sent %d samples (%d dropped), %d bytes, %s"%(
+                sim.sent, sim.dropped, sim.bytes_sent,
+                "binary" if sim.binary else "ascii"))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+from serial import Serial
+from math import degrees
+
+import calibration
+import camera
+import fusion
+import instrument
+import linereader
+import prediction
+import rotation
+import scheduler
+from helper import *
+from ringbuffer import RingBuffer
+
+"""
+    default settings of a rig, see Stabilizer
+"""
+default_settings = {
+    "name": "rig",
+    "port": None, # serial port of the sensor board, None or "auto" finds it
+    "port_cache": "ports.json", # where found ports are kept, see find_port
+    "replay": None, # recording to play back instead of port, see recording.py
+    "record": None, # file to record the serial stream to
+    "binary": False, # use the binary sensor protocol, see protocol.py
+    "camera_ip": None, # None disables camera control
+    "shape_commands": True, # leave out moves that change little
+    "dead_band": 0.2, # degrees, see camera.CommandShaper
+    "min_dv": 0.5, # degrees per second
+    "max_command_rate": 10.0, # velocity commands per second
+    "estimate_position": True, # instead of asking the camera every move
+    "max_position_error": 0.2, # degrees, see camera.PositionEstimator
+    "pan": 0, # target pan, degrees
+    "tilt": 45, # target tilt, degrees
+    "output_freq": 25.0, # Hz, at start if adapted
+    "adapt_output": True, # to the camera, see scheduler.RateController
+    "min_output_freq": None, # Hz, None is 5 or output_freq if lower
+    "max_output_freq": None, # Hz, None is 50 or output_freq if higher
+    "backend": fusion.default_config["backend"], # see fusion.create_fuser
+    "predict": True, # compensate camera latency if any, see prediction.py
+    "latency_offset": 0.0, # seconds added to the measured camera latency
+    "calibration": None, # None is per rig name, "" is none, see calibration.py
+    "online_cal": False, # update and save gyro_cal, see calibration.py
+    "telemetry": None # directory to record every output to, see telemetry.py
+}
+
+class Stabilizer:
+    """
+        stabilizes one rig: reads the sensor board, fuses the samples and
+        moves the camera to keep it at the target pan and tilt
+        settings: see default_settings, missing keys get the default
+    """
+    def __init__(self, settings):
+        s = dict(default_settings, **settings)
+        if s["calibration"] is None:
+            s["calibration"] = calibration.default_path(s["name"])
+        self.settings = s
+
+        # used for lookup
+        self.output_freq = float(s["output_freq"])
+        self.output_dt = 1.0/self.output_freq
+
+        # camera movement "gain", follows the output rate, see
+        # set_output_freq
+        self.cam_dt = 2.0*self.output_dt
+
+        # used for measuring output freq
+        self.last_output_time = 0.0
+
+        # buffer length is set such that the buffer is 1 second long
+        buf_len = int(self.output_freq)
+
+        # start serial
+        self.binary = s["binary"] and not s["replay"] # recordings are ascii
+        # protocol and recording need numpy, they are only imported when
+        # used so an ascii rig starts without it
+        if s["replay"] or s["record"]:
+            import recording
+        if s["replay"]:
+            self.ser = recording.ReplaySerial(s["replay"])
+        else:
+            if s["port"] in [None, "auto"]:
+                s["port"] = find_port(s["name"], s["port_cache"])
+                if not s["port"]:
+                    raise Exception("No serial port found")
+            self.ser = Serial(s["port"], 115200, timeout=0)
+
+        # create and initalize a fuser
+        config = dict(fusion.default_config, backend=s["backend"],
+            online_cal=s["online_cal"])
+        config = calibration.load_calibration(s["calibration"], config)
+        f = fusion.create_fuser(config, buffer_size=buf_len)
+        self.f = f
+
+        # saves the zero values of the online calibration, off the loop
+        self.cal_saver = None
+        if f.calibrator and s["calibration"]:
+            self.cal_saver = calibration.CalibrationSaver(f, s["calibration"])
+            self.cal_saver.start()
+
+        # reads complete lines (or binary frames) from serial
+        if self.binary:
+            import protocol
+            self.reader = protocol.FrameReader(self.ser)
+            self.read = self.reader.read_samples
+            self.process = lambda sample: protocol.process(f, sample)
+        else:
+            if not s["replay"]:
+                # in case it was left in binary mode (protocol.MODE_ASCII)
+                self.ser.write(b"A")
+            self.reader = linereader.LineReader(self.ser)
+            self.read = self.reader.read_lines
+            self.process = f.process
+
+        # start recording
+        self.recorder = None
+        if s["record"]:
+            self.recorder = recording.Recorder(s["record"])
+            self.record = self.recorder.record_sample if self.binary \
+                else self.recorder.record
+
+        # create and initalize a camera object
+        # moves are sent from a background worker, keeping only the newest
+        self.cam_worker = None
+        if s["camera_ip"]:
+            shaper = None
+            if s["shape_commands"]:
+                shaper = camera.CommandShaper(s["dead_band"], s["min_dv"],
+                    s["max_command_rate"])
+            estimator = None
+            if s["estimate_position"]:
+                estimator = camera.PositionEstimator(s["max_position_error"])
+            self.cam_worker = camera.CameraWorker(
+                camera.Camera(s["camera_ip"], shaper, estimator),
+                buffer_size=buf_len)
+            self.cam_worker.start()
+
+        # adapts the output rate to the camera
+        self.rate_ctl = None
+        if self.cam_worker and s["adapt_output"]:
+            freq = self.output_freq
+            self.rate_ctl = scheduler.RateController(freq,
+                s["min_output_freq"] or min(5.0, freq),
+                s["max_output_freq"] or max(50.0, freq))
+            self.output_freq = self.rate_ctl.freq
+            self.output_dt = 1.0/self.output_freq
+            self.cam_dt = 2.0*self.output_dt
+        self.cam_round_trips = 0 # when the rate was last updated
+
+        # extrapolates the angles by the camera latency, measured by the
+        # camera worker, without a camera there is nothing to compensate
+        self.predictor = None
+        if self.cam_worker and s["predict"]:
+            self.predictor = prediction.Predictor(offset=s["latency_offset"])
+        self.cam_sent = 0 # moves sent when the latency was last updated
+
+        # create and initalize a rotator
+        self.rotator = rotation.Rotator(s["pan"], s["tilt"])
+
+        # last output
+        self.angles = [0.0]*3
+        self.predicted = [0.0]*3
+        self.pan, self.tilt = 0.0, 0.0
+        self.outputs = 0
+
+        # create empty buffers
+        self.out_f_buf = RingBuffer(buf_len)
+        self.fuse_t_buf = RingBuffer(buf_len)
+        self.rot_t_buf = RingBuffer(buf_len)
+        self.out_t_buf = RingBuffer(buf_len)
+        self.backlog_buf = RingBuffer(buf_len, 0)
+        self.exc_buf = RingBuffer(buf_len, None, stats=False)
+
+        # record of every output, see telemetry.py
+        self.telemetry = None
+        if s["telemetry"]:
+            import telemetry
+            self.telemetry = telemetry.Telemetry(s["telemetry"])
+            self.telemetry.start()
+        self.samples = 0 # processed since last output
+        self.rot_t = 0.0
+        self.backlog = 0
+
+        # timing of the loop stages, see instrument.py
+        self.read_h = instrument.histogram("serial.read")
+        self.fuse_h = instrument.histogram("fusion.pass")
+        self.output_h = instrument.histogram("loop.output")
+
+        # output deadlines, and sleeping until data or the next deadline
+        self.ticker = scheduler.Ticker(self.output_dt, buf_len)
+        self.waiter = scheduler.create_waiter(self.ser)
+
+        # share of the time not spent waiting, per output
+        self.busy_buf = RingBuffer(buf_len)
+        self.waited = 0.0
+
+    """
+        reads everything waiting on serial and processes all complete samples
+    """
+    def poll(self):
+        t = now()
+        samples = self.read()
+        read_t = now()
+        self.read_h.add(read_t - t)
+        if not samples:
+            return
+        self.samples += len(samples)
+
+        # timed per pass, a clock read per sample would cost as much as
+        # the fusion itself
+        ok = True
+        for s in samples:
+            if self.recorder:
+                self.record(s)
+            try:
+                self.process(s)
+            except Exception as e:
+                self.exc_buf.push(e) # save the exception for diagnostic output
+                ok = False
+        if ok:
+            self.exc_buf.push(None)
+
+        fuse_t = now() - read_t
+        self.fuse_h.add(fuse_t)
+        self.fuse_t_buf.push(fuse_t/len(samples)) # per sample
+
+    """
+        rotates the current angles, predicted forward by the camera latency,
+        to pan and tilt and moves the camera
+        t: time of this output, dt: time since last output
+    """
+    def output(self, t, dt):
+        self.last_output_time = t
+        self.out_f_buf.push(1.0/dt)
+        self.outputs += 1
+
+        self.busy_buf.push(max(0.0, 1.0 - self.waited/dt))
+        self.waited = 0.0
+
+        # largest serial backlog since last output
+        self.backlog = self.reader.peak_backlog
+        self.backlog_buf.push(self.backlog)
+        self.reader.peak_backlog = 0
+
+        self.angles = list(self.f.angles) # the fuser updates it in place
+        if self.predictor:
+            sent, age = self.cam_worker.latest()
+            if sent != self.cam_sent:
+                self.cam_sent = sent
+                self.predictor.update(age)
+            self.predicted = self.predictor.predict(self.angles, self.f.rates)
+        else:
+            self.predicted = self.angles
+
+        rot_t = now()
+        self.pan, self.tilt = self.rotator.rotate(self.predicted)
+        self.rot_t = now() - rot_t
+        self.rot_t_buf.push(self.rot_t)
+
+        if self.cam_worker:
+            self.cam_worker.submit(self.pan, self.tilt, self.cam_dt)
+        if self.rate_ctl:
+            self.adapt_output(t, dt)
+
+    """
+        adapts the output rate to the camera, see scheduler.RateController
+        t: time of this output, dt: time since last output
+    """
+    def adapt_output(self, t, dt):
+        round_trips, rtt, dropped = self.cam_worker.throughput()
+        if round_trips == self.cam_round_trips or round_trips == 1:
+            rtt = None # not new, or the first, which also connects
+        self.cam_round_trips = round_trips
+        freq = self.rate_ctl.update(t, dt, rtt, dropped)
+        if freq:
+            self.set_output_freq(freq)
+
+    """
+        changes the output rate to freq Hz, from the next output on
+        the camera is given the longer of two outputs and its round trip
+        time to reach a target
+    """
+    def set_output_freq(self, freq):
+        self.output_freq = freq
+        self.output_dt = 1.0/freq
+        self.ticker.set_interval(self.output_dt)
+        rtt = self.rate_ctl.rtt if self.rate_ctl else None
+        self.cam_dt = 2.0*max(self.output_dt, rtt or 0.0)
+
+    """
+        one pass of the control loop: processes new samples and outputs if
+        the next output is due, then calls on_output(self)
+        returns True if output was done
+    """
+    def step(self, on_output=None):
+        self.poll()
+
+        # if the next output is due, output data
+        t = now()
+        if not self.ticker.due(t):
+            return False
+
+        # the first output has no previous one, taken as on time
+        dt = t - self.last_output_time if self.outputs else self.output_dt
+        self.output(t, dt)
+        if on_output:
+            on_output(self)
+        out_t = now() - t
+        self.out_t_buf.push(out_t)
+        self.output_h.add(out_t)
+
+        if self.telemetry:
+            # angles and predicted are new lists every output, no copies
+            self.telemetry.add((t, dt, self.angles, self.predicted,
+                (self.pan, self.tilt), self.ticker.late, self.samples,
+                self.backlog, self.rot_t, out_t))
+        self.samples = 0
+        return True
+
+    """
+        sleeps until serial data arrives or the next output is due
+    """
+    def wait(self):
+        t = now()
+        self.waiter.wait(self.ticker.remaining(t))
+        self.waited += now() - t
+
+    """
+        runs the control loop forever, see step
+    """
+    def run(self, on_output=None):
+        while True:
+            self.step(on_output)
+            self.wait()
+
+    """
+        returns the state and diagnostic data of the rig as a dict of plain
+        values (can be pickled and sent between processes)
+    """
+    def stats(self):
+        s = self.settings
+        excs = [str(x) for x in self.exc_buf if x]
+        d = {
+            "name": s["name"],
+            "serial": s["replay"] or s["port"],
+            "camera_ip": s["camera_ip"],
+            "backend": s["backend"],
+            "target": [s["pan"], s["tilt"]],
+            "outputs": self.outputs,
+            "acc_f": cur_avg_min(self.f.acc_f_buf),
+            "gyro_f": cur_avg_min(self.f.gyro_f_buf),
+            "out_f": [self.output_freq] + cur_avg_min(self.out_f_buf),
+            "fus_t": [self.fuse_t_buf.mean(), self.fuse_t_buf.max()],
+            "rot_t": [self.rot_t_buf.mean(), self.rot_t_buf.max()],
+            "out_t": [self.out_t_buf.mean(), self.out_t_buf.max()],
+            "backlog": [self.backlog_buf.latest(), self.backlog_buf.max()],
+            "jitter": cur_avg_max(self.ticker.jitter_buf),
+            "missed": self.ticker.missed,
+            "busy": self.busy_buf.mean(),
+            "status": excs[0] if excs else "ok",
+            "angles": [degrees(x) for x in self.angles],
+            "predicted": [degrees(x) for x in self.predicted],
+            "pan_tilt": [self.pan, self.tilt],
+            "camera": None,
+            "calibration": None,
+            "prediction": None,
+            "rate": None,
+            "timing": instrument.snapshot()
+        }
+        if self.cam_worker:
+            cam = self.cam_worker.snapshot()
+            d["camera"] = {
+                "latency": [cam["latency_avg"], cam["latency_max"]],
+                "sent": cam["sent"],
+                "suppressed": cam["suppressed"],
+                "dropped": cam["dropped"],
+                "errors": cam["errors"],
+                "last_error": str(cam["last_error"] or ""),
+                "in_flight": cam["in_flight"],
+                "position": None
+            }
+            estimator = self.cam_worker.camera.estimator
+            if estimator:
+                d["camera"]["position"] = estimator.snapshot()
+        if self.f.calibrator:
+            d["calibration"] = {
+                "gyro_cal": list(self.f.config["gyro_cal"]),
+                "updates": self.f.calibrator.updates,
+                "rejected": self.f.calibrator.rejected
+            }
+        if self.rate_ctl:
+            d["rate"] = self.rate_ctl.snapshot()
+        if self.predictor:
+            d["prediction"] = {
+                "latency": self.predictor.latency,
+                "horizon": self.predictor.horizon(),
+                "measurements": self.predictor.measurements
+            }
+        return d
+
+    """
+        stops the camera worker and closes serial, recording and telemetry,
+        saving the calibration
+    """
+    def close(self):
+        if self.cam_worker:
+            self.cam_worker.stop()
+        if self.cal_saver:
+            self.cal_saver.stop()
+        if self.recorder:
+            self.recorder.close()
+        if self.telemetry:
+            self.telemetry.stop()
+        self.ser.close()
@@ -0,0 +1,280 @@
+import json
+import multiprocessing
+import signal
+import sys
+import traceback
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+import calibration
+import stabilizer
+from helper import *
+
+"""
+    supervisor for many rigs (sensor board and camera pairs), every rig is
+    stabilized in its own process so one slow or broken rig can not stall
+    the others
+
+    usage:
+        python supervisor.py RIGS
+            RIGS is a json file with a list of rig settings, see
+            stabilizer.default_settings, for example
+            [
+                {"name": "left", "port": "/dev/ttyACM0",
+                    "camera_ip": "169.254.20.202"},
+                {"name": "right", "port": "/dev/ttyACM1",
+                    "camera_ip": "169.254.20.203", "pan": 30}
+            ]
+            a rig without a port finds it, see helper.find_port, and a rig
+            without a calibration file gets its own, see
+            calibration.default_path
+
+    failed rigs are restarted with a growing delay, rigs that have not
+    reported for stale_time seconds are shown as stale, and after
+    restart_stale_time seconds their worker is stopped and they are
+    restarted like failed rigs, as are rigs whose worker died without a
+    word (killed)
+"""
+
+# seconds between reports from every rig
+report_interval = 1.0
+
+# seconds without a report before a rig is shown as stale, and restarted
+stale_time = 5.0
+restart_stale_time = 15.0
+
+# restart delay after a failure, doubled for every failure in a row
+# a rig starts in well under a second, so the first retry is quick
+restart_delay = 0.1
+max_restart_delay = 30.0
+
+"""
+    run rig
+    stabilizes one rig, runs in a worker process
+    puts (name, "running", stats) on queue every interval seconds and
+    (name, "failed", error) if the rig fails
+"""
+def run_rig(settings, queue, interval=report_interval):
+    name = settings["name"]
+    stab = None
+    try:
+        stab = stabilizer.Stabilizer(settings)
+        last_report = 0.0
+        while True:
+            stab.step()
+            stab.wait()
+            t = now()
+            if t - last_report >= interval:
+                last_report = t
+                queue.put((name, "running", stab.stats()))
+    except Exception as e:
+        # the traceback is lost when the exception crosses processes
+        queue.put((name, "failed", "%s\n%s"%(e, traceback.format_exc())))
+    finally:
+        if stab:
+            stab.close()
+
+"""
+    worker
+    runs in the worker process of a rig, see run_rig
+    ctrl-c goes to the whole process group, the supervisor stops the workers
+"""
+def worker(settings, queue):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run_rig(settings, queue)
+
+class Rig:
+    """
+        what the supervisor knows about one rig
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.name = settings["name"]
+        self.status = "starting"
+        self.stats = None
+        self.error = None
+        self.last_report = now()
+        self.failures = 0 # in a row
+        self.restarts = 0
+        self.restart_time = None
+        self.process = None # worker process
+
+class Supervisor:
+    """
+        starts one worker process per rig and collects their reports
+        a rig gets a new process on every start, so a hung or killed worker
+        is replaced and never holds up the others
+    """
+    def __init__(self, rigs):
+        names = [r["name"] for r in rigs]
+        if len(set(names)) != len(names):
+            raise Exception("Rig names must be unique")
+
+        # every board has its own zero values
+        rigs = [dict(r, calibration=r.get("calibration")
+            or calibration.default_path(r["name"])) for r in rigs]
+        paths = [r["calibration"] for r in rigs]
+        if len(set(paths)) != len(paths):
+            raise Exception("Rigs can not share a calibration file")
+
+        self.rigs = dict((r["name"], Rig(r)) for r in rigs)
+        self.order = names
+
+        # a manager queue, a worker killed while putting does not break it
+        self.queue = multiprocessing.Manager().Queue()
+
+        for name in names:
+            self.start(self.rigs[name])
+
+    def start(self, rig):
+        self.stop(rig)
+        rig.status = "starting"
+        rig.last_report = now()
+        rig.restart_time = None
+        rig.process = multiprocessing.Process(target=worker,
+            args=(rig.settings, self.queue))
+        rig.process.daemon = True
+        rig.process.start()
+
+    """
+        stops the worker of rig, if any
+    """
+    def stop(self, rig):
+        p = rig.process
+        if p is None:
+            return
+        if p.is_alive():
+            p.terminate()
+        p.join()
+        rig.process = None
+
+    """
+        handles all reports waiting on the queue, and restarts failed rigs
+        whose delay has passed
+    """
+    def poll(self, timeout):
+        try:
+            msg = self.queue.get(timeout=timeout)
+            while True:
+                self.handle(*msg)
+                msg = self.queue.get_nowait()
+        except Empty:
+            pass
+
+        t = now()
+        for rig in self.rigs.values():
+            if rig.status == "failed":
+                if t >= rig.restart_time:
+                    rig.restarts += 1
+                    self.start(rig)
+            elif not rig.process.is_alive():
+                self.handle(rig.name, "failed", "worker died (exit code %s)"%
+                    rig.process.exitcode)
+            elif t - rig.last_report > restart_stale_time:
+                self.stop(rig)
+                self.handle(rig.name, "failed",
+                    "no report for %.0f s, restarted"%restart_stale_time)
+            elif t - rig.last_report > stale_time:
+                rig.status = "stale"
+
+    def handle(self, name, status, data):
+        rig = self.rigs[name]
+        rig.last_report = now()
+        if status == "running":
+            rig.status = status
+            rig.stats = data
+            rig.failures = 0
+        else:
+            rig.status = status
+            rig.error = data
+            rig.failures += 1
+            delay = min(restart_delay*2**(rig.failures - 1), max_restart_delay)
+            rig.restart_time = now() + delay
+
+    """
+        returns the aggregated view of all rigs as text
+    """
+    def table(self):
+        # every row is formatted as strings, so all rows line up
+        fmt = "%-12s %-8s %4s %10s %10s %12s %13s %11s %8s %s"
+        lines = [
+            fmt%("rig", "status", "rst", "out [hz]", "acc [hz]", "fus [us]",
+                "out p99 [us]", "http [ms]", "backlog", "last error")
+        ]
+        total_outputs = 0
+        n_running = 0
+        for name in self.order:
+            rig = self.rigs[name]
+            d = rig.stats
+            error = (rig.error or "").split("\n")[0]
+            if d:
+                total_outputs += d["outputs"]
+                if d["status"] != "ok":
+                    error = d["status"]
+                cam = d["camera"]
+                http = "%d %d"%tuple(int(x*1.0e3) for x in cam["latency"]) \
+                    if cam else "-"
+                if cam and cam["last_error"]:
+                    error = cam["last_error"]
+                out_h = d["timing"].get("loop.output")
+                cells = [
+                    "%d %d"%(round_to_int(d["out_f"][1]),
+                        round_to_int(d["out_f"][3])),
+                    "%d %d"%(round_to_int(d["acc_f"][1]),
+                        round_to_int(d["acc_f"][2])),
+                    "%d %d"%(int(d["fus_t"][0]*1.0e6), int(d["fus_t"][1]*1.0e6)),
+                    "%d"%(int(out_h["p99"]*1.0e6) if out_h else 0),
+                    http,
+                    "%d"%d["backlog"][1]
+                ]
+            else:
+                cells = ["-"]*6
+            lines.append(fmt%tuple([name[:12], rig.status, rig.restarts]
+                + cells + [error[:40]]))
+            n_running += rig.status == "running"
+
+        lines += [
+            "",
+            "rigs running: %d/%d, outputs: %d"%(
+                n_running, len(self.rigs), total_outputs)
+        ]
+        return "\n".join(lines)
+
+    """
+        supervises until interrupted, printing the table every interval
+        seconds
+    """
+    def run(self, interval=report_interval):
+        last_print = 0.0
+        while True:
+            self.poll(timeout=interval/4)
+            t = now()
+            if t - last_print >= interval:
+                last_print = t
+                clear_console()
+                print(ascii_art + "\n")
+                print(self.table())
+
+    def close(self):
+        for rig in self.rigs.values():
+            self.stop(rig)
+
+def main():
+    if len(sys.argv) < 2:
+        exit("usage: python supervisor.py RIGS")
+    with open(sys.argv[1]) as f:
+        rigs = json.load(f)
+
+    s = Supervisor(rigs)
+    try:
+        s.run()
+    except KeyboardInterrupt:
+        print("\nStopping rigs...")
+    finally:
+        s.close()
+
+if __name__ == "__main__":
+    main()
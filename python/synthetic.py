@@ -0,0 +1,109 @@
+from math import pi
+import numpy as np
+
+import fusion
+
+"""
+    sway
+    default motion profile, a slow rocking around all axes
+    t: array of times in seconds
+    returns an array with rows [x, y, z] rotation angles in radians
+"""
+def sway(t):
+    return np.column_stack([
+        0.10*np.sin(2*pi*0.5*t),
+        0.05*np.sin(2*pi*0.3*t + 1.0),
+        0.02*np.sin(2*pi*0.2*t)
+    ])
+
+"""
+    tilt
+    motion profile with large tilts, where small angle approximations fail
+"""
+def tilt(t):
+    return np.column_stack([
+        0.6*np.sin(2*pi*0.2*t),
+        0.5*np.sin(2*pi*0.13*t + 1.0),
+        0.8*np.sin(2*pi*0.1*t)
+    ])
+
+"""
+    still
+    motion profile of a rig standing still and level
+"""
+def still(t):
+    return np.zeros((len(t), 3))
+
+"""
+    generates raw sensor samples, as the arduino would send them, for a rig
+    following motion
+
+    duration:   seconds of data
+    acc_rate:   acc samples per second
+    gyro_rate:  gyro samples per second
+    motion:     function of time, see sway
+    config:     sensor calibration, the inverse of the conversion in Fuser
+    acc_noise:  standard deviation of acc noise, raw units
+    gyro_noise: standard deviation of gyro noise, raw units
+    gyro_bias:  [x, y, z] offset added to the calibrated gyro zero, raw units
+    seed:       random seed, the same seed gives the same data
+    start:      time in seconds the data follows on from, the first samples
+                are one dt later, so blocks can be generated one after another
+
+    returns (acc, gyro, truth):
+        acc rows [t, dt, x, y] and gyro rows [t, dt, x, y, z], see
+        Fuser.process_batch, t in seconds and the rest integers as in the lines
+        truth rows [t, x, y, z], the true angles at every gyro sample
+"""
+def generate(duration, acc_rate=100.0, gyro_rate=100.0, motion=sway,
+        config=fusion.default_config, acc_noise=5.0, gyro_noise=3.0,
+        gyro_bias=(0.0, 0.0, 0.0), seed=0, start=0.0):
+    rng = np.random.RandomState(seed)
+    c = config
+
+    ## acc, gravity seen from the rotated sensor
+    # the angles are roll x, pitch y and yaw z of a rigid body (z, y, x order),
+    # for small angles these are the angles Fuser estimates
+    acc_dt = int(round(1e6/acc_rate))
+    acc_t = start + np.arange(1, int(duration*acc_rate) + 1)*acc_dt*1e-6
+    ang = motion(acc_t)
+    acc_g = np.column_stack([
+        -np.sin(ang[:, 1]),
+        np.sin(ang[:, 0])*np.cos(ang[:, 1])
+    ])
+    acc_raw = acc_g*c["acc_g"] + c["acc_cal"]
+    acc_raw += rng.normal(0.0, acc_noise, acc_raw.shape)
+
+    ## gyro, body rates of the rotated sensor
+    gyro_dt = int(round(1e6/gyro_rate))
+    gyro_t = start + np.arange(1, int(duration*gyro_rate) + 1)*gyro_dt*1e-6
+    ang = motion(gyro_t)
+    prev_ang = motion(gyro_t - gyro_dt*1e-6)
+    d = (ang - prev_ang)/(gyro_dt*1e-6) # rate of change of the angles
+    x, y, _ = ((ang + prev_ang)/2).T
+    rate = np.column_stack([
+        d[:, 0] - d[:, 2]*np.sin(y),
+        d[:, 1]*np.cos(x) + d[:, 2]*np.cos(y)*np.sin(x),
+        -d[:, 1]*np.sin(x) + d[:, 2]*np.cos(y)*np.cos(x)
+    ])
+    gyro_raw = np.degrees(rate)/c["gyro_to_dps_factor"]*c["gyro_signs"] \
+        + c["gyro_cal"] + gyro_bias
+    gyro_raw += rng.normal(0.0, gyro_noise, gyro_raw.shape)
+
+    acc = np.column_stack([acc_t, np.full(len(acc_t), acc_dt),
+        np.round(acc_raw)])
+    gyro = np.column_stack([gyro_t, np.full(len(gyro_t), gyro_dt),
+        np.round(gyro_raw)])
+    truth = np.column_stack([gyro_t, ang])
+    return acc, gyro, truth
+
+"""
+    lines
+    returns the samples as the lines the arduino sends (see Fuser.process),
+    ordered by time with acc first on ties
+"""
+def lines(acc, gyro):
+    l = [(r[0], 0, "atxy\t%d\t%d\t%d"%tuple(r[1:])) for r in acc.tolist()] \
+        + [(r[0], 1, "gtxyz\t%d\t%d\t%d\t%d"%tuple(r[1:])) for r in gyro.tolist()]
+    l.sort()
+    return [(t, s) for t, _, s in l]
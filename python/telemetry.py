@@ -0,0 +1,224 @@
+import json
+import os
+import shutil
+import sys
+import threading
+import numpy as np
+
+from helper import *
+
+"""
+    telemetry, a record of what the stabilizer did at every output
+
+    rows are appended to a list by the control loop (one append per tick),
+    a background thread moves them to preallocated, memory mapped .npy
+    files, one per column, in segments of a fixed number of rows:
+        DIR/000001/t.npy
+        DIR/000001/angles.npy
+        ...
+        DIR/000001/meta.json    {"count": rows written, "columns": [...]}
+    a full segment is closed and the next one started, the oldest segments
+    are deleted beyond max_segments
+
+    meta.json is written after the data, so a crash loses at most the rows
+    of the last flush interval, see load
+"""
+
+"""
+    default columns, (name, dtype, shape) as for a numpy record dtype, see
+    stabilizer.Stabilizer.step for what goes in them
+"""
+COLUMNS = [
+    ("t", "<f8", ()), # time of the output, seconds
+    ("dt", "<f4", ()), # since the previous output
+    ("angles", "<f4", (3,)), # fused, radians
+    ("predicted", "<f4", (3,)), # sent to the rotator, see prediction.py
+    ("pan_tilt", "<f4", (2,)), # degrees
+    ("late", "<f4", ()), # how late the tick was handled
+    ("samples", "<i4", ()), # processed since the previous output
+    ("backlog", "<i4", ()), # serial bytes waiting, most since last output
+    ("rot_t", "<f4", ()), # rotation
+    ("out_t", "<f4", ()) # whole output, including on_output
+]
+
+class Telemetry(threading.Thread):
+    """
+        records rows to the directory path, see above
+
+        columns: see COLUMNS, add takes rows in this order
+        segment_size: rows per segment file, preallocated
+        max_segments: segments kept, the oldest are deleted
+        interval: seconds between flushes to the files
+        max_pending: rows kept in memory at most if the flushing falls
+            behind, further rows are dropped (and counted)
+    """
+    def __init__(self, path, columns=COLUMNS, segment_size=100000,
+            max_segments=100, interval=1.0, max_pending=100000):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.path = path
+        self.columns = columns
+        self.dtype = np.dtype([(name, dtype, shape)
+            for name, dtype, shape in columns])
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.interval = interval
+        self.max_pending = max_pending
+
+        # rows added by the loop, taken by the flushing thread
+        self.pending = []
+        self.dropped = 0
+        self.rows = 0 # written to files
+
+        # continue after the segments of earlier runs
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.segment = max([0] + segments(path))
+        self.files = None # column name: memmap of the open segment
+        self.count = 0 # rows in the open segment
+
+        self.stopped = threading.Event()
+
+    """
+        adds a row, a tuple of values in the order of columns (lists for
+        columns with a shape), the only part run by the control loop
+    """
+    def add(self, row):
+        if len(self.pending) < self.max_pending:
+            self.pending.append(row)
+        else:
+            self.dropped += 1
+
+    """
+        starts a new segment with preallocated files
+    """
+    def open_segment(self):
+        self.segment += 1
+        path = os.path.join(self.path, "%06d"%self.segment)
+        os.makedirs(path)
+        self.files = {}
+        for name, dtype, shape in self.columns:
+            self.files[name] = np.lib.format.open_memmap(
+                os.path.join(path, name + ".npy"), mode="w+", dtype=dtype,
+                shape=(self.segment_size,) + shape)
+        self.count = 0
+        self.write_meta()
+
+        # bounded disk use
+        for s in segments(self.path)[:-self.max_segments]:
+            shutil.rmtree(os.path.join(self.path, "%06d"%s), True)
+
+    """
+        writes the meta data of the open segment, replaced in one step
+    """
+    def write_meta(self):
+        path = os.path.join(self.path, "%06d"%self.segment, "meta.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump({
+                "count": self.count,
+                "columns": [[name, dtype, list(shape)]
+                    for name, dtype, shape in self.columns]
+            }, f)
+        if os.name == "nt" and os.path.exists(path):
+            os.remove(path)
+        os.rename(path + ".tmp", path)
+
+    def close_segment(self):
+        for a in self.files.values():
+            a.flush()
+        self.write_meta()
+        self.files = None
+
+    """
+        moves the pending rows to the files
+    """
+    def flush(self):
+        # only this thread removes rows, rows added meanwhile stay
+        n = len(self.pending)
+        if not n:
+            return
+        rows = np.array(self.pending[:n], dtype=self.dtype)
+        del self.pending[:n]
+
+        i = 0
+        while i < n:
+            if self.files is None:
+                self.open_segment()
+            k = min(n - i, self.segment_size - self.count)
+            for name, a in self.files.items():
+                a[self.count:self.count + k] = rows[name][i:i + k]
+            self.count += k
+            self.rows += k
+            i += k
+            if self.count == self.segment_size:
+                self.close_segment()
+
+        if self.files is not None:
+            for a in self.files.values():
+                a.flush()
+            self.write_meta()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    """
+        stops the thread and writes what is left
+    """
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.flush()
+        if self.files is not None:
+            self.close_segment()
+
+"""
+    segments
+    returns the numbers of the segments in the telemetry directory path,
+    oldest first
+"""
+def segments(path):
+    return sorted(int(s) for s in os.listdir(path) if s.isdigit())
+
+"""
+    load
+    returns the telemetry in directory path as {column name: array}, the
+    rows of all segments in order
+    a single segment is memory mapped, not read
+"""
+def load(path):
+    parts = {}
+    for s in segments(path):
+        seg_path = os.path.join(path, "%06d"%s)
+        try:
+            with open(os.path.join(seg_path, "meta.json")) as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            continue # started but never written
+        for name, _, _ in meta["columns"]:
+            a = np.load(os.path.join(seg_path, name + ".npy"), mmap_mode="r")
+            parts.setdefault(name, []).append(a[:meta["count"]])
+    return dict((name, a[0] if len(a) == 1 else np.concatenate(a))
+        for name, a in parts.items())
+
+"""
+    prints a summary of the telemetry in a directory
+    usage: python telemetry.py DIR
+"""
+def main():
+    d = load(sys.argv[1])
+    if not d or not len(d["t"]):
+        exit("no telemetry")
+    t = d["t"]
+    print("rows: %d, %.1f s"%(len(t), t[-1] - t[0]))
+    for name in sorted(d):
+        if name == "t":
+            continue
+        a = np.asarray(d[name], dtype=float).reshape(len(t), -1)
+        print("%-10s mean %s  max %s"%(name,
+            " ".join("%10.4g"%x for x in a.mean(axis=0)),
+            " ".join("%10.4g"%x for x in a.max(axis=0))))
+
+if __name__ == "__main__":
+    main()
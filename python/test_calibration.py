@@ -0,0 +1,48 @@
+import unittest
+
+import fusion
+import synthetic
+
+"""
+    tests of the online calibration on synthetic data
+
+    usage:
+        python -m unittest test_calibration (or python -m pytest)
+"""
+
+bias = (5.0, -3.0, 2.0)
+
+"""
+    runs an online calibrating fuser on duration seconds of motion
+    returns the fuser
+"""
+def calibrate(duration, rate, motion):
+    acc, gyro, _ = synthetic.generate(duration, rate, rate, motion=motion,
+        gyro_bias=bias)
+    f = fusion.create_fuser(dict(fusion.default_config, online_cal=True))
+    fusion.process_each(f, acc, gyro)
+    return f
+
+class TestOnlineCalibrator(unittest.TestCase):
+    def test_sway_is_not_still(self):
+        # at a high rate a few samples near the turning points of a slow
+        # sway look still, seconds of them do not
+        f = calibrate(10.0, 5000.0, synthetic.sway)
+        self.assertEqual(f.calibrator.updates, 0)
+        self.assertEqual(f.config["gyro_cal"],
+            fusion.default_config["gyro_cal"])
+
+    def test_still_finds_bias(self):
+        f = calibrate(30.0, 100.0, synthetic.still)
+        self.assertGreater(f.calibrator.updates, 0)
+        for cal, cal0, b in zip(f.config["gyro_cal"],
+                fusion.default_config["gyro_cal"], bias):
+            self.assertAlmostEqual(cal, cal0 + b, delta=0.5)
+
+    def test_window_in_seconds(self):
+        # not still for long enough, however many samples
+        f = calibrate(2.0, 5000.0, synthetic.still)
+        self.assertEqual(f.calibrator.updates, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+import numpy as np
+
+import fusion
+import synthetic
+
+"""
+    tests of Fuser.process_batch against Fuser.process
+
+    usage:
+        python -m unittest test_fusion (or python -m pytest)
+"""
+
+# radians
+tolerance = 1e-9
+
+"""
+    returns (acc, gyro) of two blocks at different rates, so dt changes
+    halfway
+"""
+def samples(motion=synthetic.sway):
+    acc1, gyro1, _ = synthetic.generate(2.0, 100.0, 100.0, motion=motion,
+        gyro_bias=(5.0, -3.0, 2.0))
+    acc2, gyro2, _ = synthetic.generate(2.0, 250.0, 40.0, motion=motion,
+        gyro_bias=(5.0, -3.0, 2.0), seed=1, start=2.0)
+    return np.vstack([acc1, acc2]), np.vstack([gyro1, gyro2])
+
+"""
+    returns the angles after every line fed to process, and the fuser
+"""
+def process_lines(acc, gyro):
+    f = fusion.Fuser()
+    angles = []
+    for _, s in synthetic.lines(acc, gyro):
+        f.process(s)
+        angles.append(list(f.angles))
+    return np.array(angles), f
+
+class TestProcessBatch(unittest.TestCase):
+    def check(self, acc, gyro):
+        ref, f_ref = process_lines(acc, gyro)
+        f = fusion.Fuser()
+        t, angles = f.process_batch(acc, gyro)
+
+        self.assertEqual(angles.shape, ref.shape)
+        self.assertLess(np.abs(angles[0] - ref[0]).max(), tolerance)
+        self.assertLess(np.abs(angles - ref).max(), tolerance)
+
+        # the state is left as after the last sample
+        for name in ["angles", "filt_acc", "rates"]:
+            self.assertLess(np.abs(np.subtract(getattr(f, name),
+                getattr(f_ref, name))).max(), tolerance)
+        return f, f_ref
+
+    def test_sway(self):
+        self.check(*samples())
+
+    def test_tilt(self):
+        self.check(*samples(synthetic.tilt))
+
+    def test_dt_change(self):
+        acc, gyro = samples()
+        self.assertEqual(len(set(acc[:, 1].tolist())), 2)
+        self.assertEqual(len(set(gyro[:, 1].tolist())), 2)
+        self.check(acc, gyro)
+
+    def test_first_sample(self):
+        acc, gyro = samples()
+        self.check(acc[:1], gyro[:0]) # acc only
+        self.check(acc[:0], gyro[:1]) # gyro only
+        self.check(acc[:1], gyro[:1])
+
+    def test_continues(self):
+        # two batches give the same as one
+        acc, gyro = samples()
+        ref, _ = process_lines(acc, gyro)
+        f = fusion.Fuser()
+        split = 2.0
+        _, a1 = f.process_batch(acc[acc[:, 0] < split], gyro[gyro[:, 0] < split])
+        _, a2 = f.process_batch(acc[acc[:, 0] >= split],
+            gyro[gyro[:, 0] >= split])
+        self.assertLess(np.abs(np.vstack([a1, a2]) - ref).max(), tolerance)
+
+if __name__ == "__main__":
+    unittest.main()
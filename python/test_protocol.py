@@ -0,0 +1,80 @@
+import unittest
+
+import protocol
+
+"""
+    tests of the binary protocol reader
+
+    usage:
+        python -m unittest test_protocol (or python -m pytest)
+"""
+
+class FakeBoard:
+    """
+        a serial port of a board that sends one sample per read pass, as an
+        ascii line until it is asked for binary frames, reset() puts it back
+        in ascii like a board reset does
+    """
+    def __init__(self):
+        self.binary = False
+        self.requests = 0
+        self.n = 0
+
+    def reset(self):
+        self.binary = False
+
+    def write(self, data):
+        if data == protocol.MODE_BINARY:
+            self.binary = True
+            self.requests += 1
+        elif data == protocol.MODE_ASCII:
+            self.binary = False
+
+    @property
+    def in_waiting(self):
+        return 1 # there is always a sample
+
+    def read(self, size=1):
+        self.n += 1
+        if self.binary:
+            return protocol.encode(protocol.GYRO, 10000, [self.n, 0, 0])
+        return ("gtxyz\t10000\t%d\t0\t0\r\n"%self.n).encode("ascii")
+
+class TestFrameReader(unittest.TestCase):
+    def test_sync(self):
+        board = FakeBoard()
+        reader = protocol.FrameReader(board)
+        self.assertEqual(len(reader.read_samples()), 1)
+        self.assertTrue(reader.synced)
+        self.assertEqual(board.requests, 1)
+
+    def test_resync_after_reset(self):
+        board = FakeBoard()
+        reader = protocol.FrameReader(board)
+        for _ in range(3):
+            reader.read_samples()
+
+        board.reset()
+        self.assertEqual(reader.read_samples(), []) # an ascii line
+        self.assertFalse(reader.synced)
+        self.assertEqual(reader.resyncs, 1)
+
+        # asked again on the next read, without waiting for retry_time
+        samples = reader.read_samples()
+        self.assertEqual(board.requests, 2)
+        self.assertEqual(len(samples), 1)
+        self.assertTrue(reader.synced)
+
+    def test_no_repeated_requests(self):
+        # while the board stays in ascii, the request is only repeated every
+        # retry_time
+        board = FakeBoard()
+        board.write = lambda data: setattr(board, "requests",
+            board.requests + 1)
+        reader = protocol.FrameReader(board, retry_time=60.0)
+        for _ in range(10):
+            reader.read_samples()
+        self.assertEqual(board.requests, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import protocol
+import recording
+
+"""
+    tests of recording and replaying the serial stream
+
+    usage:
+        python -m unittest test_recording (or python -m pytest)
+"""
+
+class TestRecording(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "test.rec")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    """
+        records lines and returns the lines replayed
+    """
+    def round_trip(self, lines):
+        r = recording.Recorder(self.path)
+        for s in lines:
+            r.record(s, 1.0)
+        r.close()
+        return [s for _, s in recording.Replay(self.path).lines()]
+
+    def test_round_trip(self):
+        lines = ["atxy 10000 4000 6000", "gtxyz 10000 150 -200 50",
+            "w skipped gyro read"]
+        replayed = self.round_trip(lines)
+        self.assertEqual([s.split() for s in replayed],
+            [s.split() for s in lines])
+
+    def test_kept_lines(self):
+        lines = ["w something new", "atxy 10000 40", "gtxyz 1.5 1 2 3"]
+        self.assertEqual(self.round_trip(lines), lines)
+
+    def test_out_of_range(self):
+        # corrupt lines with numbers that do not fit a record
+        lines = ["atxy 10000 4000 99999999999", "gtxyz 3000000000 1 2 3",
+            "atxy 10000 -2147483649 6000", "atxy 10000 2147483647 6000"]
+        replayed = self.round_trip(lines)
+        self.assertEqual(replayed[:3], lines[:3])
+        self.assertEqual(replayed[3].split(), lines[3].split())
+        kinds = recording.Replay(self.path).records["kind"].tolist()
+        self.assertEqual(kinds, [recording.INVALID]*3 + [recording.ACC])
+
+    def test_out_of_range_sample(self):
+        r = recording.Recorder(self.path)
+        r.record_sample((protocol.GYRO, 2**32 - 1, [1, 2, 3]), 1.0)
+        r.record_sample((protocol.ACC, 10000, [4000, 6000, 0]), 1.0)
+        r.close()
+        kinds = recording.Replay(self.path).records["kind"].tolist()
+        self.assertEqual(kinds, [recording.INVALID, recording.ACC])
+
+if __name__ == "__main__":
+    unittest.main()
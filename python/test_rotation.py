@@ -0,0 +1,125 @@
+from math import sin, cos, pi, acos, degrees, atan2, radians
+import unittest
+import numpy as np
+
+from rotation import Rotator, rotation_matrix
+
+"""
+    tests of Rotator.rotate and rotate_many against the original rotate
+
+    usage:
+        python -m unittest test_rotation (or python -m pytest)
+"""
+
+"""
+    reference rotate
+    the rotate of the first version of rotation.py, kept as it was, returns
+    [pan, tilt] in degrees of xyz coordinates [x, y, z] for the target
+    (pan, tilt) in degrees
+"""
+def reference_rotate(target, xyz):
+    pan, tilt = map(radians, target)
+    target_pan = pan
+    target_pt = np.array([
+        sin(tilt)*cos(pan),
+        sin(tilt)*sin(pan),
+        cos(tilt)
+    ])
+
+    ## construct rotational matrix, rotates in order x, y, z
+
+    # initalizes 3x3 matrix with all elem = 0.0
+    rot_mat = np.full((3, 3), 0.0)
+
+    # we want to reverse angles to compensate movement
+    xyz = [-x for x in xyz]
+
+    # precompute sin and cos for all components
+    s = [np.sin(x) for x in xyz]
+    c = [np.cos(x) for x in xyz]
+
+    rot_mat[0, 0] =  c[2]*c[1]
+    rot_mat[0, 1] = -s[2]*c[1]
+    rot_mat[0, 2] =  s[1]
+
+    rot_mat[1, 0] =  s[1]*c[2]*s[0]+s[2]*c[0]
+    rot_mat[1, 1] =  -s[2]*s[1]*s[0]+c[2]*c[0]
+    rot_mat[1, 2] = -c[1]*s[0]
+
+    rot_mat[2, 0] = -c[2]*s[2]*c[0]+s[2]*s[0]
+    rot_mat[2, 1] =  s[2]*s[1]*c[0]+c[2]*s[0]
+    rot_mat[2, 2] =  c[1]*c[0]
+
+    # rot_max*target_pt applies the rotation to the original vector
+    pt = np.dot(target_pt, rot_mat)
+
+    # correct angles
+    if pt[0] == 0:
+        if pt[1] < 0:
+            pan = -90
+        if pt[1] > 0:
+            pan = 90
+        else:
+            pan  = target_pan
+    elif pt[0] <  0:
+        pan = pi - atan2(pt[1],pt[0])
+    else:
+        pan = atan2(pt[1], pt[0])
+
+    tilt = acos(pt[2]) # tilt = arccos(z/[r = 1])
+    if tilt > pi/2:
+        tilt  = pi - tilt
+
+    return list(map(degrees, [pan, tilt]))
+
+# degrees
+tolerance = 1e-9
+
+# targets (pan, tilt) in degrees, with x > 0 and x < 0 after rotation
+targets = [(0, 45), (-60, 10), (90, 80), (150, 60), (-170, 30), (30, 90)]
+
+class TestRotator(unittest.TestCase):
+    def check(self, target, angles):
+        r = Rotator(*target)
+        ref = np.array([reference_rotate(target, a) for a in angles])
+        single = np.array([r.rotate(a) for a in angles])
+        many = np.column_stack(r.rotate_many(np.array(angles)))
+        self.assertLess(np.abs(single - ref).max(), tolerance)
+        self.assertLess(np.abs(many - ref).max(), tolerance)
+
+    def test_random(self):
+        rng = np.random.RandomState(0)
+        for target in targets:
+            self.check(target, rng.uniform(-0.5, 0.5, (500, 3)).tolist())
+
+    def test_large_angles(self):
+        rng = np.random.RandomState(1)
+        for target in targets:
+            self.check(target, rng.uniform(-pi, pi, (500, 3)).tolist())
+
+    """
+        returns the rotated target points of angles, rows [x, y, z]
+    """
+    def rotated(self, target, angles):
+        r = Rotator(*target)
+        return np.array([np.dot(r.target, rotation_matrix(a)) for a in angles])
+
+    def test_x_negative(self):
+        # the target is behind, x < 0 for small rotations
+        angles = np.random.RandomState(2).uniform(-0.2, 0.2, (100, 3)).tolist()
+        self.assertTrue((self.rotated((180, 45), angles)[:, 0] < 0).all())
+        self.check((180, 45), angles)
+
+    def test_x_zero(self):
+        # straight up, with no z rotation the rotated point has x == 0,
+        # y > 0, y < 0 and y == 0
+        angles = [[-0.3, 0.5, 0.0], [0.3, -0.2, 0.0], [0.0, 0.4, 0.0],
+            [0.0, 0.0, 0.0]]
+        for target in [(0, 0), (40, 0), (-120, 0)]:
+            pt = self.rotated(target, angles)
+            self.assertTrue((pt[:, 0] == 0).all())
+            self.assertEqual(list(np.sign(pt[:, 1])), [1, -1, 0, 0])
+            self.check(target, angles)
+
+if __name__ == "__main__":
+    unittest.main()
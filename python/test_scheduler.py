@@ -0,0 +1,55 @@
+import random
+import unittest
+
+import scheduler
+
+"""
+    tests of the output rate controller with a simulated loop
+
+    usage:
+        python -m unittest test_scheduler (or python -m pytest)
+"""
+
+"""
+    runs n outputs of a loop that reaches at most loop_freq Hz, with jitter
+    returns the controller and the rate after every output
+"""
+def simulate(rc, n, loop_freq, rtt=0.012, jitter=0.1, dropped=lambda i: 0):
+    rng = random.Random(0)
+    t = 0.0
+    freqs = []
+    for i in range(n):
+        dt = max(1.0/rc.freq, 1.0/loop_freq)*(1.0 + rng.uniform(-jitter,
+            jitter))
+        t += dt
+        rc.update(t, dt, rtt + rng.uniform(-0.002, 0.002), dropped(i))
+        freqs.append(rc.freq)
+    return rc, freqs
+
+class TestRateController(unittest.TestCase):
+    def test_settles_at_loop_rate(self):
+        # the camera allows about 55 Hz, the loop only 30 Hz
+        rc, freqs = simulate(scheduler.RateController(25.0), 3000, 30.0)
+        last = freqs[1500:]
+        self.assertLess(rc.changes, 30)
+        self.assertAlmostEqual(sum(last)/len(last), 30.0, delta=1.0)
+        self.assertGreater(min(last), 27.0)
+
+    def test_no_change_before_window(self):
+        rc = scheduler.RateController(40.0)
+        rc, freqs = simulate(rc, rc.window - 1, 30.0)
+        self.assertEqual(rc.changes, 0)
+        self.assertIsNone(rc.achieved)
+
+    def test_climbs_to_limit(self):
+        rc, _ = simulate(scheduler.RateController(10.0), 1000, 100.0,
+            rtt=0.02, jitter=0.0)
+        self.assertAlmostEqual(rc.freq, rc.limit, delta=0.1*rc.limit)
+
+    def test_backoff_on_dropped(self):
+        rc, freqs = simulate(scheduler.RateController(30.0), 200, 100.0,
+            dropped=lambda i: int(i >= 100))
+        self.assertLess(freqs[100], freqs[99])
+
+if __name__ == "__main__":
+    unittest.main()
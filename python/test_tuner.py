@@ -0,0 +1,52 @@
+import unittest
+
+import fusion
+import tuner
+
+"""
+    tests of the tuner on synthetic sessions, where the gyro bias is known
+
+    usage:
+        python -m unittest test_tuner (or python -m pytest)
+"""
+
+# the zero values the synthetic sessions were generated with
+true_gyro_cal = [cal + b for cal, b in
+    zip(fusion.default_config["gyro_cal"], tuner.synthetic_bias)]
+
+class TestTuner(unittest.TestCase):
+    def setUp(self):
+        self.base = dict(fusion.default_config, online_cal=False)
+
+    """
+        returns the grid of every gyro axis around its true zero value
+    """
+    def gyro_grid(self, step):
+        return dict(("gyro_cal_" + axis, [x - 2*step, x - step, x, x + step,
+            x + 2*step]) for axis, x in zip("xyz", true_gyro_cal))
+
+    def test_recovers_gyro_bias(self):
+        for step in [5.0, 1.0]:
+            ranked = tuner.tune(["synthetic:sway"], self.gyro_grid(step),
+                self.base, workers=2, duration=60.0)
+            best = ranked[0]["settings"]
+            for axis, x in zip("xyz", true_gyro_cal):
+                self.assertAlmostEqual(best["gyro_cal_" + axis], x)
+
+    def test_axes_scored_apart(self):
+        # a wrong z zero value must not change which x zero value wins
+        g = {"gyro_cal_x": [true_gyro_cal[0] - 5.0, true_gyro_cal[0],
+            true_gyro_cal[0] + 5.0], "gyro_cal_z": [self.base["gyro_cal"][2]]}
+        ranked = tuner.tune(["synthetic:sway"], g, self.base, workers=2,
+            duration=60.0)
+        self.assertAlmostEqual(ranked[0]["settings"]["gyro_cal_x"],
+            true_gyro_cal[0])
+        self.assertGreater(ranked[0]["yaw"], 1.0) # the z drift is there
+
+    def test_acc_cal_rejected_on_recordings(self):
+        with self.assertRaises(Exception):
+            tuner.tune(["session.rec"], {"acc_cal_x": [4900.0, 5000.0]},
+                self.base, workers=1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,328 @@
+from glob import glob
+import itertools
+import json
+import multiprocessing
+import sys
+import time
+import numpy as np
+
+import calibration
+import fusion
+import recording
+import rotation
+import synthetic
+from helper import *
+
+"""
+    offline tuning of the fusion settings
+
+    replays recorded sessions (see recording.py) through the fuser and the
+    rotator with every combination of a grid of settings, spread over all
+    cores, and ranks the settings by how well they would have stabilized
+    the camera
+
+    usage:
+        python tuner.py [REC ...] [NAME=V1,V2,...] [--synthetic MOTIONS]
+                [--duration S] [--calibration FILE] [--backend NAME]
+                [--output-freq HZ] [--workers N] [--top N] [--out FILE]
+            REC are recordings, globs are expanded
+            NAME=V1,V2,... are the values tried for a setting (see params),
+                default_grid is used for the settings not given
+            --synthetic adds sessions of duration S (default 120) generated
+                with the motions (comma separated, see synthetic.py), these
+                have a known truth
+            the settings start from fusion.default_config with the zero
+            values of --calibration (default calibration-rig.json)
+            all results are written as json to FILE (default tuning.json)
+
+    metrics of a setting, over all sessions:
+        tilt: degrees rms, of the fused x and y angles against the true ones
+            for sessions with a known truth, for recordings of their slow
+            part (mean over ref_window seconds) against the tilt seen by the
+            acc with the zero values of the setting, the only drift free
+            reference there is
+        yaw: degrees rms, of the fused z angle against the true one, only
+            known for synthetic sessions, the acc can not correct it so gyro
+            z bias shows up here only
+        jitter: degrees rms, of the second difference of pan and tilt from
+            one output to the next (of their error with a known truth), how
+            much the camera is made to shake
+        score: tilt + yaw + jitter, the settings are ranked by it
+    tilt and yaw are kept apart as the x and y settings only change the
+    first and the z setting the second, scored together as pan and tilt the
+    yaw drift would hide the x and y settings
+
+    the acc zero values can not be tuned on recordings, the only reference
+    there is the acc itself
+"""
+
+# settings that can be tuned, name: (config key, index in it or None)
+params = {
+    "acc_fc": ("acc_fc", None),
+    "acc_fuse_f": ("acc_fuse_f", None),
+    "gyro_cal_x": ("gyro_cal", 0),
+    "gyro_cal_y": ("gyro_cal", 1),
+    "gyro_cal_z": ("gyro_cal", 2),
+    "acc_cal_x": ("acc_cal", 0),
+    "acc_cal_y": ("acc_cal", 1)
+}
+
+# values tried for the settings not given
+default_grid = {
+    "acc_fc": [2.0, 5.0, 10.0, 20.0],
+    "acc_fuse_f": [0.2, 0.5, 1.0, 2.0]
+}
+
+# gyro bias of the synthetic sessions, raw units, as in benchmark.py
+synthetic_bias = (5.0, -3.0, 2.0)
+
+# recordings are split into pieces of at most this many seconds, so a
+# worker only holds one piece in memory and long sessions are spread over
+# the cores, every piece is scored after warmup seconds of settling
+piece = 600.0
+warmup = 5.0
+
+# seconds the slow part is averaged over for recordings
+ref_window = 10.0
+
+# pan and tilt the camera is kept at, degrees
+target = (0.0, 45.0)
+
+"""
+    configure
+    returns a copy of config with the settings (name, value) applied
+"""
+def configure(config, settings):
+    c = dict(config)
+    for name, value in settings:
+        key, i = params[name]
+        if i is None:
+            c[key] = value
+        else:
+            c[key] = list(c[key])
+            c[key][i] = value
+    return c
+
+"""
+    pieces
+    returns the pieces of the session name as (name, start, end), start and
+    end in seconds as in the recording, None for a synthetic session
+"""
+def pieces(name):
+    if name.startswith("synthetic:"):
+        return [(name, None, None)]
+    t = recording.Replay(name).records["t"]
+    if len(t) < 2:
+        return []
+    starts = np.arange(t[0], t[-1], piece).tolist()
+    return [(name, s, min(s + piece, float(t[-1]) + 1.0)) for s in starts
+        if min(s + piece, t[-1]) - s > warmup + ref_window]
+
+"""
+    load piece
+    returns (acc, gyro, truth) of a piece, see pieces, truth is None for
+    recordings
+"""
+def load_piece(name, start, end, duration):
+    if name.startswith("synthetic:"):
+        motion = getattr(synthetic, name.split(":")[1])
+        return synthetic.generate(duration, motion=motion,
+            gyro_bias=synthetic_bias)
+    acc, gyro = recording.Replay(name).batch(start, end)
+    return acc, gyro, None
+
+"""
+    wrap
+    returns the angle differences d in degrees wrapped to [-180, 180)
+"""
+def wrap(d):
+    return (d + 180.0) % 360.0 - 180.0
+
+def rms(a):
+    return float(np.sqrt(np.mean(a**2))) if a.size else 0.0
+
+"""
+    evaluate
+    runs one setting on a loaded piece and returns (tilt, yaw, jitter,
+    seconds scored), see metrics above
+"""
+def evaluate(config, acc, gyro, truth, output_freq):
+    f = fusion.create_fuser(config)
+    t, angles = f.process_batch(acc, gyro)
+    if len(t) < 2:
+        return 0.0, 0.0, 0.0, 0.0
+
+    # the angles held at every output, as the control loop sends them
+    t_out = np.arange(t[0] + warmup, t[-1], 1.0/output_freq)
+    if len(t_out) < 3:
+        return 0.0, 0.0, 0.0, 0.0
+    i = np.searchsorted(t, t_out, side="right") - 1
+    rotator = rotation.Rotator(*target)
+    out = np.column_stack(rotator.rotate_many(angles[i]))
+
+    if truth is not None:
+        j = np.searchsorted(truth[:, 0], t_out, side="right") - 1
+        d = np.degrees(angles[i] - truth[j, 1:])
+        d_out = wrap(out - np.column_stack(rotator.rotate_many(truth[j, 1:])))
+        return rms(d[:, :2]), rms(d[:, 2]), rms(np.diff(d_out, 2, axis=0)), \
+            t_out[-1] - t_out[0]
+
+    # the tilt seen by the acc at every output, as in Fuser.process_batch
+    c = config
+    g = np.clip((acc[:, 2:4] - c["acc_cal"])/c["acc_g"], -1.0, 1.0)
+    a = np.arcsin(g/np.maximum(1.0, np.sqrt(1.0 - g[:, ::-1]**2)))
+    k = np.maximum(np.searchsorted(acc[:, 0], t_out, side="right") - 1, 0)
+    ref = np.column_stack([a[k, 1], -a[k, 0]])
+
+    # slow parts, means over ref_window seconds
+    n = min(len(t_out), max(1, int(ref_window*output_freq)))
+    w = np.ones(n)/n
+    d = angles[i, :2] - ref
+    slow = np.column_stack([np.convolve(d[:, 0], w, "valid"),
+        np.convolve(d[:, 1], w, "valid")])
+    return rms(np.degrees(slow)), 0.0, rms(wrap(np.diff(out, 2, axis=0))), \
+        t_out[-1] - t_out[0]
+
+"""
+    run
+    runs every setting of a task on its piece, in a worker process
+    task: (piece, [(key, settings)], base config, options)
+    returns [(key, piece name, tilt, yaw, jitter, seconds scored)]
+"""
+def run(task):
+    (name, start, end), settings, base, opts = task
+    acc, gyro, truth = load_piece(name, start, end, opts["duration"])
+    results = []
+    for key, s in settings:
+        results.append((key, name) + evaluate(configure(base, s), acc, gyro,
+            truth, opts["output_freq"]))
+    return results
+
+"""
+    grid
+    returns the grid to try as {name: [values]}, from default_grid and the
+    NAME=V1,V2,... arguments args
+"""
+def grid(args):
+    g = dict(default_grid)
+    for a in args:
+        name, values = a.split("=", 1)
+        if name not in params:
+            raise Exception("unknown setting: %s (one of %s)"%(
+                name, ", ".join(sorted(params))))
+        g[name] = [float(x) for x in values.split(",")]
+    return g
+
+"""
+    tune
+    runs the grid g on the sessions (recording paths or "synthetic:MOTION")
+    with workers processes
+    returns the settings ranked by score, best first, as dicts with the
+    settings and the metrics
+"""
+def tune(sessions, g, base, workers=None, output_freq=25.0, duration=120.0):
+    names = sorted(g)
+    acc_cal = [name for name in names if params[name][0] == "acc_cal"]
+    if acc_cal and any(not s.startswith("synthetic:") for s in sessions):
+        raise Exception("%s can not be tuned on recordings, the acc is the "
+            "only reference there (use --synthetic)"%", ".join(acc_cal))
+    settings = [(k, list(zip(names, values))) for k, values in
+        enumerate(itertools.product(*[g[name] for name in names]))]
+    ps = [p for s in sessions for p in pieces(s)]
+    if not ps:
+        raise Exception("no sessions long enough to tune on")
+
+    # enough tasks to keep every core busy, as few as that takes as every
+    # task loads its piece
+    workers = workers or multiprocessing.cpu_count()
+    per_task = max(1, len(settings)*len(ps)//(4*workers))
+    opts = {"output_freq": output_freq, "duration": duration}
+    tasks = [(p, settings[i:i + per_task], base, opts) for p in ps
+        for i in range(0, len(settings), per_task)]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = [r for rs in pool.imap_unordered(run, tasks) for r in rs]
+    finally:
+        pool.close()
+        pool.join()
+
+    # rms over all pieces, weighted by the seconds scored
+    sums = {}
+    for r in results:
+        s = sums.setdefault(r[0], [0.0]*4)
+        t = r[-1]
+        for k, x in enumerate(r[2:-1]):
+            s[k] += x**2*t
+        s[3] += t
+    ranked = []
+    for key, values in settings:
+        s = sums[key]
+        tilt, yaw, jitter = [(x/s[3])**0.5 if s[3] else 0.0 for x in s[:3]]
+        ranked.append({"settings": dict(values), "tilt": tilt, "yaw": yaw,
+            "jitter": jitter, "score": tilt + yaw + jitter})
+    ranked.sort(key=lambda r: r["score"])
+    return ranked
+
+"""
+    positional arguments
+    returns the arguments that are not options or option values
+"""
+def positional_args(options):
+    args = []
+    skip = False
+    for a in sys.argv[1:]:
+        if skip:
+            skip = False
+        elif a in options:
+            skip = True
+        elif not a.startswith("--"):
+            args.append(a)
+    return args
+
+def main():
+    options = ["--synthetic", "--duration", "--calibration", "--backend",
+        "--output-freq", "--workers", "--top", "--out"]
+    args = positional_args(options)
+    g = grid([a for a in args if "=" in a])
+    sessions = [p for a in args if "=" not in a for p in sorted(glob(a))]
+    duration = float(arg_value("--duration") or 120.0)
+    if arg_value("--synthetic"):
+        sessions += ["synthetic:" + m
+            for m in arg_value("--synthetic").split(",")]
+    if not sessions:
+        exit("no sessions, give recordings or --synthetic sway,tilt")
+
+    base = dict(fusion.default_config, online_cal=False,
+        backend=arg_value("--backend") or "complementary")
+    base = calibration.load_calibration(
+        arg_value("--calibration") or calibration.default_path(), base)
+    workers = int(arg_value("--workers") or 0) or None
+    output_freq = float(arg_value("--output-freq") or 25.0)
+
+    n = 1
+    for values in g.values():
+        n *= len(values)
+    print("tuning %d settings on %d sessions..."%(n, len(sessions)))
+    start_t = now()
+    ranked = tune(sessions, g, base, workers, output_freq, duration)
+    print("done in %.1f s"%(now() - start_t))
+
+    names = sorted(g)
+    print("%4s  %s  %9s %9s %9s %9s"%("rank", " ".join("%10s"%name[:10]
+        for name in names), "tilt", "yaw", "jitter", "score"))
+    for i, r in enumerate(ranked[:int(arg_value("--top") or 10)]):
+        print("%4d  %s  %9.4f %9.4f %9.4f %9.4f"%(i + 1, " ".join("%10g"%
+            r["settings"][name] for name in names), r["tilt"], r["yaw"],
+            r["jitter"], r["score"]))
+
+    with open(arg_value("--out") or "tuning.json", "w") as f:
+        json.dump({
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "sessions": sessions,
+            "grid": g,
+            "ranked": ranked
+        }, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()